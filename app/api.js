@@ -5,6 +5,43 @@
 
 const API_BASE_URL = '/api'; // Change to actual backend URL if needed
 const PROJECT_ROOT = '..'; // Relative path to project root from ui/
+const JOB_POLL_INTERVAL_MS = 1000;
+
+/**
+ * Submit a background job and poll until it finishes.
+ * Calls onProgress(job) on every poll; resolves with the finished job.
+ */
+async function runJob(path, onProgress) {
+  const response = await fetch(`${API_BASE_URL}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' }
+  });
+  
+  const data = await response.json().catch(() => ({}));
+  if (!response.ok) {
+    throw new Error(data.message || `HTTP ${response.status}: ${response.statusText}`);
+  }
+  
+  let job = data.job;
+  while (!['succeeded', 'failed', 'cancelled'].includes(job.status)) {
+    onProgress(job);
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    const poll = await fetch(`${API_BASE_URL}/jobs/${job.id}`);
+    if (!poll.ok) {
+      throw new Error(`HTTP ${poll.status}: ${poll.statusText}`);
+    }
+    job = (await poll.json()).job;
+  }
+  return job;
+}
+
+/**
+ * Format a job's stage/progress for the status line
+ */
+function formatJobProgress(job) {
+  const pct = Math.round((job.progress || 0) * 100);
+  return `${job.status.toUpperCase()}... ${job.stage ? `${job.stage} ` : ''}(${pct}%)`;
+}
 
 /**
  * Execute ETL pipeline
@@ -24,25 +61,19 @@ async function runPipeline() {
   status.textContent = 'RUNNING... Please wait.';
   
   try {
-    // Try backend API first
-    const response = await fetch(`${API_BASE_URL}/pipeline/run`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' }
+    // Submit background job and poll its progress
+    const job = await runJob('/pipeline/run', job => {
+      status.textContent = formatJobProgress(job);
     });
     
-    if (!response.ok) {
-      throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-    }
-    
-    const data = await response.json();
-    
-    if (data.status === 'success') {
+    if (job.status === 'succeeded') {
+      const metrics = job.result?.metrics || {};
       status.className = 'status success';
-      status.textContent = `✅ Pipeline complete! Events: ${data.metrics.events_count?.toLocaleString() || 'N/A'}, Sessions: ${data.metrics.session_count?.toLocaleString() || 'N/A'}, View→Cart: ${data.metrics.view_to_cart_rate?.toFixed(2) || 'N/A'}%, Cart→Purchase: ${data.metrics.cart_to_purchase_rate?.toFixed(2) || 'N/A'}%`;
-      updatePipelineSummary(data.metrics);
+      status.textContent = `✅ Pipeline complete! Events: ${metrics.events_count?.toLocaleString() || 'N/A'}, Sessions: ${metrics.session_count?.toLocaleString() || 'N/A'}, View→Cart: ${metrics.view_to_cart_rate?.toFixed(2) || 'N/A'}%, Cart→Purchase: ${metrics.cart_to_purchase_rate?.toFixed(2) || 'N/A'}%`;
+      updatePipelineSummary(metrics);
     } else {
       status.className = 'status error';
-      status.textContent = `❌ Error: ${data.message || 'Unknown error'}`;
+      status.textContent = `❌ Error: ${job.error || job.status}`;
     }
   } catch (error) {
     // Fallback: Show helpful error message
@@ -73,25 +104,20 @@ async function runAnalytics() {
   status.textContent = 'RUNNING... Please wait.';
   
   try {
-    // Try backend API first
-    const response = await fetch(`${API_BASE_URL}/analytics/run`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' }
+    // Submit background job and poll its progress
+    const job = await runJob('/analytics/run', job => {
+      status.textContent = formatJobProgress(job);
     });
     
-    if (!response.ok) {
-      throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-    }
-    
-    const data = await response.json();
-    
-    if (data.status === 'success') {
+    if (job.status === 'succeeded') {
+      const exports = job.result?.exports || [];
+      const rowsFor = file => exports.find(e => e.file === file)?.rows || 0;
       status.className = 'status success';
-      status.textContent = `✅ Analytics complete! Exported ${data.exports?.[0]?.rows || 0} rows to sku_dropoff.csv, ${data.exports?.[1]?.rows || 0} rows to cohort_retention.csv`;
-      updateAnalyticsExports(data.exports);
+      status.textContent = `✅ Analytics complete! Exported ${rowsFor('sku_dropoff.csv')} rows to sku_dropoff.csv, ${rowsFor('cohort_retention.csv')} rows to cohort_retention.csv`;
+      updateAnalyticsExports(exports);
     } else {
       status.className = 'status error';
-      status.textContent = `❌ Error: ${data.message || 'Unknown error'}`;
+      status.textContent = `❌ Error: ${job.error || job.status}`;
     }
   } catch (error) {
     // Fallback: Show helpful error message
@@ -148,15 +174,12 @@ function updatePipelineSummary(metrics) {
  * Update analytics exports section
  */
 function updateAnalyticsExports(exports) {
-  const skuEl = document.querySelector('[data-export="sku_dropoff"]');
-  const cohortEl = document.querySelector('[data-export="cohort_retention"]');
-  
-  if (skuEl && exports?.[0]) {
-    skuEl.textContent = `sku_dropoff.csv — rows: ${exports[0].rows?.toLocaleString() || 'N/A'}`;
-  }
-  if (cohortEl && exports?.[1]) {
-    cohortEl.textContent = `cohort_retention.csv — rows: ${exports[1].rows?.toLocaleString() || 'N/A'}`;
-  }
+  (exports || []).forEach(exp => {
+    const el = document.querySelector(`[data-export="${exp.file.replace(/\.csv$/, '')}"]`);
+    if (el) {
+      el.textContent = `${exp.file} — rows: ${exp.rows?.toLocaleString() || 'N/A'}`;
+    }
+  });
 }
 
 /**
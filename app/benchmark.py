@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark harness on synthetic events.
+
+For each scale (e.g. 1M, 10M, 100M events) this:
+1. Generates a deterministic events.csv with synth_events (cached per scale
+   and seed under data/interim/bench/)
+2. Runs etl_funnel.py in a child process against its own warehouse and
+   artifacts directory, timing every pipeline stage from its PROGRESS events
+3. Runs run_analytics.py --force and records the time of each SQL report
+4. Times the main API endpoints in-process through Flask's test client
+
+Every step records wall time and throughput. Child processes also record
+peak RSS. Results are written as JSON. Pass --baseline with a previous
+results file to print per-metric changes and flag regressions, e.g. when
+comparing two commits on the same machine.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import datetime as dt
+import pathlib as p
+import duckdb
+from synth_events import generate_events, parse_count, DEFAULTS
+from utils import (BENCH_DIR, PROJECT_ROOT, PROGRESS_ENV, PROGRESS_PREFIX,
+                   add_runtime_args, configure_runtime_from_args, write_json_atomic)
+
+APP_DIR = p.Path(__file__).parent.resolve()
+
+DEFAULT_SCALES = "1M"
+DEFAULT_RESULTS = BENCH_DIR / "results.json"
+
+# Relative slowdown beyond which a metric is reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+# Endpoints timed by the harness: (name, path)
+ENDPOINTS = (
+    ("summary", "/api/pipeline/summary"),
+    ("artifacts", "/api/artifacts"),
+    ("query_by_day", "/api/query/funnel?group_by=day&limit=1000"),
+    ("query_by_sku", "/api/query/funnel?group_by=sku&limit=100"),
+    ("query_by_cohort", "/api/query/funnel?group_by=cohort_month"),
+)
+
+
+def run_child(args, env):
+    """Run a child Python process, timestamping its PROGRESS events.
+
+    Returns:
+        Dict with seconds, peak_rss_mb (None where unavailable), the
+        (stage, elapsed seconds) events and the child's stdout lines
+
+    Raises:
+        RuntimeError: If the child exits with a non-zero status
+    """
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, *args], cwd=APP_DIR, env=env, text=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    events, lines = [], []
+    for line in proc.stdout:
+        if line.startswith(PROGRESS_PREFIX):
+            events.append((json.loads(line[len(PROGRESS_PREFIX):])["stage"],
+                           time.perf_counter() - started))
+        else:
+            lines.append(line.rstrip())
+
+    peak_rss_mb = None
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        scale = 1024 if sys.platform != "darwin" else 1024 * 1024
+        peak_rss_mb = round(usage.ru_maxrss / scale, 1)
+    else:
+        proc.wait()
+    seconds = time.perf_counter() - started
+
+    if proc.returncode != 0:
+        tail = "\n".join(lines[-20:])
+        raise RuntimeError(f"{' '.join(args)} failed with exit code {proc.returncode}:\n{tail}")
+    return {"seconds": seconds, "peak_rss_mb": peak_rss_mb, "events": events, "lines": lines}
+
+
+def stage_durations(events, total):
+    """Turn (stage, started-at) progress events into per-stage seconds."""
+    durations = {}
+    for (stage, at), nxt in zip(events, events[1:] + [("end", total)]):
+        durations[stage] = round(durations.get(stage, 0) + nxt[1] - at, 4)
+    durations.pop("done", None)
+    return durations
+
+
+def bench_env(workdir):
+    """Environment that points the ETL, analytics and server at `workdir`."""
+    env = dict(os.environ)
+    env.update({
+        "FUNNEL_EVENTS_FILE": str(workdir / "events.csv"),
+        "FUNNEL_WAREHOUSE": str(workdir / "funnel.duckdb"),
+        "FUNNEL_ARTIFACTS": str(workdir / "artifacts"),
+        "FUNNEL_RUNS_DIR": str(workdir / "runs"),
+        PROGRESS_ENV: "1",
+    })
+    return env
+
+
+def measure_endpoints(repeat=5):
+    """Time ENDPOINTS in this process (run as a child with bench_env).
+
+    Returns {name: {"first_ms", "warm_ms", "status"}}; warm_ms is the median
+    of `repeat` further requests.
+    """
+    import server
+
+    client = server.app.test_client()
+    results = {}
+    for name, path in ENDPOINTS:
+        timings = []
+        status = None
+        for _ in range(repeat + 1):
+            started = time.perf_counter()
+            response = client.get(path)
+            timings.append((time.perf_counter() - started) * 1000)
+            status = response.status_code
+        results[name] = {
+            "first_ms": round(timings[0], 3),
+            "warm_ms": round(statistics.median(timings[1:]), 3),
+            "status": status,
+        }
+    return results
+
+
+def bench_scale(events, seed, repeat, keep_data):
+    """Generate data for one scale and benchmark ETL, analytics and endpoints."""
+    workdir = BENCH_DIR / f"events_{events}_seed{seed}"
+    (workdir / "artifacts").mkdir(parents=True, exist_ok=True)
+    events_file = workdir / "events.csv"
+    result = {"events_requested": events}
+
+    if events_file.exists():
+        print(f"Reusing {events_file}")
+        with duckdb.connect() as con:
+            rows = con.execute("SELECT COUNT(*) FROM read_csv(?, header = true)",
+                               [str(events_file)]).fetchone()[0]
+        result["generate"] = {"cached": True}
+    else:
+        print(f"Generating ~{events:,} synthetic events...")
+        started = time.perf_counter()
+        rows = generate_events(events_file, events=events, seed=seed)
+        result["generate"] = {"seconds": round(time.perf_counter() - started, 4)}
+    result["events"] = rows
+    result["input_bytes"] = events_file.stat().st_size
+
+    env = bench_env(workdir)
+    (workdir / "funnel.duckdb").unlink(missing_ok=True)
+    (workdir / "funnel.duckdb.wal").unlink(missing_ok=True)
+
+    print("Running ETL...")
+    etl = run_child(["etl_funnel.py"], env)
+    result["etl"] = {
+        "seconds": round(etl["seconds"], 4),
+        "events_per_sec": round(rows / etl["seconds"]),
+        "peak_rss_mb": etl["peak_rss_mb"],
+        "stages": stage_durations(etl["events"], etl["seconds"]),
+    }
+
+    print("Running analytics...")
+    analytics = run_child(["run_analytics.py", "--force"], env)
+    manifest = json.loads((workdir / "artifacts" / "analytics_manifest.json").read_text())
+    result["analytics"] = {
+        "seconds": round(analytics["seconds"], 4),
+        "peak_rss_mb": analytics["peak_rss_mb"],
+        "reports": {name: entry.get("export", {}).get("seconds") for name, entry in sorted(manifest.items())},
+    }
+
+    print("Timing endpoints...")
+    endpoints = run_child([p.Path(__file__).name, "--measure-endpoints", "--repeat", str(repeat)], env)
+    result["endpoints"] = json.loads(endpoints["lines"][-1])
+    result["endpoints_peak_rss_mb"] = endpoints["peak_rss_mb"]
+
+    if not keep_data:
+        for path in (events_file, workdir / "funnel.duckdb", workdir / "funnel.duckdb.wal"):
+            path.unlink(missing_ok=True)
+    return result
+
+
+def git_commit():
+    """Return the current git commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timing_metrics(results):
+    """Flatten results into {"<scale>.<path>": value} for time/memory metrics."""
+    flat = {}
+
+    def walk(prefix, node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                walk(f"{prefix}.{key}" if prefix else str(key), value)
+        elif isinstance(node, (int, float)) and not isinstance(node, bool):
+            leaf = prefix.rsplit(".", 1)[-1]
+            parent = prefix.split(".")[-2] if "." in prefix else ""
+            if (leaf in ("seconds", "first_ms", "warm_ms") or leaf.endswith("peak_rss_mb")
+                    or parent in ("stages", "reports")):
+                flat[prefix] = node
+
+    walk("", results["scales"])
+    return flat
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Print metric changes against a baseline results dict.
+
+    Returns:
+        List of metric names that got slower/larger by more than `threshold`
+    """
+    current, previous = timing_metrics(results), timing_metrics(baseline)
+    regressions = []
+    print(f"\nComparison with baseline {baseline.get('git_commit') or '(unknown commit)'}:")
+    for name in sorted(current.keys() & previous.keys()):
+        old, new = previous[name], current[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        flag = ""
+        if change > threshold:
+            flag = "  ⚠️  regression"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  ✅ faster"
+        print(f"  {name}: {old:,.3f} -> {new:,.3f} ({change:+.1%}){flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the ETL, analytics and API on synthetic events.")
+    parser.add_argument(
+        "--scales", default=DEFAULT_SCALES,
+        help=f"Comma-separated event counts, e.g. 1M,10M,100M (default: {DEFAULT_SCALES})"
+    )
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"], help="Generator seed")
+    parser.add_argument("--repeat", type=int, default=5, help="Warm requests per endpoint")
+    parser.add_argument("--output", default=str(DEFAULT_RESULTS), help="Results JSON path")
+    parser.add_argument("--baseline", help="Previous results JSON to compare against")
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help=f"Relative slowdown reported as a regression (default: {DEFAULT_THRESHOLD})"
+    )
+    parser.add_argument(
+        "--fail-on-regression", action="store_true",
+        help="Exit with status 1 if any metric regressed beyond --threshold"
+    )
+    parser.add_argument(
+        "--keep-data", action="store_true",
+        help="Keep generated events and warehouses for the next run"
+    )
+    parser.add_argument("--measure-endpoints", action="store_true", help=argparse.SUPPRESS)
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmark suite."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+
+    if args.measure_endpoints:
+        print(json.dumps(measure_endpoints(args.repeat)))
+        return
+
+    try:
+        scales = [parse_count(s) for s in args.scales.split(",") if s.strip()]
+        baseline = json.loads(p.Path(args.baseline).read_text()) if args.baseline else None
+        results = {
+            "created_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "scales": {},
+        }
+        for events in scales:
+            print(f"\n=== {events:,} events ===")
+            results["scales"][str(events)] = bench_scale(events, args.seed, args.repeat, args.keep_data)
+            etl = results["scales"][str(events)]["etl"]
+            print(f"  ETL: {etl['seconds']:.2f}s ({etl['events_per_sec']:,} events/s, "
+                  f"peak RSS {etl['peak_rss_mb']} MB)")
+
+        output = p.Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(output, results)
+        print(f"\n✅ Benchmark results written to {output}")
+
+        if baseline is not None:
+            regressions = compare(results, baseline, args.threshold)
+            if regressions and args.fail_on_regression:
+                print(f"❌ {len(regressions)} metric(s) regressed beyond {args.threshold:.0%}", file=sys.stderr)
+                sys.exit(1)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
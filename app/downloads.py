@@ -0,0 +1,213 @@
+"""
+Streaming artifact downloads for the API server.
+
+Clients fetch a slice of an artifact CSV (column projection, predicate
+filters and a row range) as gzip CSV, Parquet or Arrow IPC instead of
+reading multi-GB files off shared disk. Each download runs on its own
+in-memory DuckDB connection that scans the CSV, so the warehouse is never
+locked, and results are produced in record batches of BATCH_ROWS rows:
+
+- csv: batches are written and gzip-compressed incrementally
+- arrow: one Arrow IPC stream message per batch (requires pyarrow)
+- parquet: DuckDB writes the slice to a temporary file (Parquet's footer
+  needs the whole file), which is then streamed and removed
+
+Filters are typed and validated like query_api: column names come from the
+artifact's own schema and values are bound as parameters cast to the column
+type.
+"""
+import io
+import os
+import csv
+import zlib
+import tempfile
+from utils import INTERIM, connect, escape_sql_path
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow IPC downloads need pyarrow
+    pa = None
+
+# format -> (mimetype, file extension)
+FORMATS = {
+    "csv": ("text/csv", ".csv.gz"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrow"),
+}
+
+# filter operator -> SQL comparison
+FILTER_OPS = {"eq": "=", "ne": "<>", "lt": "<", "le": "<=", "gt": ">", "ge": ">=", "in": "IN"}
+
+# Rows fetched from DuckDB per streamed batch
+BATCH_ROWS = 65536
+
+# Bytes read per chunk when streaming a temporary Parquet file
+FILE_CHUNK_BYTES = 1 << 20
+
+
+def open_connection():
+    """In-memory connection that keeps file order, so row ranges are stable."""
+    con = connect()
+    con.execute("SET preserve_insertion_order = true;")
+    return con
+
+
+def artifact_columns(con, path):
+    """Return {column: DuckDB type} of an artifact CSV, in file order."""
+    rows = con.execute("DESCRIBE SELECT * FROM read_csv(?, header = true)", [str(path)]).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _parse_filter(text, columns):
+    """Parse 'column:op:value' (values of 'in' separated by '|')."""
+    parts = str(text).split(":", 2)
+    if len(parts) != 3:
+        raise ValueError(f"filter must look like column:op:value, got {text!r}")
+    column, op, value = parts
+    if column not in columns:
+        raise ValueError(f"Unknown filter column {column!r}")
+    if op not in FILTER_OPS:
+        raise ValueError(f"filter op must be one of: {', '.join(FILTER_OPS)}")
+    values = value.split("|") if op == "in" else [value]
+    return {"column": column, "op": op, "values": values}
+
+
+def normalize_params(args, columns):
+    """Validate download query-string arguments.
+
+    Args:
+        args: Mapping with getlist() (e.g. Flask request.args)
+        columns: {column: type} of the artifact (see artifact_columns)
+
+    Returns:
+        Dict with format, columns, filters, offset and limit (None = all rows)
+
+    Raises:
+        ValueError: If any argument is malformed
+    """
+    fmt = args.get("format", "csv")
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+
+    selected = []
+    for value in args.getlist("columns"):
+        selected.extend(c.strip() for c in str(value).split(",") if c.strip())
+    unknown = [c for c in selected if c not in columns]
+    if unknown:
+        raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+
+    filters = [_parse_filter(f, columns) for f in args.getlist("filter")]
+
+    try:
+        offset = int(args.get("offset", 0))
+        limit = int(args["limit"]) if args.get("limit") is not None else None
+    except ValueError:
+        raise ValueError("limit and offset must be integers")
+    if offset < 0 or (limit is not None and limit < 1):
+        raise ValueError("offset must be >= 0 and limit >= 1")
+
+    return {
+        "format": fmt,
+        "columns": list(dict.fromkeys(selected)) or list(columns),
+        "filters": filters,
+        "offset": offset,
+        "limit": limit,
+    }
+
+
+def build_query(path, params, columns):
+    """Build the projected/filtered/ranged SELECT over an artifact and its binds.
+
+    The row range applies after filtering, in file order.
+    """
+    where, binds = [], [str(path)]
+    for f in params["filters"]:
+        cast = f"CAST(? AS {columns[f['column']]})"
+        if f["op"] == "in":
+            where.append(f"{_quote(f['column'])} IN ({', '.join(cast for _ in f['values'])})")
+        else:
+            where.append(f"{_quote(f['column'])} {FILTER_OPS[f['op']]} {cast}")
+        binds.extend(f["values"])
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    limit_sql = f"LIMIT {params['limit']}" if params["limit"] is not None else ""
+    offset_sql = f"OFFSET {params['offset']}" if params["offset"] else ""
+    sql = f"""
+    SELECT {', '.join(_quote(c) for c in params['columns'])}
+    FROM read_csv(?, header = true)
+    {where_sql}
+    {limit_sql} {offset_sql}
+    """
+    return sql, binds
+
+
+def stream_csv_gz(con, sql, binds):
+    """Yield the query result as gzip-compressed CSV chunks."""
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    cursor = con.execute(sql, binds)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow([d[0] for d in cursor.description])
+    while True:
+        rows = cursor.fetchmany(BATCH_ROWS)
+        if rows:
+            writer.writerows(rows)
+        chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0)
+        buffer.truncate()
+        if chunk:
+            yield chunk
+        if not rows:
+            break
+    yield compressor.flush()
+
+
+def stream_arrow(con, sql, binds):
+    """Yield the query result as an Arrow IPC stream, one message per batch.
+
+    Raises:
+        RuntimeError: If pyarrow is not installed
+    """
+    if pa is None:
+        raise RuntimeError("Arrow downloads require pyarrow (pip install pyarrow)")
+    reader = con.execute(sql, binds).fetch_record_batch(BATCH_ROWS)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+def stream_parquet(con, sql, binds):
+    """Write the query result to a temporary Parquet file and yield its bytes."""
+    INTERIM.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".parquet", dir=INTERIM)
+    os.close(fd)
+    try:
+        con.execute(f"COPY ({sql}) TO '{escape_sql_path(tmp)}' (FORMAT PARQUET);", binds)
+        with open(tmp, "rb") as f:
+            while True:
+                chunk = f.read(FILE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.unlink(tmp)
+
+
+STREAMERS = {"csv": stream_csv_gz, "arrow": stream_arrow, "parquet": stream_parquet}
+
+
+def stream_artifact(con, path, params, columns):
+    """Yield the requested artifact slice in params["format"]; closes `con` when done."""
+    try:
+        sql, binds = build_query(path, params, columns)
+        yield from STREAMERS[params["format"]](con, sql, binds)
+    finally:
+        con.close()
@@ -3,143 +3,956 @@ ETL Pipeline for E-Commerce Revenue Funnel Analysis.
 
 This script:
 1. Loads raw e-commerce event data
-2. Creates sessions based on 30-minute inactivity gaps
+2. Creates sessions based on inactivity gaps (30 minutes unless the funnel
+   config says otherwise; with --incremental, only events appended since the
+   last run)
 3. Identifies funnel steps (view → addtocart → transaction)
-4. Generates session-level funnel flags
-5. Exports artifacts for Tableau dashboard
+4. Generates session-level funnel flags and daily rollups
+5. Persists integer-encoded tables (BIGINT user/sku/session ids, ENUM event
+   types) plus their decode tables to the DuckDB warehouse (data/interim/funnel.duckdb)
+6. Optionally exports CSV artifacts for Tableau dashboard (by default on
+   full builds only; incremental runs refresh them with --csv)
+7. Mirrors funnel_steps/funnel_session into month partitions (rewriting
+   only changed months; incremental runs only look at the months their
+   merge touched; see partitions.py)
+   Full builds replay the streamed-event log (data/interim/stream_events.csv,
+   see ingest.py) after events.csv, so streamed events are not lost.
+8. With a funnel config, computes every session gap/funnel variant in one
+   scan of the events (funnel_variants; see funnels.py)
+9. Runs the data-quality checks (artifacts/data_quality.json)
 """
+import os
 import sys
+import shutil
+import argparse
+import contextlib
 import duckdb
 import pathlib as p
-from utils import ARTIFACTS, get_events_file, validate_data_directory, PROJECT_ROOT
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rollups import ROLLUP_TABLES, build_rollups, refresh_rollups, funnel_totals
+import instrument
+import quality
+import partitions
+import funnels
+from instrument import stage
+from utils import (ARTIFACTS, INTERIM, WAREHOUSE, RUNTIME, EVENT_TYPES, STREAM_LOG, get_events_file, validate_data_directory,
+                   connect, connect_warehouse, escape_sql_path, add_runtime_args,
+                   configure_runtime, configure_runtime_from_args, funnel_metrics,
+                   write_artifact_meta, write_summary_cache, report_progress, PROJECT_ROOT)
 
 
-def main():
-    """Run the complete ETL pipeline."""
-    con = None
-    try:
-        # Validate data directory
-        print("Validating data directory...")
-        validate_data_directory()
-        
-        # Initialize DuckDB connection
-        print("Initializing DuckDB connection...")
-        con = duckdb.connect(database=":memory:")
-        
-        # Get events file path
-        events_file = get_events_file()
-        print(f"Loading events from {events_file}...")
-        
-        # Load events
-        con.execute("""
-        CREATE OR REPLACE TABLE events AS
-        SELECT CAST(user_id AS VARCHAR) AS user_id,
-               CAST(timestamp AS TIMESTAMP) AS ts,
-               event AS event_type,
-               CAST(itemid AS VARCHAR) AS sku
-        FROM read_csv_auto(?);
-        """, [events_file])
-        
-        print("Events loaded. Sessionizing...")
-        
-        # Sessionize: 30-min gap => new session
-        con.execute("""
-        CREATE OR REPLACE TABLE events_s AS
-        WITH e AS (
-          SELECT user_id, ts, event_type, sku,
-                 CASE WHEN ts - LAG(ts) OVER (PARTITION BY user_id ORDER BY ts) > INTERVAL 30 MINUTE
-                      OR LAG(ts) OVER (PARTITION BY user_id ORDER BY ts) IS NULL
-                      THEN 1 ELSE 0 END AS new_session
-          FROM events
+# ENUM type holding event_type as a 1-byte code (see EVENT_TYPES)
+EVENT_TYPE_ENUM = "event_type_enum"
+
+# session_id packs (user_id, session_seq) into one BIGINT:
+# user_id * SESSION_KEY_BASE + session_seq (so up to 2^24 sessions per user)
+SESSION_KEY_BASE = 1 << 24
+
+# Expected header of the raw events file
+EVENTS_COLUMNS = ("user_id", "timestamp", "event", "itemid")
+
+# Explicit column types for the raw events file (no type sniffing); the
+# timestamp column type depends on whether the file holds epochs or datetimes
+EVENTS_SCHEMA = {"user_id": "BIGINT", "event": "VARCHAR", "itemid": "BIGINT"}
+
+# timestamp column kind -> (CSV column type, expression converting it to TIMESTAMP)
+TIMESTAMP_FORMATS = {
+    "datetime": ("TIMESTAMP", "timestamp"),
+    "epoch_s": ("BIGINT", "to_timestamp(timestamp)::TIMESTAMP"),
+    "epoch_ms": ("BIGINT", "epoch_ms(timestamp)"),
+}
+
+# etl_manifest source of the streamed-event log (bytes_processed = committed
+# length of STREAM_LOG)
+STREAM_SOURCE = "stream"
+
+# Parse a full-build input in byte-range chunks of this size (None = one pass)
+DEFAULT_CHUNK_SIZE = os.environ.get("FUNNEL_CHUNK_SIZE")
+
+
+def timestamp_format(events_file):
+    """Classify the timestamp column from the header and first data row.
+    
+    RetailRocket exports epoch milliseconds; other sources use datetime
+    strings. Only one row is read, so no sniffing pass over the file is needed.
+    
+    Raises:
+        ValueError: If the header does not match EVENTS_COLUMNS
+    """
+    with open(events_file, 'r', newline='') as f:
+        header = tuple(c.strip() for c in f.readline().split(','))
+        first = f.readline().split(',')
+    if header != EVENTS_COLUMNS:
+        raise ValueError(
+            f"Unexpected events.csv header {','.join(header)!r}; "
+            f"expected {','.join(EVENTS_COLUMNS)!r}"
         )
-        SELECT *, SUM(new_session) OVER (PARTITION BY user_id ORDER BY ts ROWS UNBOUNDED PRECEDING) AS session_seq
-        FROM e;
-        """)
+    value = first[1].strip() if len(first) > 1 else ""
+    if value.isdigit():
+        return "epoch_ms" if len(value) > 11 else "epoch_s"
+    return "datetime"
+
+
+def events_select(events_file, ts_format=None, where=None):
+    """Build the typed SELECT over a raw events CSV and its bind parameters.
+    
+    The CSV is read with an explicit schema (auto_detect off), so integers and
+    epochs are parsed natively and DuckDB streams the file instead of sniffing it.
+    
+    Args:
+        events_file: CSV file to read (the raw file or an extracted chunk)
+        ts_format: Key of TIMESTAMP_FORMATS; detected from the file if omitted
+        where: Optional SQL condition on the raw columns (e.g. a user sample)
         
-        print("Sessions created. Creating funnel steps...")
+    Returns:
+        (sql, binds)
+    """
+    ts_type, ts_expr = TIMESTAMP_FORMATS[ts_format or timestamp_format(events_file)]
+    columns = ", ".join(
+        f"'{name}': '{ts_type if name == 'timestamp' else EVENTS_SCHEMA[name]}'"
+        for name in EVENTS_COLUMNS
+    )
+    sql = f"""
+    SELECT user_id,
+           {ts_expr} AS ts,
+           CAST(event AS {EVENT_TYPE_ENUM}) AS event_type,
+           itemid AS sku
+    FROM read_csv(?, header = true, auto_detect = false, delim = ',', quote = '"',
+                  columns = {{{columns}}})
+    {f"WHERE {where}" if where else ""}
+    """
+    return sql, [str(events_file)]
+
+
+def create_types(con):
+    """Create the event_type ENUM on `con` if it does not exist yet."""
+    labels = ", ".join(f"'{label}'" for label in EVENT_TYPES)
+    con.execute(f"CREATE TYPE IF NOT EXISTS {EVENT_TYPE_ENUM} AS ENUM ({labels});")
+
+
+def write_decode_tables(con):
+    """Create the lookup tables that map the integer encodings back to labels.
+    
+    event_types maps ENUM codes to event labels; the session_label() macro
+    and the session_keys view unpack a session_id into its user_id, per-user
+    session number and the readable '<user_id>-<session_seq>' label.
+    """
+    con.execute(f"""
+    CREATE OR REPLACE MACRO session_label(session_id) AS
+    CONCAT(session_id // {SESSION_KEY_BASE}, '-', session_id % {SESSION_KEY_BASE});
+    """)
+    con.execute(f"""
+    CREATE OR REPLACE TABLE event_types AS
+    SELECT enum_code(CAST(label AS {EVENT_TYPE_ENUM}))::UTINYINT AS code, label AS event_type
+    FROM (SELECT unnest(enum_range(NULL::{EVENT_TYPE_ENUM}))::VARCHAR AS label);
+    """)
+    con.execute(f"""
+    CREATE OR REPLACE VIEW session_keys AS
+    SELECT session_id,
+           session_id // {SESSION_KEY_BASE} AS user_id,
+           session_id % {SESSION_KEY_BASE} AS session_seq,
+           session_label(session_id) AS session_label
+    FROM funnel_session;
+    """)
+
+
+@contextlib.contextmanager
+def file_order(con):
+    """Preserve insertion order for the block, so rowids follow the input order."""
+    previous = con.execute("SELECT current_setting('preserve_insertion_order')").fetchone()[0]
+    con.execute("SET preserve_insertion_order = true;")
+    try:
+        yield
+    finally:
+        con.execute(f"SET preserve_insertion_order = {str(previous).lower()};")
+
+
+def load_events(con, table, events_file, ts_format=None, temp=False, where=None):
+    """Create (or replace) `table` from a raw events CSV using the explicit schema.
+    
+    Rows keep their file order (rowid = position in the file), which
+    count_late_events relies on. `where` optionally filters the raw rows (see
+    events_select). Returns the number of rows loaded.
+    
+    Raises:
+        duckdb.ConversionException: If an event label is not in EVENT_TYPES
+    """
+    create_types(con)
+    sql, binds = events_select(events_file, ts_format, where)
+    kind = "TEMP TABLE" if temp else "TABLE"
+    with file_order(con):
+        return con.execute(f"CREATE OR REPLACE {kind} {table} AS {sql};", binds).fetchone()[0]
+
+
+def count_late_events(con, first_row=0):
+    """Count out-of-order events: rows of `events` stored after a later event of the same user.
+    
+    events.rowid follows file (or stream) order, so the count is the same
+    whether the file was loaded in one pass, in chunks or incrementally.
+    
+    Args:
+        first_row: Count only rows from this rowid on (a just-appended
+            batch); earlier rows of the same users are still compared
+    """
+    users = f"WHERE user_id IN (SELECT user_id FROM events WHERE rowid >= {int(first_row)})" if first_row else ""
+    return con.execute(f"""
+    SELECT COUNT(*)
+    FROM (
+      SELECT rowid AS row_number, ts,
+             MAX(ts) OVER (PARTITION BY user_id ORDER BY rowid
+                           ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS earlier_max_ts
+      FROM events {users}
+    )
+    WHERE row_number >= {int(first_row)} AND ts < earlier_max_ts;
+    """).fetchone()[0]
+
+
+def parse_size(value):
+    """Parse a byte size such as 67108864, '64MB' or '1GB' (None passes through)."""
+    if value is None:
+        return None
+    text = str(value).strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    factor = units.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in units else text
+    try:
+        size = int(float(number) * factor)
+    except ValueError:
+        raise ValueError(f"Invalid size {value!r}; use bytes or a KB/MB/GB suffix")
+    if size <= 0:
+        raise ValueError(f"Size must be positive, got {value!r}")
+    return size
+
+
+def chunk_ranges(events_file, chunk_bytes):
+    """Split the data rows of `events_file` into newline-aligned byte ranges.
+    
+    Yields (start, end) offsets of roughly `chunk_bytes` each; the first range
+    starts after the header.
+    """
+    with open(events_file, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            if f.tell() < size:
+                f.readline()
+            end = f.tell()
+            yield start, end
+            start = end
+
+
+def export_csv(con, table, path):
+    """Export a warehouse table to a CSV artifact and record its row count.
+    
+    The packed session_id is written as its readable '<user_id>-<session_seq>'
+    label (see write_decode_tables); event_type ENUMs are written as labels.
+    
+    Returns the number of rows written.
+    """
+    print(f"Exporting {table} to {path}...")
+    rows = con.execute(f"""
+    COPY (SELECT * REPLACE (session_label(session_id) AS session_id) FROM {table}) 
+    TO '{escape_sql_path(path)}' (HEADER, DELIMITER ',');
+    """).fetchone()[0]
+    write_artifact_meta(path, rows=rows, source_table=table)
+    return rows
+
+
+def export_variants(con, path):
+    """Export the funnel_variants table to a CSV artifact; returns the rows written."""
+    print(f"Exporting funnel_variants to {path}...")
+    rows = con.execute(f"""
+    COPY funnel_variants TO '{escape_sql_path(path)}' (HEADER, DELIMITER ',');
+    """).fetchone()[0]
+    write_artifact_meta(path, rows=rows, source_table="funnel_variants")
+    return rows
+
+
+def steps_sql(source, seq_offsets=None, gap_minutes=None):
+    """Build the SELECT that sessionizes `source` into funnel_steps rows.
+    
+    Sessionization takes two window passes per user and no intermediate
+    table: the first (PARTITION BY user_id ORDER BY ts) yields the gap flag
+    and the row position rn; the second (ORDER BY rn, running frame) sums
+    the flags into the session number and carries the session-start
+    position forward. Window functions cannot nest, so the running sum
+    needs its own pass over the flags. step_order is the row position
+    relative to the session start, so no third (user_id, session_seq)
+    window is needed and no events_s table is materialized.
+    
+    Args:
+        source: Table with (user_id, ts, event_type, sku) columns
+        seq_offsets: Optional table of (user_id, base_seq); session numbering
+            for those users continues after base_seq instead of starting at 1
+        gap_minutes: Session gap (default: the active funnel config)
+    """
+    offset_join = ""
+    offset_expr = ""
+    if seq_offsets:
+        offset_join = f"LEFT JOIN {seq_offsets} o USING (user_id)"
+        offset_expr = "COALESCE(o.base_seq, 0) + "
+    return f"""
+    WITH e AS (
+      SELECT user_id, ts, event_type, sku,
+             ROW_NUMBER() OVER w AS rn,
+             COALESCE(ts - LAG(ts) OVER w > {funnels.session_gap_sql(gap_minutes)}, TRUE) AS new_session
+      FROM {source}
+      WINDOW w AS (PARTITION BY user_id ORDER BY ts)
+    ),
+    s AS (
+      SELECT user_id, ts, event_type, sku, rn,
+             SUM(new_session::INTEGER) OVER w AS session_seq,
+             MAX(CASE WHEN new_session THEN rn END) OVER w AS session_start
+      FROM e
+      WINDOW w AS (PARTITION BY user_id ORDER BY rn ROWS UNBOUNDED PRECEDING)
+    )
+    SELECT user_id,
+           CAST(user_id * {SESSION_KEY_BASE} + {offset_expr}session_seq AS BIGINT) AS session_id,
+           ts, event_type, sku,
+           rn - session_start + 1 AS step_order
+    FROM s {offset_join}
+    """
+
+
+def session_flags_sql(steps_source):
+    """Build the SELECT that aggregates funnel steps into session-level flags."""
+    return f"""
+    SELECT session_id,
+           MAX(CASE WHEN event_type='view' THEN 1 ELSE 0 END)::UTINYINT AS has_view,
+           MAX(CASE WHEN event_type='addtocart' THEN 1 ELSE 0 END)::UTINYINT AS has_cart,
+           MAX(CASE WHEN event_type='transaction' THEN 1 ELSE 0 END)::UTINYINT AS has_purchase
+    FROM {steps_source}
+    GROUP BY 1
+    """
+
+
+def record_manifest(con, events_file, bytes_processed, late_events=0, full=False, gap_minutes=None):
+    """Store the high-water mark (file offset and max ts) of processed events.
+    
+    The session gap the tables were built with is stored alongside, so an
+    incremental run under a different gap rebuilds instead of merging.
+    
+    Args:
+        late_events: Out-of-order events among the rows just loaded (see
+            count_late_events)
+        full: The tables were just rebuilt, so late_events replaces the
+            stored total instead of being added to it
+        gap_minutes: Session gap the rows were merged with (default: the
+            active funnel config)
+    """
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS etl_manifest (
+        source VARCHAR PRIMARY KEY,
+        bytes_processed BIGINT,
+        max_ts TIMESTAMP,
+        updated_at TIMESTAMP,
+        late_events BIGINT
+    );
+    """)
+    con.execute("ALTER TABLE etl_manifest ADD COLUMN IF NOT EXISTS late_events BIGINT;")
+    con.execute("ALTER TABLE etl_manifest ADD COLUMN IF NOT EXISTS session_gap_minutes INTEGER;")
+    total = late_events if full else late_events + stored_late_events(con, events_file)
+    con.execute("""
+    INSERT OR REPLACE INTO etl_manifest
+        (source, bytes_processed, max_ts, updated_at, late_events, session_gap_minutes)
+    SELECT ?, ?, (SELECT MAX(ts) FROM events), now()::TIMESTAMP, ?, ?;
+    """, [events_file, bytes_processed, total, gap_minutes or funnels.session_gap_minutes()])
+
+
+def stored_late_events(con, events_file):
+    """Return the out-of-order events of the stored rows (0 if unknown)."""
+    try:
+        row = con.execute("SELECT late_events FROM etl_manifest WHERE source = ?", [events_file]).fetchone()
+    except duckdb.CatalogException:
+        return 0
+    return (row[0] or 0) if row else 0
+
+
+def stream_log_offset(con):
+    """Return the committed length of STREAM_LOG (0 if there is no log).
+    
+    This is the stream source's bytes_processed; bytes after it are the tail
+    of a flush whose merge failed, which the flusher still holds and
+    re-appends. Without a record (e.g. a new warehouse file) the whole log
+    counts as committed.
+    """
+    size = STREAM_LOG.stat().st_size if STREAM_LOG.exists() else 0
+    try:
+        row = con.execute("SELECT bytes_processed FROM etl_manifest WHERE source = ?", [STREAM_SOURCE]).fetchone()
+    except duckdb.CatalogException:
+        row = None
+    if row is None or row[0] is None:
+        return size
+    return min(row[0], size)
+
+
+def replay_stream_log(con, merge=False):
+    """Re-apply the streamed events of STREAM_LOG after a full build replaced the tables.
+    
+    An uncommitted tail of the log is cut off first (see stream_log_offset).
+    The stream source's manifest row is reset to the replayed log.
+    
+    Args:
+        merge: Merge the log like an incremental batch (chunked builds, whose
+            tables exist already); otherwise append it to `events` before
+            sessionization
+    
+    Returns the number of streamed events replayed.
+    """
+    offset = stream_log_offset(con)
+    if not offset:
+        try:
+            con.execute("DELETE FROM etl_manifest WHERE source = ?", [STREAM_SOURCE])
+        except duckdb.CatalogException:
+            pass
+        return 0
+    if STREAM_LOG.stat().st_size > offset:
+        os.truncate(STREAM_LOG, offset)
+    table = "events_new" if merge else "stream_events"
+    rows = load_events(con, table, STREAM_LOG, temp=True)
+    if not rows:
+        con.execute(f"DROP TABLE {table};")
+        return 0
+    print(f"Replaying {rows:,} streamed events from {STREAM_LOG}...")
+    if merge:
+        con.execute("UPDATE etl_manifest SET late_events = 0 WHERE source = ?", [STREAM_SOURCE])
+        return merge_new_events(con, STREAM_SOURCE, offset, verbose=False)
+    first_row = con.execute("SELECT COALESCE(MAX(rowid) + 1, 0) FROM events").fetchone()[0]
+    with file_order(con):
+        con.execute(f"INSERT INTO events SELECT * FROM {table};")
+    con.execute(f"DROP TABLE {table};")
+    record_manifest(con, STREAM_SOURCE, offset, late_events=count_late_events(con, first_row), full=True)
+    return rows
+
+
+def read_manifest(con, events_file):
+    """Return (bytes_processed, max_ts) for the events file, or None if unknown.
+    
+    Warehouses written before the integer encoding (string session_id) or
+    with a different session gap than the active funnel config also return
+    None, so the next run rebuilds them in full.
+    """
+    tables = {row[0] for row in con.execute("SHOW TABLES").fetchall()}
+    if not {"etl_manifest", "events", "funnel_steps", "funnel_session", *ROLLUP_TABLES} <= tables:
+        return None
+    session_type = con.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'funnel_steps' AND column_name = 'session_id'
+    """).fetchone()
+    if session_type is None or session_type[0] != "BIGINT":
+        return None
+    cursor = con.execute("SELECT * FROM etl_manifest WHERE source = ?", [events_file])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    entry = dict(zip((d[0] for d in cursor.description), row))
+    # Manifests from before the gap was configurable were built with 30 minutes
+    if (entry.get("session_gap_minutes") or 30) != funnels.session_gap_minutes():
+        print(f"Session gap changed to {funnels.session_gap_minutes()} minutes.")
+        return None
+    return entry["bytes_processed"], entry["max_ts"]
+
+
+def extract_delta(events_file, offset, delta_path, end=None):
+    """Copy the header plus the bytes from `offset` to `end` to `delta_path`.
+    
+    Args:
+        end: Stop offset; everything appended after `offset` if omitted
         
-        # Ordered steps per session
-        con.execute("""
+    Returns the new offset (file size at the time of reading, or `end`).
+    """
+    with open(events_file, 'rb') as src, open(delta_path, 'wb') as dst:
+        dst.write(src.readline())
+        src.seek(offset)
+        if end is None:
+            shutil.copyfileobj(src, dst)
+            return src.tell()
+        remaining = end - offset
+        while remaining > 0:
+            block = src.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            dst.write(block)
+            remaining -= len(block)
+        return src.tell()
+
+
+def sessionize_shard(shard_dir, out_dir, runtime, funnel_config):
+    """Sessionize one user-hash shard in its own process.
+    
+    Every window is PARTITION BY user_id and shards never split a user, so each
+    shard is sessionized independently and written as Parquet parts.
+    
+    Returns (shard name, steps rows, sessions rows).
+    """
+    configure_runtime(**runtime)
+    funnels.configure(funnel_config)
+    name = p.Path(shard_dir).name
+    source = f"read_parquet('{escape_sql_path(shard_dir)}/*.parquet')"
+    con = connect()
+    try:
+        con.execute(f"CREATE TABLE funnel_steps AS {steps_sql(source)};")
+        con.execute(f"CREATE TABLE funnel_session AS {session_flags_sql('funnel_steps')};")
+        for table, subdir in (("funnel_steps", "steps"), ("funnel_session", "session")):
+            con.execute(f"""
+            COPY {table} TO '{escape_sql_path(out_dir / subdir / name)}.parquet' (FORMAT PARQUET);
+            """)
+        steps = con.execute("SELECT COUNT(*) FROM funnel_steps").fetchone()[0]
+        sessions = con.execute("SELECT COUNT(*) FROM funnel_session").fetchone()[0]
+        return name, steps, sessions
+    finally:
+        con.close()
+
+
+def sharded_build(con, shards, workers):
+    """Sessionize `events` as N user-hash shards in a process pool and merge the parts.
+    
+    Shard inputs and outputs are Parquet files under data/interim/shards; the
+    merged funnel_steps and funnel_session replace the warehouse tables.
+    """
+    shard_root = INTERIM / "shards"
+    shutil.rmtree(shard_root, ignore_errors=True)
+    (shard_root / "out" / "steps").mkdir(parents=True)
+    (shard_root / "out" / "session").mkdir(parents=True)
+    
+    print(f"Hash-partitioning events by user_id into {shards} shards...")
+    with stage("partition", progress=0.15, shards=shards) as st:
+        st["rows_out"] = con.execute(f"""
+        COPY (SELECT *, hash(user_id) % {shards} AS shard FROM events)
+        TO '{escape_sql_path(shard_root / 'in')}' (FORMAT PARQUET, PARTITION_BY (shard));
+        """).fetchone()[0]
+    shard_dirs = sorted((shard_root / "in").glob("shard=*"))
+    
+    # Split the thread budget across worker processes unless set explicitly
+    runtime = dict(RUNTIME)
+    if runtime["threads"] is None:
+        runtime["threads"] = max(1, (os.cpu_count() or 1) // workers)
+    
+    print(f"Sessionizing {len(shard_dirs)} shards with {workers} worker processes...")
+    with stage("sessionize", workers=workers) as st, ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(sessionize_shard, str(d), shard_root / "out", runtime, dict(funnels.CONFIG)) for d in shard_dirs]
+        st["shards"] = {}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name, steps, sessions = future.result()
+            st["shards"][name] = {"steps": steps, "sessions": sessions}
+            print(f"  {name}: {steps:,} steps, {sessions:,} sessions")
+            report_progress("sessionize", 0.2 + 0.5 * done / len(futures), shard=name,
+                            shards_done=done, shards=len(futures))
+    
+    print("Merging shard outputs...")
+    with stage("merge", progress=0.65) as st:
+        st["rows_out"] = con.execute(f"""
         CREATE OR REPLACE TABLE funnel_steps AS
-        SELECT user_id,
-               CONCAT(user_id,'-',session_seq) AS session_id,
-               ts, event_type, sku,
-               ROW_NUMBER() OVER (PARTITION BY user_id, session_seq ORDER BY ts) AS step_order
-        FROM events_s;
-        """)
-        
-        print("Funnel steps created. Generating session flags...")
-        
-        # Session-level flags
-        con.execute("""
-        CREATE OR REPLACE TABLE funnel_session AS
-        SELECT session_id,
-               MAX(CASE WHEN event_type='view' THEN 1 ELSE 0 END) AS has_view,
-               MAX(CASE WHEN event_type='addtocart' THEN 1 ELSE 0 END) AS has_cart,
-               MAX(CASE WHEN event_type='transaction' THEN 1 ELSE 0 END) AS has_purchase
-        FROM funnel_steps
-        GROUP BY 1;
-        """)
-        
-        # Export artifacts (escape single quotes in path for SQL)
-        funnel_session_path = ARTIFACTS / "funnel_session.csv"
-        print(f"Exporting funnel_session to {funnel_session_path}...")
-        funnel_session_path_escaped = str(funnel_session_path).replace("'", "''")
+        SELECT * REPLACE (CAST(event_type AS {EVENT_TYPE_ENUM}) AS event_type)
+        FROM read_parquet('{escape_sql_path(shard_root / 'out' / 'steps')}/*.parquet');
+        """).fetchone()[0]
         con.execute(f"""
-        COPY (SELECT * FROM funnel_session) 
-        TO '{funnel_session_path_escaped}' (HEADER, DELIMITER ',');
-        """)
-        
-        # Export funnel_steps for SQL queries
-        funnel_steps_path = ARTIFACTS / "funnel_steps.csv"
-        print(f"Exporting funnel_steps to {funnel_steps_path}...")
-        funnel_steps_path_escaped = str(funnel_steps_path).replace("'", "''")
-        con.execute(f"""
-        COPY (SELECT * FROM funnel_steps) 
-        TO '{funnel_steps_path_escaped}' (HEADER, DELIMITER ',');
+        CREATE OR REPLACE TABLE funnel_session AS
+        SELECT * FROM read_parquet('{escape_sql_path(shard_root / 'out' / 'session')}/*.parquet');
         """)
+    shutil.rmtree(shard_root, ignore_errors=True)
+
+
+def full_build(con, events_file, shards=1, workers=None, chunk_size=None):
+    """Rebuild events, funnel_steps and funnel_session from the whole file.
+    
+    Streamed events (STREAM_LOG) are replayed after the file's events. With
+    `chunk_size`, the file is ingested in byte-range chunks instead (see
+    chunked_build) so peak memory follows the chunk size, not the file size.
+    """
+    size = os.path.getsize(events_file)
+    ts_format = timestamp_format(events_file)
+    if chunk_size and size > chunk_size:
+        if shards > 1:
+            print("  ⚠️  Warning: --shards is ignored for chunked ingestion")
+        chunked_build(con, events_file, chunk_size, ts_format)
+        return
+    
+    print(f"Loading events from {events_file}...")
+    with stage("load", progress=0.05, bytes_in=size, timestamp_format=ts_format) as st:
+        loaded = st["rows_out"] = load_events(con, "events", events_file, ts_format)
+    with stage("late_events") as st:
+        late_events = st["rows_out"] = count_late_events(con)
+    with stage("stream_replay") as st:
+        loaded += replay_stream_log(con)
+    
+    if shards > 1:
+        sharded_build(con, shards, workers or min(shards, os.cpu_count() or 1))
+    else:
+        print("Events loaded. Sessionizing and creating funnel steps...")
+        with stage("sessionize", progress=0.2, rows_in=loaded) as st:
+            st["rows_out"] = con.execute(
+                f"CREATE OR REPLACE TABLE funnel_steps AS {steps_sql('events')};"
+            ).fetchone()[0]
         
-        # Data validation checks
-        print("\nRunning data validation checks...")
-        
-        # Check row counts
-        session_count = con.execute("SELECT COUNT(*) FROM funnel_session").fetchone()[0]
-        steps_count = con.execute("SELECT COUNT(*) FROM funnel_steps").fetchone()[0]
-        events_count = con.execute("SELECT COUNT(*) FROM events").fetchone()[0]
-        
-        print(f"  Events loaded: {events_count:,}")
-        print(f"  Funnel steps: {steps_count:,}")
-        print(f"  Sessions created: {session_count:,}")
-        
-        # Check for null timestamps
-        null_ts = con.execute("SELECT COUNT(*) FROM events WHERE ts IS NULL").fetchone()[0]
-        if null_ts > 0:
-            print(f"  ⚠️  Warning: {null_ts} events with NULL timestamps")
-        
-        # Check conversion rates
-        conversions = con.execute("""
-            SELECT 
-                SUM(has_view) as views,
-                SUM(has_cart) as carts,
-                SUM(has_purchase) as purchases
-            FROM funnel_session
-        """).fetchone()
-        
-        views, carts, purchases = conversions[0], conversions[1], conversions[2]
-        
-        if views > 0:
-            view_to_cart = (carts / views) * 100
-            print(f"  View-to-cart rate: {view_to_cart:.2f}% ({carts:,}/{views:,})")
+        print("Funnel steps created. Generating session flags...")
+        with stage("flags", progress=0.6, rows_in=st["rows_out"]) as st:
+            st["rows_out"] = con.execute(
+                f"CREATE OR REPLACE TABLE funnel_session AS {session_flags_sql('funnel_steps')};"
+            ).fetchone()[0]
+    
+    print("Building daily rollups...")
+    with stage("rollups", progress=0.7):
+        build_rollups(con)
+    record_manifest(con, events_file, size, late_events=late_events, full=True)
+
+
+def chunked_build(con, events_file, chunk_size, ts_format=None):
+    """Full build that streams the file through sessionization chunk by chunk.
+    
+    The first chunk creates the tables; every later chunk, and finally the
+    streamed-event log, is merged the same way as an incremental run
+    (boundary sessions re-opened and upserted). The high-water mark is
+    recorded after each chunk, so an interrupted build can be finished with
+    --incremental (streamed events then return with the next full build).
+    """
+    ranges = list(chunk_ranges(events_file, chunk_size))
+    print(f"Streaming {events_file} in {len(ranges)} chunks of ~{chunk_size:,} bytes...")
+    delta_path = INTERIM / "events_chunk.csv"
+    try:
+        for index, (start, end) in enumerate(ranges, start=1):
+            with stage("chunk", index=index, bytes_in=end - start) as st:
+                extract_delta(events_file, start, delta_path, end=end)
+                if index == 1:
+                    st["rows_in"] = load_events(con, "events", delta_path, ts_format)
+                    con.execute(f"CREATE OR REPLACE TABLE funnel_steps AS {steps_sql('events')};")
+                    con.execute(f"CREATE OR REPLACE TABLE funnel_session AS {session_flags_sql('funnel_steps')};")
+                    build_rollups(con)
+                    record_manifest(con, events_file, end, late_events=count_late_events(con), full=True)
+                else:
+                    load_events(con, "events_new", delta_path, ts_format, temp=True)
+                    st["rows_in"] = merge_new_events(con, events_file, end, verbose=False)
+            print(f"  chunk {index}/{len(ranges)}: bytes {start:,}-{end:,}")
+            report_progress("sessionize", 0.15 + 0.55 * index / len(ranges),
+                            chunks_done=index, chunks=len(ranges))
+        with stage("stream_replay") as st:
+            st["rows_in"] = replay_stream_log(con, merge=True)
+    finally:
+        delta_path.unlink(missing_ok=True)
+
+
+def incremental_build(con, events_file, offset):
+    """Sessionize only events appended since `offset` and upsert the results.
+    
+    Sessions of affected users that ended within the inactivity gap of their
+    earliest new event are re-opened: their steps are re-sessionized together
+    with the new events and replaced in funnel_steps/funnel_session.
+    
+    Returns the number of new events processed.
+    """
+    if os.path.getsize(events_file) == offset:
+        print("No new events since last run.")
+        return 0
+    
+    delta_path = INTERIM / "events_delta.csv"
+    with stage("load", progress=0.05, offset=offset) as st:
+        new_offset = extract_delta(events_file, offset, delta_path)
+        st["bytes_in"] = new_offset - offset
+        try:
+            st["rows_out"] = load_events(con, "events_new", delta_path, timestamp_format(events_file), temp=True)
+        finally:
+            delta_path.unlink(missing_ok=True)
+    
+    return merge_new_events(con, events_file, new_offset)
+
+
+def merge_new_events(con, events_file, new_offset, verbose=True, gap_minutes=None):
+    """Sessionize the `events_new` temp table into the warehouse tables.
+    
+    Args:
+        events_file: Source recorded in the manifest
+        new_offset: High-water mark to record once the batch is committed
+        verbose: Print and report per-stage progress (off when the caller
+            reports per-chunk progress itself)
+        gap_minutes: Session gap (default: the active funnel config)
+    
+    Returns the number of new events processed.
+    """
+    new_count = con.execute("SELECT COUNT(*) FROM events_new").fetchone()[0]
+    if verbose:
+        print(f"Found {new_count:,} new events since last run.")
+        print("Re-opening boundary sessions...")
+    with stage("reopen", progress=0.3 if verbose else None, rows_in=new_count) as st:
+        _reopen_sessions(con, gap_minutes)
+        st["rows_out"] = con.execute("SELECT COUNT(*) FROM events_rebuild").fetchone()[0]
+    
+    if verbose:
+        print("Sessionizing new events...")
+    with stage("sessionize", progress=0.45 if verbose else None, rows_in=st["rows_out"]) as st:
+        st["rows_out"] = con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE steps_new AS
+        {steps_sql('events_rebuild', seq_offsets='seq_offsets', gap_minutes=gap_minutes)};
+        """).fetchone()[0]
+    
+    if verbose:
+        print("Upserting funnel steps, session flags and rollups...")
+    with stage("upsert", progress=0.6 if verbose else None, rows_in=st["rows_out"]) as st:
+        con.execute("BEGIN TRANSACTION;")
+        try:
+            con.execute("DELETE FROM funnel_steps WHERE session_id IN (SELECT session_id FROM reopened WHERE is_open);")
+            con.execute("DELETE FROM funnel_session WHERE session_id IN (SELECT session_id FROM reopened WHERE is_open);")
+            con.execute("INSERT INTO funnel_steps SELECT * FROM steps_new;")
+            con.execute(f"INSERT INTO funnel_session {session_flags_sql('steps_new')};")
+            first_row = con.execute("SELECT COALESCE(MAX(rowid) + 1, 0) FROM events").fetchone()[0]
+            with file_order(con):
+                con.execute("INSERT INTO events SELECT * FROM events_new;")
+            st["late_events"] = count_late_events(con, first_row)
+            refresh_rollups(con, "events_rebuild")
+            partitions.mark_dirty(con, "events_rebuild")
+            record_manifest(con, events_file, new_offset, late_events=st["late_events"], gap_minutes=gap_minutes)
+            con.execute("COMMIT;")
+        except duckdb.Error:
+            con.execute("ROLLBACK;")
+            raise
+    
+    for table in ("events_new", "reopened", "seq_offsets", "events_rebuild", "steps_new"):
+        con.execute(f"DROP TABLE IF EXISTS {table};")
+    return new_count
+
+
+def _reopen_sessions(con, gap_minutes=None):
+    """Collect the boundary sessions to re-sessionize with `events_new` into events_rebuild."""
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE reopened AS
+    WITH first_new AS (
+      SELECT user_id, MIN(ts) AS first_ts FROM events_new GROUP BY 1
+    ),
+    sessions AS (
+      SELECT s.user_id, s.session_id,
+             s.session_id % {SESSION_KEY_BASE} AS session_seq,
+             MAX(s.ts) AS session_end
+      FROM funnel_steps s SEMI JOIN first_new USING (user_id)
+      GROUP BY 1, 2
+    )
+    SELECT s.user_id, s.session_id, s.session_seq, s.session_end,
+           s.session_end >= f.first_ts - {funnels.session_gap_sql(gap_minutes)} AS is_open
+    FROM sessions s JOIN first_new f USING (user_id);
+    """)
+    con.execute("""
+    CREATE OR REPLACE TEMP TABLE seq_offsets AS
+    SELECT user_id, COALESCE(MAX(session_seq) FILTER (WHERE NOT is_open), 0) AS base_seq
+    FROM reopened GROUP BY 1;
+    """)
+    con.execute("""
+    CREATE OR REPLACE TEMP TABLE events_rebuild AS
+    SELECT user_id, ts, event_type, sku
+    FROM funnel_steps
+    WHERE session_id IN (SELECT session_id FROM reopened WHERE is_open)
+    UNION ALL
+    SELECT user_id, ts, event_type, sku FROM events_new;
+    """)
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Run the funnel ETL pipeline.")
+    csv_group = parser.add_mutually_exclusive_group()
+    csv_group.add_argument(
+        "--no-csv", action="store_true",
+        help="Skip the CSV export step (tables are still written to the warehouse)"
+    )
+    csv_group.add_argument(
+        "--csv", action="store_true",
+        help="Re-export the full CSV artifacts after an incremental run (skipped by default)"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Process only events appended to events.csv since the last run"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="Hash-partition users into N shards sessionized in parallel processes"
+    )
+    parser.add_argument(
+        "--workers", type=int,
+        help="Worker processes for --shards (default: min(shards, CPU count))"
+    )
+    parser.add_argument(
+        "--chunk-size", default=DEFAULT_CHUNK_SIZE,
+        help="Ingest a full build in byte-range chunks of this size, e.g. 256MB "
+             "(env: FUNNEL_CHUNK_SIZE; default: one pass)"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", default=None,
+        help="Store full DuckDB query plans in the run record (env: FUNNEL_PROFILE=1)"
+    )
+    parser.add_argument(
+        "--funnel-config",
+        help="JSON session/funnel config: gap, gap variants and funnel stages "
+             f"(env: {funnels.CONFIG_ENV}; see funnels.py)"
+    )
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def run_pipeline(incremental=False, shards=1, workers=None, export=None, con=None,
+                 chunk_size=None, profile=None, funnel_config=None):
+    """Run the ETL and return the summary metrics.
+    
+    Every run is recorded by the instrument module (per-stage timings, row
+    counts, memory and DuckDB query profiles) under data/interim/runs/.
+    
+    Args:
+        incremental: Process only events appended since the last run
+        shards: Sessionize a full build as N user-hash shards in parallel
+        workers: Worker processes for sharded builds
+        export: Export funnel_session/funnel_steps CSV artifacts (default:
+            after full builds only; exporting rewrites the whole tables, so
+            incremental runs skip it unless export=True)
+        con: Open warehouse connection/cursor to use (e.g. from the server
+            pool); a new connection is opened and closed if omitted
+        chunk_size: Ingest a full build in byte-range chunks of this many
+            bytes (int or size string such as '256MB')
+        profile: Store full DuckDB operator trees in the run record
+            (default: FUNNEL_PROFILE env)
+        funnel_config: Path of a JSON session/funnel config (default:
+            FUNNEL_CONFIG env, else a 30-minute gap and no variants)
         
-        if carts > 0:
-            cart_to_purchase = (purchases / carts) * 100
-            print(f"  Cart-to-purchase rate: {cart_to_purchase:.2f}% ({purchases:,}/{carts:,})")
+    Returns:
+        Metrics dict (counts, funnel totals and conversion rates)
         
-        # Print summary
-        print(f"\n✅ Pipeline complete!")
-        print(f"Artifacts exported to: {ARTIFACTS}")
+    Raises:
+        FileNotFoundError: If the raw events file is missing
+        ValueError: If the events file header, chunk size or funnel config is invalid
+        duckdb.Error: If a pipeline query fails
+    """
+    owns_con = con is None
+    chunk_size = parse_size(chunk_size)
+    params = {"incremental": incremental, "shards": shards, "workers": workers,
+              "export": export, "chunk_size": chunk_size, "funnel_config": funnel_config}
+    with instrument.run("pipeline", params, full_profile=profile) as recorder:
+        try:
+            # Validate data directory
+            print("Validating data directory...")
+            with stage("validate_input", progress=0.0):
+                validate_data_directory()
+                funnels.configure(funnels.load_config(funnel_config))
+            recorder.record["params"]["session_gap_minutes"] = funnels.session_gap_minutes()
+            
+            # Open the persistent warehouse
+            if owns_con:
+                print(f"Opening DuckDB warehouse {WAREHOUSE}...")
+                con = connect_warehouse()
+            con = recorder.wrap(con)
+            
+            # Get events file path
+            events_file = get_events_file()
+            
+            # Incremental runs resume from the stored high-water mark
+            manifest = read_manifest(con, events_file) if incremental else None
+            size = os.path.getsize(events_file)
+            full = manifest is None or size < manifest[0]
+            if full:
+                if incremental:
+                    print("No usable high-water mark (first run, file rewritten or old encoding); running full build.")
+                recorder.record["params"]["mode"] = "full"
+                full_build(con, events_file, shards=shards, workers=workers, chunk_size=chunk_size)
+            else:
+                print(f"Resuming after byte {manifest[0]:,} (max ts {manifest[1]})...")
+                recorder.record["params"]["mode"] = "incremental"
+                incremental_build(con, events_file, manifest[0])
+            write_decode_tables(con)
+            
+            # Optional CSV export for Tableau
+            if export is None:
+                export = full
+                if not full:
+                    print("⏭️  Skipping CSV export (incremental run); use --csv to refresh "
+                          "funnel_session.csv and funnel_steps.csv")
+            if export:
+                with stage("export", progress=0.75):
+                    for table in ("funnel_session", "funnel_steps"):
+                        with stage(f"export.{table}") as st:
+                            st["rows_out"] = export_csv(con, table, ARTIFACTS / f"{table}.csv")
+            
+            # Mirror changed months into the partitioned Parquet store
+            with stage("partitions", progress=0.85) as st:
+                st["rewritten"] = partitions.write_partitions(con, full=full)
+            
+            # Gap/funnel sensitivity variants: one scan of events for all of them
+            if funnels.has_variants():
+                print("Computing session gap and funnel variants...")
+                with stage("variants", progress=0.88) as st:
+                    st["rows_out"] = con.execute(
+                        f"CREATE OR REPLACE TABLE funnel_variants AS {funnels.variants_sql('events')};"
+                    ).fetchone()[0]
+                    if export:
+                        export_variants(con, ARTIFACTS / "funnel_variants.csv")
+            
+            # Data-quality checks: one fused pass plus by-products of earlier stages
+            print("\nRunning data validation checks...")
+            with stage("validate", progress=0.9) as st:
+                session_count, steps_count, views, carts, purchases = funnel_totals(con)
+                report = quality.run_checks(con, late_events=stored_late_events(con, events_file))
+                quality.write_report(report)
+                st["rows_in"] = report["counts"]["steps"]
+                st["status"] = report["status"]
+            events_count = report["counts"]["events"]
+            recorder.record["quality"] = {name: c["count"] for name, c in report["checks"].items()}
+            
+            print(f"  Events loaded: {events_count:,}")
+            print(f"  Funnel steps: {steps_count:,}")
+            print(f"  Sessions created: {session_count:,}")
+            for name, check in report["checks"].items():
+                if check["status"] != "pass":
+                    icon = "❌" if check["status"] == "fail" else "⚠️ "
+                    print(f"  {icon} {name.replace('_', ' ').capitalize()}: {check['count']:,}")
+            print(f"  Data-quality report: {quality.QUALITY_REPORT} ({report['status']})")
+            
+            # Check conversion rates
+            if views > 0:
+                view_to_cart = (carts / views) * 100
+                print(f"  View-to-cart rate: {view_to_cart:.2f}% ({carts:,}/{views:,})")
+            
+            if carts > 0:
+                cart_to_purchase = (purchases / carts) * 100
+                print(f"  Cart-to-purchase rate: {cart_to_purchase:.2f}% ({purchases:,}/{carts:,})")
+            
+            metrics = funnel_metrics(session_count, steps_count, views, carts, purchases,
+                                     events_count=events_count)
+            recorder.record["metrics"] = metrics
+            
+            # Checkpoint before caching so the cache keys on the final warehouse file
+            with stage("checkpoint"):
+                try:
+                    con.execute("CHECKPOINT;")
+                except duckdb.Error as e:
+                    print(f"  ⚠️  Warning: checkpoint skipped ({e})")
+            write_summary_cache(metrics)
+            report_progress("done", 1.0, metrics=metrics, run_id=recorder.run_id)
+            
+            # Print summary
+            print(f"\n✅ Pipeline complete!")
+            print(f"Warehouse: {WAREHOUSE}")
+            if export:
+                print(f"Artifacts exported to: {ARTIFACTS}")
+            print(f"Run metrics: {instrument.run_path(recorder.run_id)}")
+            return metrics
         
-    except FileNotFoundError as e:
+        finally:
+            if isinstance(con, instrument.ProfiledConnection):
+                con = con.unwrap()
+            if owns_con and con is not None:
+                con.close()
+
+
+def main(argv=None):
+    """Run the complete ETL pipeline."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+    try:
+        run_pipeline(
+            incremental=args.incremental,
+            shards=args.shards,
+            workers=args.workers,
+            export=True if args.csv else False if args.no_csv else None,
+            chunk_size=args.chunk_size,
+            profile=args.profile,
+            funnel_config=args.funnel_config
+        )
+    except (FileNotFoundError, ValueError) as e:
         print(f"❌ Error: {e}", file=sys.stderr)
         sys.exit(1)
     except duckdb.Error as e:
@@ -148,9 +961,6 @@ def main():
     except Exception as e:
         print(f"❌ Unexpected error: {e}", file=sys.stderr)
         sys.exit(1)
-    finally:
-        if con is not None:
-            con.close()
 
 
 if __name__ == "__main__":
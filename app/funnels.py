@@ -0,0 +1,245 @@
+"""
+Declarative session and funnel definitions.
+
+The ETL's session gap and the funnels used for sensitivity analysis come
+from a JSON config instead of being hard-coded in SQL:
+
+    {
+      "session_gap_minutes": 30,
+      "gap_variants_minutes": [15, 60],
+      "funnels": {
+        "default": {"stages": ["view", "addtocart", "transaction"]},
+        "strict": {"stages": ["view", "addtocart", "transaction"], "strict_order": true},
+        "browse_to_buy": {"stages": ["view", {"name": "buy", "events": ["addtocart", "transaction"]}]}
+      }
+    }
+
+session_gap_minutes drives the warehouse sessionization (funnel_steps and
+funnel_session). Each stage is an event type or a named set of event types
+(from EVENT_TYPES). A session reaches a stage if it has one of the stage's
+events; with strict_order it must also have reached every earlier stage
+before, in event order.
+
+variants_sql() evaluates every gap (the session gap plus the variants)
+against every funnel in one ordered scan of the events: the time since the
+user's previous event is computed once, each gap turns it into its own
+running session number within the same window, and each session's event
+codes are collected once and matched against all funnels.
+
+The config is read from --funnel-config or FUNNEL_CONFIG; without one the
+defaults below apply and no variants are computed.
+"""
+import os
+import re
+import json
+import pathlib as p
+from utils import EVENT_TYPES
+
+# Path of the JSON funnel config (optional)
+CONFIG_ENV = "FUNNEL_CONFIG"
+
+DEFAULT_CONFIG = {
+    "session_gap_minutes": 30,
+    "gap_variants_minutes": [],
+    "funnels": {"default": {"stages": list(EVENT_TYPES), "strict_order": False}},
+}
+
+# Funnel and stage names end up in SQL literals and CSV rows
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# Config the ETL is currently running with (see configure())
+CONFIG = {**DEFAULT_CONFIG, "source": None}
+
+
+def _gap(value, name):
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise ValueError(f"{name} must be a positive whole number of minutes, got {value!r}")
+    return value
+
+
+def _name(value, what):
+    if not isinstance(value, str) or not NAME_PATTERN.match(value):
+        raise ValueError(f"{what} name must match {NAME_PATTERN.pattern}, got {value!r}")
+    return value
+
+
+def _stage(value, funnel):
+    """Normalize a stage given as an event type or {"name", "events"}."""
+    if isinstance(value, str):
+        value = {"name": value, "events": [value]}
+    if not isinstance(value, dict) or not value.get("events"):
+        raise ValueError(f"Funnel {funnel!r}: each stage must be an event type or "
+                         f"{{\"name\": ..., \"events\": [...]}}")
+    events = list(dict.fromkeys(value["events"]))
+    unknown = [e for e in events if e not in EVENT_TYPES]
+    if unknown:
+        raise ValueError(f"Funnel {funnel!r}: unknown event type(s) {', '.join(map(str, unknown))}; "
+                         f"expected {', '.join(EVENT_TYPES)}")
+    return {"name": _name(value.get("name", "+".join(events)), "Stage"), "events": events}
+
+
+def normalize_config(raw, source=None):
+    """Validate a raw config dict and fill in defaults.
+
+    Returns:
+        Dict with session_gap_minutes, gap_variants_minutes (sorted, without
+        the session gap), funnels ({name: {"stages", "strict_order"}}) and source
+
+    Raises:
+        ValueError: If any field is malformed
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("Funnel config must be a JSON object")
+    unknown = set(raw) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown funnel config key(s): {', '.join(sorted(unknown))}")
+
+    gap = _gap(raw.get("session_gap_minutes", DEFAULT_CONFIG["session_gap_minutes"]), "session_gap_minutes")
+    variants = raw.get("gap_variants_minutes", [])
+    if not isinstance(variants, list):
+        raise ValueError("gap_variants_minutes must be a list")
+    variants = sorted({_gap(v, "gap_variants_minutes") for v in variants} - {gap})
+
+    funnels = {}
+    for name, spec in (raw.get("funnels") or DEFAULT_CONFIG["funnels"]).items():
+        _name(name, "Funnel")
+        if not isinstance(spec, dict) or not spec.get("stages"):
+            raise ValueError(f"Funnel {name!r} needs a non-empty stages list")
+        stages = [_stage(s, name) for s in spec["stages"]]
+        if len({s["name"] for s in stages}) != len(stages):
+            raise ValueError(f"Funnel {name!r} has duplicate stage names")
+        funnels[name] = {"stages": stages, "strict_order": bool(spec.get("strict_order", False))}
+
+    return {
+        "session_gap_minutes": gap,
+        "gap_variants_minutes": variants,
+        "funnels": funnels,
+        "source": str(source) if source else None,
+    }
+
+
+def load_config(path=None):
+    """Load and validate the funnel config from `path` or FUNNEL_CONFIG.
+
+    Returns the defaults (with source None) when neither is set.
+
+    Raises:
+        FileNotFoundError: If the config file does not exist
+        ValueError: If the file is not valid JSON or the config is malformed
+    """
+    path = path or os.environ.get(CONFIG_ENV)
+    if not path:
+        return normalize_config(DEFAULT_CONFIG)
+    path = p.Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"Funnel config not found: {path}")
+    try:
+        raw = json.loads(path.read_text(encoding="utf-8"))
+    except ValueError as e:
+        raise ValueError(f"Funnel config {path} is not valid JSON: {e}")
+    return normalize_config(raw, source=path)
+
+
+def configure(config):
+    """Make `config` (from load_config/normalize_config) the active config."""
+    CONFIG.clear()
+    CONFIG.update(config)
+
+
+def session_gap_minutes():
+    """Inactivity gap (minutes) that closes a session in the active config."""
+    return CONFIG["session_gap_minutes"]
+
+
+def session_gap_sql(minutes=None):
+    """SQL INTERVAL of a session gap (the active one by default)."""
+    return f"INTERVAL {int(minutes or session_gap_minutes())} MINUTE"
+
+
+def has_variants(config=None):
+    """True if the config asks for gap variants or funnels beyond the defaults."""
+    config = config or CONFIG
+    return bool(config["source"]) and (
+        bool(config["gap_variants_minutes"]) or config["funnels"] != normalize_config(DEFAULT_CONFIG)["funnels"]
+    )
+
+
+def _stage_codes(stage):
+    """ENUM codes (see EVENT_TYPES) of a stage's event types."""
+    return [EVENT_TYPES.index(e) for e in stage["events"]]
+
+
+def variants_sql(source="events", config=None):
+    """Build the single-scan SELECT of stage reach per gap variant and funnel.
+
+    Args:
+        source: Table with (user_id, ts, event_type) columns
+        config: Normalized config (the active one by default)
+
+    Returns:
+        SQL producing one row per (gap_minutes, funnel, stage_order) with
+        stage, strict_order, sessions, sessions_reached,
+        conversion_from_previous and conversion_from_first
+    """
+    config = config or CONFIG
+    gaps = sorted({config["session_gap_minutes"], *config["gap_variants_minutes"]})
+    seq_columns = ",\n             ".join(
+        f"SUM(COALESCE(since_prev > {session_gap_sql(g)}, TRUE)::INTEGER) OVER w AS seq_{g}"
+        for g in gaps
+    )
+    per_gap = ", ".join(f"{{'gap_minutes': {g}, 'seq': seq_{g}}}" for g in gaps)
+
+    # One reach expression per (funnel, stage), evaluated on each session's codes
+    reach, labels = [], []
+    for name, funnel in config["funnels"].items():
+        stages = funnel["stages"]
+        if funnel["strict_order"]:
+            codes = [_stage_codes(s) for s in stages]
+            depth = (f"list_reduce(codes, lambda acc, x: CASE WHEN acc < {len(stages)} "
+                     f"AND list_contains({codes}[acc + 1], x) THEN acc + 1 ELSE acc END, 0)")
+        for order, stage in enumerate(stages, start=1):
+            if funnel["strict_order"]:
+                reach.append(f"{depth} >= {order}")
+            else:
+                reach.append(f"list_has_any(codes, {_stage_codes(stage)}::UTINYINT[])")
+            labels.append(f"({len(labels) + 1}, '{name}', {str(funnel['strict_order']).upper()}, "
+                          f"{order}, '{stage['name']}')")
+    counts = ",\n             ".join(f"COUNT(*) FILTER (WHERE {expr})" for expr in reach)
+
+    return f"""
+    WITH e AS (
+      SELECT user_id, enum_code(event_type)::UTINYINT AS code,
+             ROW_NUMBER() OVER w AS rn,
+             ts - LAG(ts) OVER w AS since_prev
+      FROM {source}
+      WINDOW w AS (PARTITION BY user_id ORDER BY ts)
+    ),
+    s AS (
+      SELECT user_id, rn, code,
+             {seq_columns}
+      FROM e
+      WINDOW w AS (PARTITION BY user_id ORDER BY rn ROWS UNBOUNDED PRECEDING)
+    ),
+    sessions AS (
+      SELECT gap_minutes, list(code ORDER BY rn) AS codes
+      FROM (SELECT user_id, rn, code, unnest([{per_gap}], recursive := true) FROM s)
+      GROUP BY gap_minutes, user_id, seq
+    ),
+    totals AS (
+      SELECT gap_minutes, COUNT(*) AS sessions,
+             [{counts}] AS reached
+      FROM sessions
+      GROUP BY 1
+    ),
+    stages(idx, funnel, strict_order, stage_order, stage) AS (
+      VALUES {', '.join(labels)}
+    )
+    SELECT t.gap_minutes, d.funnel, d.strict_order, d.stage_order, d.stage,
+           t.sessions,
+           t.reached[d.idx] AS sessions_reached,
+           1.0 * t.reached[d.idx] / NULLIF(LAG(t.reached[d.idx]) OVER f, 0) AS conversion_from_previous,
+           1.0 * t.reached[d.idx] / NULLIF(FIRST_VALUE(t.reached[d.idx]) OVER f, 0) AS conversion_from_first
+    FROM totals t CROSS JOIN stages d
+    WINDOW f AS (PARTITION BY t.gap_minutes, d.funnel ORDER BY d.stage_order)
+    ORDER BY 1, 2, 4
+    """
@@ -0,0 +1,111 @@
+"""
+Conditional GET and response compression for the API server.
+
+Dashboards poll the same few endpoints over and over. Endpoints that
+support it tag their responses with a weak ETag built from version tokens
+of their inputs (file size/mtime, never file contents), so a request whose
+If-None-Match still matches is answered with 304 before any CSV or the
+warehouse is read. Tagged responses carry `Cache-Control: no-cache`, which
+makes browsers revalidate on every poll instead of re-downloading.
+
+Compressible responses (JSON, CSV, HTML, JS, CSS) of at least
+MIN_COMPRESS_BYTES are sent br (when the optional brotli package is
+installed) or gzip, as negotiated from Accept-Encoding. ETags are weak so
+they stay valid across encodings.
+"""
+import gzip
+import json
+import hashlib
+from flask import Response, request
+from utils import file_signature
+
+try:
+    import brotli
+except ImportError:  # br responses need the brotli package
+    brotli = None
+
+# Mimetypes worth compressing
+COMPRESSIBLE_TYPES = {
+    "application/json", "text/csv", "text/html", "text/css",
+    "text/javascript", "application/javascript",
+}
+
+# Smaller bodies are sent as-is (compression would not pay for itself)
+MIN_COMPRESS_BYTES = 1024
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+CACHE_CONTROL = "no-cache"
+
+
+def file_version(path):
+    """Return a 'size:mtime_ns' token for a file, or None if it is missing."""
+    try:
+        sig = file_signature(path)
+    except OSError:
+        return None
+    return f"{sig['size']}:{sig['mtime_ns']}"
+
+
+def make_etag(*parts):
+    """Return an opaque ETag value over JSON-serializable version parts."""
+    payload = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()[:24]
+
+
+def not_modified(etag):
+    """Return a 304 response if If-None-Match matches `etag`, else None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return tag(Response(status=304), etag)
+
+
+def tag(response, etag):
+    """Set the weak ETag and revalidation policy on a response."""
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+def _encoding():
+    """Pick br or gzip from the request's Accept-Encoding, or None."""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(response):
+    """Compress a response body per Accept-Encoding (Flask after_request hook).
+
+    Attachments and streamed responses (artifact downloads, which are
+    compressed or binary already) and partial or non-200 responses pass
+    through unchanged; static files are read and compressed like any other
+    body.
+    """
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.headers.get("Content-Disposition", "").startswith("attachment")
+            or (response.is_streamed and not response.direct_passthrough)):
+        return response
+    encoding = _encoding()
+    if encoding is None:
+        return response
+
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+    if encoding == "br":
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Accept-Ranges", None)
+    # The compressed body is a different byte sequence: keep only weak validators
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,351 @@
+"""
+Micro-batch event ingestion with live funnel state.
+
+The API server accepts batches of raw events (POST /api/events) and buffers
+them. A background flusher turns the buffer into micro-batches every
+MICRO_BATCH_SECONDS (sooner once MICRO_BATCH_EVENTS are waiting) and applies
+them to an in-memory open-session state keyed by user_id:
+
+- an event more than the session gap (from the funnel config the server
+  loads at start, see funnels.py) after the user's last event closes the
+  open session and starts a new one
+- sessions whose last event is more than the gap behind the stream's
+  watermark (latest event time seen) are closed as well
+
+Closed sessions are flushed incrementally into the warehouse through the
+same merge as `etl_funnel.py --incremental` (merge_new_events), so a closed
+session that continues the user's last stored session is re-opened and
+merged, the rollups are refreshed for the touched days/users only and
+etl_manifest records the streamed event count under the "stream" source.
+
+Live counters (sessions, steps and sessions with a view/cart/purchase that
+are still open or not yet flushed) are updated per event, so
+/api/pipeline/summary adds them to the stored totals without any rescan.
+
+Every flush is first appended (and fsynced) to an append-only log,
+data/interim/stream_events.csv in the events.csv format; the merge then
+records the log's new length as the stream source's high-water mark. A
+full build from events.csv replays the log, so streamed events survive
+rebuilds (see etl_funnel.replay_stream_log). The month partitions are marked
+stale until the next pipeline run rewrites them.
+"""
+import os
+import csv
+import io
+import heapq
+import threading
+import datetime as dt
+from collections import Counter
+import funnels
+from etl_funnel import (EVENT_TYPE_ENUM, EVENTS_COLUMNS, STREAM_SOURCE, create_types, file_order,
+                        merge_new_events, stream_log_offset)
+from utils import EVENT_TYPES, STREAM_LOG
+
+# etl_manifest source of streamed events (bytes_processed = committed log length)
+INGEST_SOURCE = STREAM_SOURCE
+
+# Micro-batch cadence and size trigger
+MICRO_BATCH_SECONDS = 1.0
+MICRO_BATCH_EVENTS = 5000
+
+# Request limit, and limit on events held in memory (buffered, in open
+# sessions or in closed sessions waiting for a successful flush)
+MAX_REQUEST_EVENTS = 10000
+MAX_BUFFERED_EVENTS = 1_000_000
+
+# Epoch timestamps above this are milliseconds (as in RetailRocket exports)
+EPOCH_MS_THRESHOLD = 10**11
+
+# Live counter names, in funnel_metrics order
+COUNTERS = ("sessions", "steps", "views", "carts", "purchases")
+
+# event type -> live counter of sessions with that event
+EVENT_COUNTERS = dict(zip(EVENT_TYPES, ("views", "carts", "purchases")))
+
+
+class FlushBusyError(RuntimeError):
+    """A non-blocking flush found the warehouse or another flush busy."""
+
+
+def parse_timestamp(value):
+    """Parse an epoch (seconds or milliseconds) or ISO timestamp as naive UTC."""
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp {value!r}")
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.strip().isdigit()):
+        epoch = float(value)
+        if epoch > EPOCH_MS_THRESHOLD:
+            epoch /= 1000
+        return dt.datetime.fromtimestamp(epoch, tz=dt.timezone.utc).replace(tzinfo=None)
+    try:
+        ts = dt.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise ValueError(f"Invalid timestamp {value!r}; use epoch seconds/milliseconds or ISO 8601")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def parse_events(payload):
+    """Validate a POSTed batch into (user_id, ts, event_type, sku) tuples.
+
+    Args:
+        payload: {"events": [...]} or a list of events, each with the raw
+            events.csv fields user_id, timestamp, event and itemid
+
+    Raises:
+        ValueError: If the batch or any event is malformed
+    """
+    events = payload.get("events") if isinstance(payload, dict) else payload
+    if not isinstance(events, list) or not events:
+        raise ValueError('Body must be a non-empty list of events or {"events": [...]}')
+    if len(events) > MAX_REQUEST_EVENTS:
+        raise ValueError(f"At most {MAX_REQUEST_EVENTS} events per request")
+    parsed = []
+    for index, event in enumerate(events):
+        try:
+            if not isinstance(event, dict):
+                raise ValueError("event must be an object")
+            kind = event.get("event")
+            if kind not in EVENT_TYPES:
+                raise ValueError(f"event must be one of: {', '.join(EVENT_TYPES)}")
+            parsed.append((int(event["user_id"]), parse_timestamp(event["timestamp"]), kind, int(event["itemid"])))
+        except KeyError as e:
+            raise ValueError(f"events[{index}]: missing field {e}")
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"events[{index}]: {e}")
+    return parsed
+
+
+def append_stream_log(rows, offset):
+    """Append rows to STREAM_LOG after cutting it back to `offset` bytes.
+
+    Cutting back drops the rows of an earlier flush whose merge failed (they
+    are being retried in `rows`). The file is fsynced before returning.
+
+    Returns the new log length.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if not offset:
+        writer.writerow(EVENTS_COLUMNS)
+    writer.writerows((user_id, ts.isoformat(sep=" "), event_type, sku) for user_id, ts, event_type, sku in rows)
+    STREAM_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with open(STREAM_LOG, "r+b" if STREAM_LOG.exists() else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(buffer.getvalue().encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def merge_events(con, rows, gap_minutes=None):
+    """Log closed-session events durably and merge them into the warehouse tables and rollups.
+
+    Args:
+        con: Warehouse connection/cursor (writable)
+        rows: List of (user_id, ts, event_type, sku)
+        gap_minutes: Session gap to merge with (LiveFunnel.gap_minutes, so
+            the warehouse sessions match the live ones)
+
+    Returns the number of events merged.
+    """
+    create_types(con)
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE events_new (
+        user_id BIGINT, ts TIMESTAMP, event_type {EVENT_TYPE_ENUM}, sku BIGINT
+    );
+    """)
+    users, stamps, kinds, skus = (list(column) for column in zip(*rows))
+    with file_order(con):
+        con.execute(f"""
+        INSERT INTO events_new
+        SELECT unnest(?::BIGINT[]), unnest(?::TIMESTAMP[]), CAST(unnest(?::VARCHAR[]) AS {EVENT_TYPE_ENUM}),
+               unnest(?::BIGINT[]);
+        """, [users, stamps, kinds, skus])
+    new_offset = append_stream_log(rows, stream_log_offset(con))
+    return merge_new_events(con, INGEST_SOURCE, new_offset, verbose=False, gap_minutes=gap_minutes)
+
+
+class LiveFunnel:
+    """Buffers streamed events, tracks open sessions and flushes closed ones.
+
+    Args:
+        sink: Callable receiving a list of (user_id, ts, event_type, sku)
+            rows of closed sessions and a `blocking` flag; it must merge
+            them durably with gap_minutes (see merge_events) or raise, in
+            which case they are retried. With blocking=False it raises
+            FlushBusyError instead of waiting for the warehouse
+        gap_minutes: Session gap (default: the active funnel config, read
+            once here so later reconfiguration does not change it)
+    """
+
+    def __init__(self, sink, gap_minutes=None):
+        self._sink = sink
+        self.gap_minutes = gap_minutes or funnels.session_gap_minutes()
+        self._gap = dt.timedelta(minutes=self.gap_minutes)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._buffer = []
+        self._open = {}      # user_id -> {"last", "events", "flags", "version"}
+        self._expiry = []    # heap of (last ts, user_id, version)
+        self._closed = []    # closed sessions waiting to be flushed
+        self._live = Counter()
+        self._watermark = None
+        self._stats = Counter()
+        self._last_flush_at = None
+        self._last_error = None
+
+    def start(self):
+        """Start the background flusher (idempotent)."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="live-funnel-flusher", daemon=True)
+                self._thread.start()
+
+    def submit(self, events):
+        """Buffer parsed events; returns the number of buffered events.
+
+        Events of open sessions and of closed sessions not yet flushed (e.g.
+        while flushes fail) count against MAX_BUFFERED_EVENTS too, so memory
+        stays bounded when the warehouse cannot take them.
+
+        Raises:
+            OverflowError: If the limit is reached (the client should retry)
+        """
+        with self._lock:
+            # live steps = events of open and not yet flushed sessions
+            if len(self._buffer) + self._live["steps"] + len(events) > MAX_BUFFERED_EVENTS:
+                raise OverflowError("Ingestion buffer is full; retry shortly")
+            self._buffer.extend(events)
+            self._stats["events_received"] += len(events)
+            buffered = len(self._buffer)
+        if buffered >= MICRO_BATCH_EVENTS:
+            self._wake.set()
+        self.start()
+        return buffered
+
+    def _run(self):
+        while True:
+            self._wake.wait(MICRO_BATCH_SECONDS)
+            self._wake.clear()
+            try:
+                self.process()
+            except Exception:
+                pass  # recorded in status()["last_error"]; retried next tick
+
+    def _close(self, user_id):
+        session = self._open.pop(user_id)
+        self._closed.append(session)
+        self._stats["sessions_closed"] += 1
+
+    def _apply(self, user_id, ts, event_type, sku):
+        session = self._open.get(user_id)
+        if session is not None and ts - session["last"] > self._gap:
+            self._close(user_id)
+            session = None
+        if session is None:
+            session = {"last": ts, "events": [], "flags": set(), "version": 0}
+            self._open[user_id] = session
+            self._live["sessions"] += 1
+        session["events"].append((user_id, ts, event_type, sku))
+        self._live["steps"] += 1
+        if event_type not in session["flags"]:
+            session["flags"].add(event_type)
+            self._live[EVENT_COUNTERS[event_type]] += 1
+        if ts > session["last"]:
+            session["last"] = ts
+        session["version"] += 1
+        heapq.heappush(self._expiry, (session["last"], user_id, session["version"]))
+        if self._watermark is None or ts > self._watermark:
+            self._watermark = ts
+
+    def _expire(self, close_all=False):
+        if close_all:
+            for user_id in list(self._open):
+                self._close(user_id)
+            self._expiry.clear()
+            return
+        while self._expiry and self._expiry[0][0] + self._gap < self._watermark:
+            last, user_id, version = heapq.heappop(self._expiry)
+            session = self._open.get(user_id)
+            if session is not None and session["version"] == version:
+                self._close(user_id)
+
+    def process(self, close_all=False, blocking=True):
+        """Apply the buffered micro-batch and flush the sessions it closed.
+
+        Args:
+            close_all: Also close every open session (e.g. before shutdown)
+            blocking: Wait for a running flush and for the warehouse; if
+                False, raise FlushBusyError instead (closed sessions stay
+                queued for the background flusher)
+
+        Returns the number of events flushed to the warehouse.
+        """
+        if not self._flush_lock.acquire(blocking=blocking):
+            raise FlushBusyError("Another flush is in progress; retry shortly")
+        try:
+            return self._process(close_all, blocking)
+        finally:
+            self._flush_lock.release()
+
+    def _process(self, close_all, blocking):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            for event in sorted(batch, key=lambda e: e[1]):
+                self._apply(*event)
+            if batch:
+                self._stats["micro_batches"] += 1
+            if self._watermark is not None or close_all:
+                self._expire(close_all)
+            closed = self._closed
+            self._closed = []
+        if not closed:
+            return 0
+
+        rows = [event for session in closed for event in session["events"]]
+        try:
+            self._sink(rows, blocking=blocking)
+        except FlushBusyError:
+            with self._lock:
+                self._closed = closed + self._closed
+            raise
+        except Exception as e:
+            with self._lock:
+                self._closed = closed + self._closed
+                self._last_error = str(e)[:500]
+            raise
+        with self._lock:
+            for session in closed:
+                self._live["sessions"] -= 1
+                self._live["steps"] -= len(session["events"])
+                for event_type in session["flags"]:
+                    self._live[EVENT_COUNTERS[event_type]] -= 1
+            self._stats["events_flushed"] += len(rows)
+            self._stats["sessions_flushed"] += len(closed)
+            self._last_flush_at = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+            self._last_error = None
+        return len(rows)
+
+    def live_counters(self):
+        """Counts of sessions not yet in the warehouse (open or awaiting flush)."""
+        with self._lock:
+            return {name: self._live[name] for name in COUNTERS}
+
+    def status(self):
+        """Return buffer, open-session, counter and flush statistics."""
+        with self._lock:
+            return {
+                "buffered_events": len(self._buffer),
+                "open_sessions": len(self._open),
+                "closed_pending": len(self._closed),
+                "watermark": self._watermark.isoformat() if self._watermark else None,
+                "session_gap_minutes": self.gap_minutes,
+                "live": {name: self._live[name] for name in COUNTERS},
+                "stats": dict(self._stats),
+                "last_flush_at": self._last_flush_at,
+                "last_error": self._last_error,
+            }
@@ -0,0 +1,334 @@
+"""
+Per-stage run instrumentation for the ETL and analytics runs.
+
+A run (one pipeline or analytics invocation) is a tree of named stages. Each
+stage records wall time, rows in/out where the stage knows them, process
+memory (current and peak RSS) and a DuckDB profile summary of every query it
+ran: latency, CPU time, rows scanned, peak buffer memory, spill size and the
+most expensive operators. Queries are captured by wrapping the run's DuckDB
+connection (RunRecorder.wrap), so stage code keeps calling con.execute().
+
+Each finished run is written to data/interim/runs/<run_id>.json; the newest
+RUN_HISTORY runs are kept and served by /api/runs. Set FUNNEL_PROFILE=1 (or
+--profile) to also store every query's full operator tree.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import contextlib
+import datetime as dt
+from utils import RUNS_DIR, report_progress, write_json_atomic
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Keep this many run records on disk
+RUN_HISTORY = 100
+
+# When FUNNEL_PROFILE=1, store full DuckDB operator trees for every query
+PROFILE_ENV = "FUNNEL_PROFILE"
+
+# Operators listed per query in the profile summary
+TOP_OPERATORS = 3
+
+# Longest query text stored per profiled query
+MAX_QUERY_TEXT = 300
+
+# Recorder of the run active on this thread (see run())
+_current = threading.local()
+
+
+def rss_mb():
+    """Return the current resident set size in MB, or None if unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / 1024**2, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def max_rss_mb():
+    """Return the process's peak resident set size in MB, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return round(peak / (1024**2 if sys.platform == "darwin" else 1024), 1)
+
+
+def _operator_tree(node):
+    return {
+        "operator": node.get("operator_name") or node.get("operator_type"),
+        "seconds": node.get("operator_timing"),
+        "rows": node.get("operator_cardinality"),
+        "children": [_operator_tree(child) for child in node.get("children", [])],
+    }
+
+
+def _top_operators(node, limit=TOP_OPERATORS):
+    flat = []
+    stack = list(node.get("children", []))
+    while stack:
+        op = stack.pop()
+        flat.append(op)
+        stack.extend(op.get("children", []))
+    flat.sort(key=lambda op: op.get("operator_timing") or 0, reverse=True)
+    return [
+        {"operator": op.get("operator_name") or op.get("operator_type"),
+         "seconds": round(op.get("operator_timing") or 0, 6),
+         "rows": op.get("operator_cardinality")}
+        for op in flat[:limit]
+    ]
+
+
+def summarize_profile(profile, full=False):
+    """Reduce a DuckDB JSON query profile to the fields kept in a run record."""
+    summary = {
+        "latency": profile.get("latency"),
+        "cpu_time": profile.get("cpu_time"),
+        "rows_scanned": profile.get("cumulative_rows_scanned"),
+        "rows_returned": profile.get("rows_returned"),
+        "peak_buffer_mb": round((profile.get("system_peak_buffer_memory") or 0) / 1024**2, 1),
+        "spill_mb": round((profile.get("system_peak_temp_dir_size") or 0) / 1024**2, 1),
+        "top_operators": _top_operators(profile),
+    }
+    if full:
+        summary["plan"] = [_operator_tree(child) for child in profile.get("children", [])]
+    return summary
+
+
+class ProfiledConnection:
+    """DuckDB connection/cursor proxy that records each query in the current stage."""
+
+    def __init__(self, recorder, con):
+        self._recorder = recorder
+        self._con = con
+        try:
+            con.execute("PRAGMA enable_profiling = 'no_output';")
+        except Exception:
+            pass
+
+    def execute(self, query, parameters=None):
+        started = time.perf_counter()
+        if parameters is None:
+            result = self._con.execute(query)
+        else:
+            result = self._con.execute(query, parameters)
+        self._recorder.record_query(self._con, query, time.perf_counter() - started)
+        return result
+
+    def cursor(self):
+        return ProfiledConnection(self._recorder, self._con.cursor())
+
+    def unwrap(self):
+        """Disable profiling and return the underlying connection."""
+        try:
+            self._con.execute("PRAGMA disable_profiling;")
+        except Exception:
+            pass
+        return self._con
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+class RunRecorder:
+    """Collects the stage tree and query profiles of one run."""
+
+    def __init__(self, kind, params=None, full_profile=None):
+        started = dt.datetime.now(dt.timezone.utc)
+        self.run_id = f"{kind}-{started:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+        if full_profile is None:
+            full_profile = os.environ.get(PROFILE_ENV) == "1"
+        self.full_profile = full_profile
+        self.record = {
+            "run_id": self.run_id,
+            "kind": kind,
+            "params": params or {},
+            "status": "running",
+            "started_at": started.isoformat(timespec="seconds"),
+            "finished_at": None,
+            "seconds": None,
+            "max_rss_mb": None,
+            "error": None,
+            "stages": [],
+        }
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, con):
+        """Return `con` wrapped so every query is profiled into the current stage."""
+        return ProfiledConnection(self, con)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, progress=None, **fields):
+        """Record a stage around a with-block; yields its mutable record.
+
+        Stages opened inside another stage on the same thread nest under it.
+        Callers may set rows_in/rows_out (or any other field) on the record.
+
+        Args:
+            name: Stage name (e.g. "load", "export.funnel_steps")
+            progress: If given, also report_progress(name, progress)
+            **fields: Extra fields stored on the stage record
+        """
+        if progress is not None:
+            report_progress(name, progress)
+        stack = self._stack()
+        record = {
+            "name": name,
+            "offset": round(time.perf_counter() - self._started, 4),
+            **fields,
+            "queries": [],
+            "stages": [],
+        }
+        with self._lock:
+            (stack[-1]["stages"] if stack else self.record["stages"]).append(record)
+        stack.append(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = str(e)[:500]
+            raise
+        finally:
+            stack.pop()
+            record["seconds"] = round(time.perf_counter() - started, 4)
+            record["rss_mb"] = rss_mb()
+            record["max_rss_mb"] = max_rss_mb()
+            peaks = [q["peak_buffer_mb"] for q in record["queries"]] + \
+                    [s.get("duckdb_peak_buffer_mb") or 0 for s in record["stages"]]
+            record["duckdb_peak_buffer_mb"] = max(peaks, default=None)
+            if not record["stages"]:
+                del record["stages"]
+
+    def record_query(self, con, query, seconds):
+        """Attach the profile of the query just run on `con` to the current stage."""
+        stack = self._stack()
+        if not stack:
+            return
+        entry = {"query": " ".join(str(query).split())[:MAX_QUERY_TEXT], "seconds": round(seconds, 6)}
+        try:
+            profile = json.loads(con.get_profiling_information(format="json"))
+            if profile.get("result") != "error":
+                entry.update(summarize_profile(profile, full=self.full_profile))
+        except Exception:
+            pass
+        entry.setdefault("peak_buffer_mb", 0)
+        stack[-1]["queries"].append(entry)
+
+    def finish(self, status, error=None):
+        """Mark the run finished and persist it."""
+        self.record.update(
+            status=status,
+            error=error,
+            finished_at=dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            seconds=round(time.perf_counter() - self._started, 4),
+            max_rss_mb=max_rss_mb(),
+        )
+        save_run(self.record)
+
+
+@contextlib.contextmanager
+def run(kind, params=None, full_profile=None):
+    """Record a run on this thread; yields its RunRecorder.
+
+    The record is persisted when the block exits, with status "failed" (and
+    the error) if it raised.
+    """
+    recorder = RunRecorder(kind, params, full_profile)
+    previous = getattr(_current, "recorder", None)
+    _current.recorder = recorder
+    try:
+        yield recorder
+    except BaseException as e:
+        recorder.finish("failed", error=str(e)[:500])
+        raise
+    else:
+        recorder.finish("succeeded")
+    finally:
+        _current.recorder = previous
+        _current.last_run_id = recorder.run_id
+
+
+def current():
+    """Return the RunRecorder active on this thread, or None."""
+    return getattr(_current, "recorder", None)
+
+
+def last_run_id():
+    """Return the id of the last run finished on this thread, or None."""
+    return getattr(_current, "last_run_id", None)
+
+
+def run_path(run_id):
+    """Path of a run's JSON record."""
+    return RUNS_DIR / f"{run_id}.json"
+
+
+@contextlib.contextmanager
+def stage(name, progress=None, **fields):
+    """Record a stage of the current run (a no-op record if no run is active)."""
+    recorder = current()
+    if recorder is None:
+        if progress is not None:
+            report_progress(name, progress)
+        yield {"name": name, **fields}
+        return
+    with recorder.stage(name, progress=progress, **fields) as record:
+        yield record
+
+
+def save_run(record):
+    """Persist a run record and prune records beyond RUN_HISTORY."""
+    RUNS_DIR.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(run_path(record["run_id"]), record)
+    runs = sorted(RUNS_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime)
+    for path in runs[:max(0, len(runs) - RUN_HISTORY)]:
+        path.unlink(missing_ok=True)
+
+
+def list_runs(kind=None, limit=20):
+    """Return summaries of persisted runs, newest first.
+
+    Each summary has run_id, kind, status, started_at, seconds, max_rss_mb
+    and the top-level stages' names and seconds.
+    """
+    if not RUNS_DIR.exists():
+        return []
+    summaries = []
+    for path in sorted(RUNS_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True):
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        if kind and record.get("kind") != kind:
+            continue
+        summaries.append({
+            **{key: record.get(key) for key in
+               ("run_id", "kind", "status", "started_at", "seconds", "max_rss_mb", "error")},
+            "stages": [{"name": s["name"], "seconds": s.get("seconds")} for s in record.get("stages", [])],
+        })
+        if len(summaries) >= limit:
+            break
+    return summaries
+
+
+def load_run(run_id):
+    """Return a persisted run record, or None if unknown."""
+    path = run_path(run_id)
+    if path.parent != RUNS_DIR or not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
@@ -0,0 +1,216 @@
+"""
+Background job queue for pipeline and analytics runs.
+
+Jobs run in-process in a bounded worker pool so API requests return
+immediately with a job id. Each job declares the artifacts it writes; a
+per-artifact lock keeps two jobs from clobbering the same outputs, and
+submitting a job identical to one already queued or running returns the
+existing job instead of a new one. Progress is streamed from the stages
+themselves: report_progress calls on the job's thread update the job record.
+"""
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import progress_handler
+
+# Job states
+QUEUED = "queued"
+WAITING = "waiting"  # queued on an artifact lock held by another job
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = {SUCCEEDED, FAILED, CANCELLED}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+
+class JobContext:
+    """Handle passed to a running job function for progress and cancellation."""
+
+    def __init__(self, manager, job):
+        self._manager = manager
+        self._job = job
+
+    @property
+    def cancelled(self):
+        return self._job["_cancel"].is_set()
+
+    def on_cancel(self, callback):
+        """Register a callback run on cancel (e.g. a DuckDB cursor's interrupt)."""
+        with self._manager._lock:
+            self._job["_on_cancel"].append(callback)
+
+    def progress(self, stage, fraction=None, **info):
+        """Record stage progress; raises JobCancelled if the job was cancelled."""
+        if self.cancelled:
+            raise JobCancelled()
+        fields = {"stage": stage}
+        if fraction is not None:
+            fields["progress"] = fraction
+        if info:
+            fields["detail"] = info
+        self._manager._update(self._job, **fields)
+
+
+class JobManager:
+    """Bounded worker pool with per-artifact locking and in-flight de-duplication."""
+
+    def __init__(self, max_workers=2, history=100):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._artifact_locks = {}
+        self._jobs = {}
+        self._in_flight = {}
+        self._history = history
+
+    def submit(self, kind, func, artifacts, params=None):
+        """Queue a job, or return the identical job already queued/running.
+
+        Args:
+            kind: Job type ("pipeline" or "analytics")
+            func: Callable taking a JobContext and returning the result dict
+            artifacts: Names of the artifacts the job writes (lock keys)
+            params: JSON-serializable parameters that identify the run
+
+        Returns:
+            (job snapshot, created) where created is False for a duplicate
+        """
+        params = params or {}
+        key = (kind, json.dumps(params, sort_keys=True))
+        with self._lock:
+            existing = self._in_flight.get(key)
+            if existing is not None:
+                return self._snapshot(self._jobs[existing]), False
+
+            job = {
+                "id": uuid.uuid4().hex[:12],
+                "kind": kind,
+                "params": params,
+                "status": QUEUED,
+                "stage": None,
+                "progress": 0.0,
+                "detail": None,
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "_key": key,
+                "_func": func,
+                "_artifacts": sorted(set(artifacts)),
+                "_cancel": threading.Event(),
+                "_on_cancel": []
+            }
+            self._jobs[job["id"]] = job
+            self._in_flight[key] = job["id"]
+            self._prune()
+
+        self._pool.submit(self._run, job)
+        return self._snapshot(job), True
+
+    def artifact_lock(self, name):
+        """Return the lock jobs writing `name` hold, for writers outside the pool."""
+        with self._lock:
+            return self._artifact_locks.setdefault(name, threading.Lock())
+
+    def get(self, job_id):
+        """Return a job snapshot, or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def list(self):
+        """Return snapshots of all known jobs, newest first."""
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda j: j["created_at"], reverse=True)
+            return [self._snapshot(job) for job in jobs]
+
+    def cancel(self, job_id):
+        """Request cancellation.
+
+        Running jobs stop at their next progress report; registered cancel
+        callbacks (DuckDB interrupts) abort the query in flight.
+
+        Returns the job snapshot, or None if unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            callbacks = []
+            if job["status"] not in FINISHED_STATES:
+                job["_cancel"].set()
+                callbacks = list(job["_on_cancel"])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error cancelling job {job_id}: {e}")
+        return self.get(job_id)
+
+    def _snapshot(self, job):
+        return {k: v for k, v in job.items() if not k.startswith("_")}
+
+    def _prune(self):
+        """Drop the oldest finished jobs beyond the history limit (lock held)."""
+        finished = sorted(
+            (j for j in self._jobs.values() if j["status"] in FINISHED_STATES),
+            key=lambda j: j["created_at"]
+        )
+        for job in finished[:max(0, len(finished) - self._history)]:
+            del self._jobs[job["id"]]
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def _finish(self, job, status, **fields):
+        with self._lock:
+            job.update(status=status, finished_at=time.time(), **fields)
+            self._in_flight.pop(job["_key"], None)
+
+    def _acquire_artifacts(self, job):
+        """Acquire artifact locks in a fixed order; returns the held locks or None if cancelled."""
+        with self._lock:
+            locks = [self._artifact_locks.setdefault(name, threading.Lock()) for name in job["_artifacts"]]
+        held = []
+        for lock in locks:
+            while not lock.acquire(timeout=0.5):
+                if job["_cancel"].is_set():
+                    for h in held:
+                        h.release()
+                    return None
+                self._update(job, status=WAITING)
+            held.append(lock)
+        return held
+
+    def _run(self, job):
+        if job["_cancel"].is_set():
+            self._finish(job, CANCELLED)
+            return
+        held = self._acquire_artifacts(job)
+        if held is None:
+            self._finish(job, CANCELLED)
+            return
+        try:
+            self._update(job, status=RUNNING, started_at=time.time())
+            ctx = JobContext(self, job)
+            with progress_handler(ctx.progress):
+                result = job["_func"](ctx)
+            if job["_cancel"].is_set():
+                self._finish(job, CANCELLED)
+            else:
+                self._finish(job, SUCCEEDED, progress=1.0, result=result)
+        except Exception as e:
+            if job["_cancel"].is_set():
+                self._finish(job, CANCELLED)
+            else:
+                self._finish(job, FAILED, error=str(e)[:500])
+        finally:
+            for lock in held:
+                lock.release()
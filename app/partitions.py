@@ -0,0 +1,394 @@
+"""
+Month-partitioned Parquet copies of funnel_steps and funnel_session.
+
+After every ETL build the warehouse tables are mirrored into one Parquet
+partition per month under data/interim/partitions/<table>/month=YYYY-MM/
+(steps by event month, sessions by the month of their first step), with a
+manifest (manifest.json) of per-partition row counts, min/max ts, bytes and
+a content fingerprint. Only months whose fingerprint changed are rewritten.
+After a full build every month is fingerprinted; incremental merges record
+the months they touched in the partition_dirty_months warehouse table
+(mark_dirty), and the next incremental write fingerprints and rewrites just
+those months, so a run touching the current month reads one month of data.
+
+Readers prune with the manifest: query_api reads just the partitions that
+overlap a start/end window, and the warehouse views funnel_steps_by_month /
+funnel_session_by_month (hive-partitioned read_parquet) let SQL reports
+prune on `month` or `ts` predicates. Old months can be archived (moved out
+of the tree the views scan) or compacted (rewritten as one ZSTD file):
+
+    python app/partitions.py archive --before 2015-07
+    python app/partitions.py compact --before 2015-07
+"""
+import sys
+import shutil
+import argparse
+import datetime as dt
+import json
+import duckdb
+from utils import (PARTITIONS_DIR, connect_warehouse, escape_sql_path, write_json_atomic,
+                   add_runtime_args, configure_runtime_from_args)
+
+MANIFEST = PARTITIONS_DIR / "manifest.json"
+
+# Archived partitions are moved here and no longer scanned
+ARCHIVE_DIR = PARTITIONS_DIR.parent / "partitions_archive"
+
+# table -> SELECT over the warehouse producing (month, part_ts, *columns);
+# part_ts is the partitioning time (event time for steps, session start for
+# sessions, read from the session's step_order = 1 row)
+SOURCES = {
+    "funnel_steps": """
+        SELECT strftime(ts, '%Y-%m') AS month, ts AS part_ts, *
+        FROM funnel_steps
+    """,
+    "funnel_session": """
+        SELECT strftime(f.ts, '%Y-%m') AS month, f.ts AS part_ts, s.*, f.ts AS session_start
+        FROM funnel_session s JOIN funnel_steps f USING (session_id)
+        WHERE f.step_order = 1
+    """,
+}
+
+# Months changed by incremental merges since the last partition write
+DIRTY_TABLE = "partition_dirty_months"
+
+# Columns hashed into each month's fingerprint
+FINGERPRINT_COLUMNS = {
+    "funnel_steps": "session_id, ts, event_type, sku, step_order",
+    "funnel_session": "session_id, part_ts, has_view, has_cart, has_purchase",
+}
+
+# Sort column of compacted partitions
+SORT_COLUMNS = {"funnel_steps": "ts", "funnel_session": "session_start"}
+
+# Views created in the warehouse over the partitions of each table
+VIEWS = {"funnel_steps": "funnel_steps_by_month", "funnel_session": "funnel_session_by_month"}
+
+
+def read_manifest():
+    """Return the partition manifest ({"tables": {table: {month: stats}}}), or None."""
+    if not MANIFEST.exists():
+        return None
+    try:
+        return json.loads(MANIFEST.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest):
+    manifest["updated_at"] = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+    write_json_atomic(MANIFEST, manifest)
+
+
+def mark_stale():
+    """Flag the partitions as behind the warehouse (e.g. after streamed merges).
+
+    prune() then returns None, so windowed readers fall back to the warehouse
+    tables until the next write_partitions() rewrites the changed months.
+    """
+    manifest = read_manifest()
+    if manifest is not None and not manifest.get("stale"):
+        manifest["stale"] = True
+        _write_manifest(manifest)
+
+
+def mark_dirty(con, source):
+    """Record the months of `source`'s ts column as changed (call in the merge transaction).
+
+    Args:
+        source: Table of the (re-)sessionized events, whose months cover
+            every step and session start that was rewritten
+    """
+    con.execute(f"CREATE TABLE IF NOT EXISTS {DIRTY_TABLE} (month VARCHAR PRIMARY KEY);")
+    con.execute(f"""
+    INSERT OR IGNORE INTO {DIRTY_TABLE}
+    SELECT DISTINCT strftime(ts, '%Y-%m') FROM {source};
+    """)
+
+
+def dirty_months(con):
+    """Return the months recorded by mark_dirty, or None if never recorded."""
+    try:
+        return sorted(row[0] for row in con.execute(f"SELECT month FROM {DIRTY_TABLE}").fetchall())
+    except duckdb.CatalogException:
+        return None
+
+
+def partition_dir(table, month, root=PARTITIONS_DIR):
+    """Directory holding one month of a table."""
+    return root / table / f"month={month}"
+
+
+def source_sql(table, months=None):
+    """SOURCES[table], restricted to the given months (all months if None).
+
+    The filter is a part_ts range per month, which DuckDB pushes down to the
+    ts column scan, so zone maps skip the other months' row groups.
+    """
+    if months is None:
+        return SOURCES[table]
+    ranges = []
+    for month in months:
+        start = dt.datetime.strptime(month, "%Y-%m")
+        end = (start + dt.timedelta(days=32)).replace(day=1)
+        ranges.append(f"(part_ts >= TIMESTAMP '{start}' AND part_ts < TIMESTAMP '{end}')")
+    return f"SELECT * FROM ({SOURCES[table]}) WHERE {' OR '.join(ranges) or 'FALSE'}"
+
+
+def month_stats(con, table, months=None):
+    """Return {month: {"rows", "min_ts", "max_ts", "fingerprint"}} of a warehouse table.
+
+    With `months`, only those months are scanned (empty ones are omitted).
+    """
+    rows = con.execute(f"""
+    SELECT month, COUNT(*), MIN(part_ts), MAX(part_ts),
+           bit_xor(hash({FINGERPRINT_COLUMNS[table]}))
+    FROM ({source_sql(table, months)})
+    GROUP BY 1
+    """).fetchall()
+    return {
+        month: {"rows": count, "min_ts": str(min_ts), "max_ts": str(max_ts), "fingerprint": str(fingerprint)}
+        for month, count, min_ts, max_ts, fingerprint in rows
+    }
+
+
+def _files(directory):
+    return sorted(directory.glob("*.parquet"))
+
+
+def _stale(table, month, entry, stat):
+    """True if a month's partition is missing or its fingerprint changed."""
+    if entry is None or entry.get("fingerprint") != stat["fingerprint"]:
+        return True
+    root = ARCHIVE_DIR if entry.get("archived") else PARTITIONS_DIR
+    return not _files(partition_dir(table, month, root))
+
+
+def _drop_partition(table, month, entry):
+    """Remove a month's files (active or archived)."""
+    shutil.rmtree(partition_dir(table, month), ignore_errors=True)
+    if entry and entry.get("archived"):
+        shutil.rmtree(partition_dir(table, month, ARCHIVE_DIR), ignore_errors=True)
+
+
+def write_partitions(con, full=True):
+    """Rewrite the partitions whose warehouse content changed and update the manifest.
+
+    Args:
+        full: Fingerprint every month (after a full build). Otherwise only
+            the months recorded by mark_dirty are fingerprinted and
+            rewritten; without a manifest or dirty-month record this falls
+            back to a full pass.
+
+    Returns:
+        {table: number of months rewritten}
+    """
+    manifest = read_manifest()
+    months = None if full or manifest is None else dirty_months(con)
+    manifest = manifest or {"tables": {}}
+    rewritten = {}
+    for table in SOURCES:
+        stats = month_stats(con, table, months)
+        entries = manifest["tables"].setdefault(table, {})
+        changed = sorted(month for month, stat in stats.items()
+                         if _stale(table, month, entries.get(month), stat))
+        scanned = entries if months is None else [m for m in months if m in entries]
+        for month in [m for m in scanned if m not in stats]:
+            _drop_partition(table, month, entries.pop(month))
+        for month in changed:
+            _drop_partition(table, month, entries.get(month))
+
+        if changed:
+            (PARTITIONS_DIR / table).mkdir(parents=True, exist_ok=True)
+            month_list = ", ".join(f"'{m}'" for m in changed)
+            con.execute(f"""
+            COPY (
+                SELECT * EXCLUDE (part_ts) FROM ({source_sql(table, changed)}) WHERE month IN ({month_list})
+            ) TO '{escape_sql_path(PARTITIONS_DIR / table)}'
+            (FORMAT PARQUET, PARTITION_BY (month), OVERWRITE_OR_IGNORE, FILENAME_PATTERN 'part_{{i}}');
+            """)
+        written_at = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+        for month in changed:
+            files = _files(partition_dir(table, month))
+            entries[month] = {
+                **stats[month],
+                "files": [f.relative_to(PARTITIONS_DIR).as_posix() for f in files],
+                "bytes": sum(f.stat().st_size for f in files),
+                "archived": False,
+                "written_at": written_at,
+            }
+        manifest["tables"][table] = dict(sorted(entries.items()))
+        rewritten[table] = len(changed)
+
+    manifest.pop("stale", None)
+    _write_manifest(manifest)
+    if months is None:
+        con.execute(f"DROP TABLE IF EXISTS {DIRTY_TABLE};")
+    elif months:
+        con.execute(f"DELETE FROM {DIRTY_TABLE} WHERE month IN (SELECT unnest(?::VARCHAR[]));", [months])
+    create_views(con)
+    return rewritten
+
+
+def create_views(con):
+    """(Re)create the hive-partitioned warehouse views over the active partitions."""
+    for table, view in VIEWS.items():
+        pattern = PARTITIONS_DIR / table / "*" / "*.parquet"
+        # Parquet stores the event_type ENUM as text; restore the warehouse type
+        columns = "* REPLACE (CAST(event_type AS event_type_enum) AS event_type)" if table == "funnel_steps" else "*"
+        if any((PARTITIONS_DIR / table).glob("*/*.parquet")):
+            con.execute(f"""
+            CREATE OR REPLACE VIEW {view} AS
+            SELECT {columns} FROM read_parquet('{escape_sql_path(pattern)}', hive_partitioning = true);
+            """)
+        else:
+            con.execute(f"DROP VIEW IF EXISTS {view};")
+
+
+def prune(table, start=None, end=None, manifest=None):
+    """Return the Parquet files of `table` overlapping [start, end].
+
+    Archived months are included (read from the archive directory), so a
+    window over old months still sees all of its rows.
+
+    Args:
+        start, end: Inclusive ISO dates (or None for an open bound)
+
+    Returns:
+        List of file paths, or None if the table has no partitions or they
+        are stale (callers should fall back to the warehouse table)
+    """
+    manifest = (manifest if manifest is not None else read_manifest()) or {}
+    entries = manifest.get("tables", {}).get(table)
+    if not entries or manifest.get("stale"):
+        return None
+    files = []
+    for entry in entries.values():
+        if start and entry["max_ts"][:10] < start:
+            continue
+        if end and entry["min_ts"][:10] > end:
+            continue
+        root = ARCHIVE_DIR if entry.get("archived") else PARTITIONS_DIR
+        files.extend(str(root / f) for f in entry["files"])
+    return files
+
+
+def _months_before(table, before, manifest):
+    return [m for m in manifest.get("tables", {}).get(table, {}) if m < before]
+
+
+def archive(before, tables=tuple(SOURCES)):
+    """Move partitions of months before `before` (YYYY-MM) out of the scanned tree.
+
+    Archived months are kept in the manifest with archived=true; the views
+    no longer read them, but windowed query_api queries still do.
+
+    Returns the number of partitions archived.
+    """
+    manifest = read_manifest()
+    if manifest is None:
+        raise FileNotFoundError("No partition manifest; run the ETL first")
+    moved = 0
+    for table in tables:
+        entries = manifest["tables"].get(table, {})
+        for month in _months_before(table, before, manifest):
+            entry = entries[month]
+            if entry.get("archived"):
+                continue
+            target = partition_dir(table, month, ARCHIVE_DIR)
+            shutil.rmtree(target, ignore_errors=True)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(partition_dir(table, month)), str(target))
+            entry.update(archived=True, files=[f.relative_to(ARCHIVE_DIR).as_posix() for f in _files(target)])
+            moved += 1
+    _write_manifest(manifest)
+    return moved
+
+
+def compact(con, before, tables=tuple(SOURCES)):
+    """Rewrite each active month before `before` as a single ts-sorted ZSTD file.
+
+    Returns the number of partitions compacted.
+    """
+    manifest = read_manifest()
+    if manifest is None:
+        raise FileNotFoundError("No partition manifest; run the ETL first")
+    compacted = 0
+    for table in tables:
+        entries = manifest["tables"].get(table, {})
+        for month in _months_before(table, before, manifest):
+            entry = entries[month]
+            if entry.get("archived"):
+                continue
+            directory = partition_dir(table, month)
+            sources = _files(directory)
+            target = directory / "compact.parquet.tmp"
+            con.execute(f"""
+            COPY (SELECT * FROM read_parquet(?) ORDER BY {SORT_COLUMNS[table]})
+            TO '{escape_sql_path(target)}' (FORMAT PARQUET, COMPRESSION ZSTD);
+            """, [[str(f) for f in sources]])
+            for f in sources:
+                f.unlink()
+            final = target.rename(directory / "part_0.parquet")
+            entry.update(files=[final.relative_to(PARTITIONS_DIR).as_posix()], bytes=final.stat().st_size)
+            compacted += 1
+    _write_manifest(manifest)
+    return compacted
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Manage the month-partitioned steps/session Parquet store.")
+    parser.add_argument("command", choices=("status", "archive", "compact"),
+                        help="status: list partitions; archive/compact: months before --before")
+    parser.add_argument("--before", help="First month to keep untouched (YYYY-MM)")
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Archive, compact or list partitions."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+    try:
+        if args.command == "status":
+            manifest = read_manifest()
+            if manifest is None:
+                raise FileNotFoundError("No partition manifest; run the ETL first")
+            for table, entries in manifest["tables"].items():
+                for month, entry in entries.items():
+                    state = "archived" if entry.get("archived") else "active"
+                    print(f"{table} {month}: {entry['rows']:,} rows, {entry['bytes']:,} bytes "
+                          f"({entry['min_ts']} .. {entry['max_ts']}) [{state}]")
+            return
+        if not args.before:
+            raise ValueError("--before YYYY-MM is required")
+        try:
+            dt.datetime.strptime(args.before, "%Y-%m")
+        except ValueError:
+            raise ValueError(f"--before must be YYYY-MM, got {args.before!r}")
+        if args.command == "archive":
+            count = archive(args.before)
+            con = connect_warehouse()
+            try:
+                create_views(con)
+            finally:
+                con.close()
+        else:
+            con = connect_warehouse()
+            try:
+                count = compact(con, args.before)
+            finally:
+                con.close()
+        verb = "Archived" if args.command == "archive" else "Compacted"
+        print(f"✅ {verb} {count} partition(s) before {args.before}")
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except duckdb.Error as e:
+        print(f"❌ DuckDB Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
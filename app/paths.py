@@ -0,0 +1,311 @@
+"""
+Session paths and time-to-convert distributions from one ordered scan.
+
+funnel_steps is read once, ordered by (session_id, step_order) and fetched
+in batches of SCAN_BATCH_ROWS, and every session feeds two streaming
+structures:
+
+- a prefix trie of the session's event sequence (view>view>addtocart>...),
+  capped at MAX_PATH_DEPTH steps. When the trie grows past MAX_TRIE_NODES
+  its least-visited nodes are pruned (Misra-Gries style), so memory stays
+  bounded; a path's count is then low by at most the sum of the pruning
+  thresholds, reported as max_undercount.
+- log-bucketed quantile sketches (DDSketch; every quantile is within
+  SKETCH_RELATIVE_ERROR of the exact value) of latencies in seconds: from a
+  SKU's first view in a session to its first cart/purchase, per SKU, and
+  from session start to the session's first cart/purchase, per cohort
+  (the user's first-purchase month, as in cohort_retention). Sketches merge
+  by adding bucket counts; the "all" cohort row is the merge of the
+  per-cohort sketches.
+
+No self-joins are needed: each session's state (first view per SKU, trie
+cursor) is dropped as soon as the scan moves to the next session.
+
+Results are exported next to the SQL reports:
+- session_paths.csv: the TOP_K_PATHS most common complete paths
+- time_to_convert_sku.csv: latency quantiles per SKU
+- time_to_convert_cohort.csv: latency quantiles per cohort month
+"""
+import csv
+import math
+import time
+import heapq
+from utils import ARTIFACTS, write_artifact_meta
+
+OUTPUT_FILES = ("session_paths.csv", "time_to_convert_sku.csv", "time_to_convert_cohort.csv")
+
+# Steps kept per path; longer sessions are reported as '<prefix>>...'
+MAX_PATH_DEPTH = 12
+
+# Trie size that triggers pruning (pruning keeps the busiest half)
+MAX_TRIE_NODES = 50000
+
+# Paths exported to session_paths.csv
+TOP_K_PATHS = 100
+
+# Relative accuracy of the latency quantiles
+SKETCH_RELATIVE_ERROR = 0.01
+
+# Quantiles exported per sketch
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Rows fetched from DuckDB per scan batch
+SCAN_BATCH_ROWS = 65536
+
+# Parameters that change the outputs (part of the analytics fingerprint)
+PARAMS = {
+    "max_path_depth": MAX_PATH_DEPTH,
+    "max_trie_nodes": MAX_TRIE_NODES,
+    "top_k_paths": TOP_K_PATHS,
+    "relative_error": SKETCH_RELATIVE_ERROR,
+    "quantiles": QUANTILES,
+}
+
+SCAN_SQL = """
+WITH cohorts AS (
+  SELECT user_id, strftime(MIN(month_active), '%Y-%m') AS cohort_month
+  FROM rollup_purchaser_month
+  GROUP BY 1
+)
+SELECT s.session_id, epoch(s.ts) AS ts, s.event_type::VARCHAR AS event_type, s.sku,
+       COALESCE(c.cohort_month, 'none') AS cohort_month
+FROM funnel_steps s LEFT JOIN cohorts c USING (user_id)
+ORDER BY s.session_id, s.step_order
+"""
+
+
+class QuantileSketch:
+    """Mergeable log-bucketed quantile sketch of non-negative values (DDSketch).
+
+    A value v > 0 is counted in bucket ceil(log_gamma(v)) with
+    gamma = (1 + alpha) / (1 - alpha); every bucket's midpoint is within a
+    relative error alpha of the values it holds. Zeros are counted apart.
+    """
+
+    def __init__(self, alpha=SKETCH_RELATIVE_ERROR):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """Add one value."""
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other):
+        """Add another sketch's counts (both must share alpha)."""
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different relative errors")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1), or None if empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def summary(self):
+        """Return [count, mean, *quantiles] rounded for export."""
+        mean = self.total / self.count if self.count else None
+        return [self.count, _round(mean), *(_round(self.quantile(q)) for q in QUANTILES)]
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+class PathTrie:
+    """Prefix trie of session event paths with bounded size.
+
+    Each node is [sessions through it, sessions ending at it, sessions
+    truncated at it, children by event type].
+    """
+
+    def __init__(self, max_depth=MAX_PATH_DEPTH, max_nodes=MAX_TRIE_NODES):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.root = [0, 0, 0, {}]
+        self.nodes = 0
+        self.sessions = 0
+        self.max_undercount = 0
+
+    def add(self, path):
+        """Count one session's event sequence."""
+        self.sessions += 1
+        node = self.root
+        node[0] += 1
+        for event_type in path[:self.max_depth]:
+            children = node[3]
+            child = children.get(event_type)
+            if child is None:
+                child = children[event_type] = [0, 0, 0, {}]
+                self.nodes += 1
+            child[0] += 1
+            node = child
+        node[1 if len(path) <= self.max_depth else 2] += 1
+        if self.nodes > self.max_nodes:
+            self.prune()
+
+    def _walk(self):
+        """Yield (path, node) for every non-root node."""
+        stack = [((), self.root)]
+        while stack:
+            path, node = stack.pop()
+            for event_type, child in node[3].items():
+                child_path = path + (event_type,)
+                yield child_path, child
+                stack.append((child_path, child))
+
+    def prune(self):
+        """Drop every node visited no more often than the median-ranked node."""
+        counts = sorted((node[0] for _, node in self._walk()), reverse=True)
+        threshold = counts[self.max_nodes // 2]
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for event_type, child in list(node[3].items()):
+                if child[0] <= threshold:
+                    del node[3][event_type]
+                else:
+                    stack.append(child)
+        self.nodes = sum(1 for _ in self._walk())
+        self.max_undercount += threshold
+
+    def top_paths(self, k=TOP_K_PATHS):
+        """Return the k most common complete paths as export rows."""
+        candidates = []
+        for path, node in self._walk():
+            if node[1]:
+                candidates.append((node[1], ">".join(path), len(path), node[0]))
+            if node[2]:
+                candidates.append((node[2], ">".join(path) + ">...", len(path), node[0]))
+        top = heapq.nsmallest(k, candidates, key=lambda c: (-c[0], c[1]))
+        return [
+            [rank, path, steps, sessions, round(sessions / self.sessions, 6), prefix_sessions,
+             int("transaction" in path), self.max_undercount]
+            for rank, (sessions, path, steps, prefix_sessions) in enumerate(top, start=1)
+        ]
+
+
+def scan(con):
+    """Scan funnel_steps once and build the path trie and latency sketches.
+
+    Returns:
+        (trie, sku_sketches, cohort_sketches) where the sketch dicts map
+        (sku or cohort_month, metric) to a QuantileSketch
+    """
+    trie = PathTrie()
+    sku_sketches = {}
+    cohort_sketches = {}
+
+    def sketch(sketches, key):
+        if key not in sketches:
+            sketches[key] = QuantileSketch()
+        return sketches[key]
+
+    session = None
+    cursor = con.execute(SCAN_SQL)
+    while True:
+        rows = cursor.fetchmany(SCAN_BATCH_ROWS)
+        for session_id, ts, event_type, sku, cohort_month in rows:
+            if session_id != session:
+                if session is not None:
+                    trie.add(path)
+                session = session_id
+                path, start = [], ts
+                first_view, converted = {}, set()
+                carted = purchased = False
+            path.append(event_type)
+            if event_type == "view":
+                first_view.setdefault(sku, ts)
+                continue
+            metric = "view_to_cart" if event_type == "addtocart" else "view_to_purchase"
+            if sku in first_view and (sku, metric) not in converted:
+                converted.add((sku, metric))
+                sketch(sku_sketches, (sku, metric)).add(ts - first_view[sku])
+            if event_type == "addtocart" and not carted:
+                carted = True
+                sketch(cohort_sketches, (cohort_month, "session_to_cart")).add(ts - start)
+            elif event_type == "transaction" and not purchased:
+                purchased = True
+                sketch(cohort_sketches, (cohort_month, "session_to_purchase")).add(ts - start)
+        if not rows:
+            break
+    if session is not None:
+        trie.add(path)
+    return trie, sku_sketches, cohort_sketches
+
+
+def _write_csv(name, header, rows, started, approximate):
+    """Write an artifact CSV and its sidecar metadata; returns the export metadata."""
+    path = ARTIFACTS / name
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    meta = {
+        "file": name,
+        "rows": len(rows),
+        "bytes": path.stat().st_size,
+        "seconds": round(time.perf_counter() - started, 4),
+        "approximate": approximate
+    }
+    write_artifact_meta(path, **meta)
+    print(f"✅ Exported {len(rows)} rows to {path}")
+    return meta
+
+
+def run_paths(con):
+    """Build and export session paths and time-to-convert quantiles.
+
+    Args:
+        con: Warehouse connection/cursor (read-only is fine)
+
+    Returns:
+        List of export metadata dicts ({"file", "rows", "bytes", "seconds",
+        "approximate"}), one per file in OUTPUT_FILES
+    """
+    started = time.perf_counter()
+    trie, sku_sketches, cohort_sketches = scan(con)
+
+    overall = {}
+    for (cohort_month, metric), sk in cohort_sketches.items():
+        overall.setdefault(metric, QuantileSketch()).merge(sk)
+    cohort_rows = sorted(cohort_sketches.items()) + [(("all", metric), sk) for metric, sk in sorted(overall.items())]
+
+    stats = ["samples", "mean_seconds", *(f"p{round(q * 100)}_seconds" for q in QUANTILES)]
+    ARTIFACTS.mkdir(parents=True, exist_ok=True)
+    return [
+        _write_csv(OUTPUT_FILES[0],
+                   ["rank", "path", "steps", "sessions", "share_of_sessions", "prefix_sessions",
+                    "has_purchase", "max_undercount"],
+                   trie.top_paths(), started, approximate=trie.max_undercount > 0),
+        _write_csv(OUTPUT_FILES[1], ["sku", "metric", *stats],
+                   [[sku, metric, *sk.summary()] for (sku, metric), sk in sorted(sku_sketches.items())],
+                   started, approximate=True),
+        _write_csv(OUTPUT_FILES[2], ["cohort_month", "metric", *stats],
+                   [[cohort_month, metric, *sk.summary()] for (cohort_month, metric), sk in cohort_rows],
+                   started, approximate=True),
+    ]
@@ -0,0 +1,276 @@
+"""
+Preview runs on a deterministic sample of users.
+
+A preview loads only the users whose hash(user_id) falls in the first
+`rate` share of SAMPLE_BUCKETS buckets, so the same users are kept on every
+run and smaller samples are subsets of larger ones (1% ⊂ 5% ⊂ 10%). Whole
+users are kept, so their sessions and purchase cohorts are complete. The
+sample is sessionized, rolled up and run through every SQL report on an
+in-memory DuckDB connection; the warehouse and the full artifacts are never
+touched.
+
+Results are population estimates: counts are divided by the sampling rate
+(Horvitz-Thompson), and conversion rates are ratio estimates. Both come
+with 95% confidence intervals that treat users as the sampling unit, so
+the correlation between a user's events is accounted for. The SQL reports
+scale their own counts by 1/rate through the report_scale() macro (see
+run_analytics.py), so report thresholds apply to the estimates. The funnel
+config is applied to the sample only; the process-wide config the ETL and
+server use is left alone.
+
+Output goes to artifacts/preview/ (report CSVs plus preview_summary.json):
+
+    python app/preview.py --sample 5%
+"""
+import sys
+import json
+import math
+import argparse
+import datetime as dt
+import duckdb
+import instrument
+import funnels
+from instrument import stage
+from etl_funnel import load_events, steps_sql, session_flags_sql
+from rollups import build_rollups
+from run_analytics import discover_reports, execution_waves, run_sql_query
+from utils import (ARTIFACTS, connect, get_events_file, validate_data_directory, funnel_metrics,
+                   write_json_atomic, report_progress, add_runtime_args, configure_runtime_from_args)
+
+PREVIEW_DIR = ARTIFACTS / "preview"
+PREVIEW_SUMMARY = PREVIEW_DIR / "preview_summary.json"
+
+# Users are hashed into this many buckets; a rate keeps the first rate * N
+SAMPLE_BUCKETS = 10000
+
+# Two-sided 95% normal quantile
+Z_95 = 1.959964
+
+
+def parse_rate(value):
+    """Parse a sampling rate such as 0.05, '5%' or '0.05'.
+
+    Raises:
+        ValueError: If the rate is not in (0, 1] or is finer than one bucket
+    """
+    text = str(value).strip()
+    try:
+        rate = float(text[:-1]) / 100 if text.endswith("%") else float(text)
+    except ValueError:
+        raise ValueError(f"Invalid sample rate {value!r}; use e.g. 0.05 or 5%")
+    if not 0 < rate <= 1 or round(rate * SAMPLE_BUCKETS) < 1:
+        raise ValueError(f"Sample rate must be between {1 / SAMPLE_BUCKETS:g} and 1, got {value!r}")
+    return round(rate * SAMPLE_BUCKETS) / SAMPLE_BUCKETS
+
+
+def sample_predicate(rate):
+    """SQL condition keeping the users of a `rate` sample."""
+    return f"hash(user_id) % {SAMPLE_BUCKETS} < {round(rate * SAMPLE_BUCKETS)}"
+
+
+def _total(total, squares, rate):
+    """Horvitz-Thompson estimate of a total and its 95% interval."""
+    estimate = total / rate
+    half = Z_95 * math.sqrt(max(0.0, (1 - rate) * squares)) / rate
+    return estimate, [max(0.0, estimate - half), estimate + half]
+
+
+def _ratio(y, x, yy, xx, xy, rate):
+    """Ratio estimate y/x (as a percentage) and its linearized 95% interval."""
+    if not x:
+        return None, None
+    ratio = y / x
+    residual = max(0.0, yy - 2 * ratio * xy + ratio * ratio * xx)
+    half = Z_95 * math.sqrt((1 - rate) * residual) / x
+    return ratio * 100, [max(0.0, ratio - half) * 100, (ratio + half) * 100]
+
+
+def estimate_metrics(con, rate):
+    """Scale the sampled funnel totals to the population with 95% intervals.
+
+    One aggregation over funnel_steps collects per-user totals (views,
+    carts and purchases count sessions with such an event, as in
+    funnel_totals) and the sums of squares/products the variance estimates
+    need.
+
+    Returns:
+        (metrics, intervals, sampled_users): metrics in the funnel_metrics
+        shape, intervals as {metric: [low, high]}
+    """
+    (users, sessions, steps, views, carts, purchases,
+     ss, tt, vv, cc, pp, vc, cp) = con.execute("""
+    WITH s AS (
+      SELECT user_id, session_id, COUNT(*) AS steps,
+             BOOL_OR(event_type = 'view')::INTEGER AS views,
+             BOOL_OR(event_type = 'addtocart')::INTEGER AS carts,
+             BOOL_OR(event_type = 'transaction')::INTEGER AS purchases
+      FROM funnel_steps
+      GROUP BY 1, 2
+    ),
+    u AS (
+      SELECT user_id, COUNT(*) AS sessions, SUM(steps) AS steps,
+             SUM(views) AS views, SUM(carts) AS carts, SUM(purchases) AS purchases
+      FROM s
+      GROUP BY 1
+    )
+    SELECT COUNT(*), COALESCE(SUM(sessions), 0), COALESCE(SUM(steps), 0),
+           COALESCE(SUM(views), 0), COALESCE(SUM(carts), 0), COALESCE(SUM(purchases), 0),
+           COALESCE(SUM(sessions::DOUBLE * sessions), 0), COALESCE(SUM(steps::DOUBLE * steps), 0),
+           COALESCE(SUM(views::DOUBLE * views), 0), COALESCE(SUM(carts::DOUBLE * carts), 0),
+           COALESCE(SUM(purchases::DOUBLE * purchases), 0),
+           COALESCE(SUM(views::DOUBLE * carts), 0), COALESCE(SUM(carts::DOUBLE * purchases), 0)
+    FROM u
+    """).fetchone()
+
+    intervals = {}
+    totals = {}
+    for name, total, squares in (("session_count", sessions, ss), ("steps_count", steps, tt),
+                                 ("views", views, vv), ("carts", carts, cc), ("purchases", purchases, pp)):
+        value, intervals[name] = _total(total, squares, rate)
+        totals[name] = round(value)
+    metrics = funnel_metrics(totals["session_count"], totals["steps_count"],
+                             totals["views"], totals["carts"], totals["purchases"])
+    # Rates come from the sample itself (scaling cancels out)
+    for name, args in (("view_to_cart_rate", (carts, views, cc, vv, vc)),
+                       ("cart_to_purchase_rate", (purchases, carts, pp, cc, cp))):
+        value, interval = _ratio(*args, rate)
+        if value is not None:
+            metrics[name] = value
+            intervals[name] = interval
+    return metrics, intervals, users
+
+
+def run_preview(rate, profile=None, funnel_config=None):
+    """Run the ETL and all SQL reports on a user sample and return the summary.
+
+    Args:
+        rate: Share of users to keep (see parse_rate)
+        profile: Store full DuckDB operator trees in the run record
+        funnel_config: Path of a JSON session/funnel config (see funnels.py)
+
+    Returns:
+        Dict with sample_rate, sampled_users, metrics (population estimates),
+        intervals (95% CIs), reports (export metadata) and run_id; also
+        written to artifacts/preview/preview_summary.json
+
+    Raises:
+        FileNotFoundError: If the raw events file is missing
+        ValueError: If the rate or funnel config is invalid
+        duckdb.Error: If a query fails
+    """
+    rate = parse_rate(rate)
+    params = {"sample_rate": rate, "funnel_config": funnel_config}
+    with instrument.run("preview", params, full_profile=profile) as recorder:
+        with stage("validate_input", progress=0.0):
+            validate_data_directory()
+            config = funnels.load_config(funnel_config)
+        recorder.record["params"]["session_gap_minutes"] = config["session_gap_minutes"]
+        events_file = get_events_file()
+        PREVIEW_DIR.mkdir(parents=True, exist_ok=True)
+
+        con = connect()
+        # Reports are exported in their ORDER BY order
+        con.execute("SET preserve_insertion_order = true;")
+        con = recorder.wrap(con)
+        try:
+            print(f"Loading a {rate:.2%} user sample from {events_file}...")
+            with stage("load", progress=0.05) as st:
+                st["rows_out"] = load_events(con, "events", events_file, where=sample_predicate(rate))
+            with stage("sessionize", progress=0.3, rows_in=st["rows_out"]) as st:
+                st["rows_out"] = con.execute(
+                    f"CREATE TABLE funnel_steps AS {steps_sql('events', gap_minutes=config['session_gap_minutes'])};"
+                ).fetchone()[0]
+            with stage("flags", progress=0.45, rows_in=st["rows_out"]) as st:
+                st["rows_out"] = con.execute(
+                    f"CREATE TABLE funnel_session AS {session_flags_sql('funnel_steps')};"
+                ).fetchone()[0]
+            with stage("rollups", progress=0.55):
+                build_rollups(con)
+
+            with stage("estimate", progress=0.65):
+                metrics, intervals, users = estimate_metrics(con, rate)
+
+            reports = discover_reports()
+            exports = []
+            for wave in execution_waves(reports):
+                for name in wave:
+                    report = reports[name]
+                    with stage(f"report.{name}", progress=0.7 + 0.3 * len(exports) / len(reports)) as st:
+                        meta = run_sql_query(report["sql_file"], report["output_file"], con=con,
+                                             output_dir=PREVIEW_DIR, scale=1 / rate)
+                        st["rows_out"] = meta["rows"]
+                    exports.append({**meta, "scale": 1 / rate})
+        finally:
+            con.unwrap().close()
+
+        summary = {
+            "generated_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            "sample_rate": rate,
+            "sampled_users": users,
+            "metrics": metrics,
+            "intervals": intervals,
+            "reports": exports,
+            "run_id": recorder.run_id,
+        }
+        write_json_atomic(PREVIEW_SUMMARY, summary)
+        recorder.record["metrics"] = metrics
+        report_progress("done", 1.0, metrics=metrics, run_id=recorder.run_id)
+        return summary
+
+
+def read_summary():
+    """Return the last preview summary, or None if there is none."""
+    if not PREVIEW_SUMMARY.exists():
+        return None
+    try:
+        return json.loads(PREVIEW_SUMMARY.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Run the pipeline and reports on a deterministic user sample.")
+    parser.add_argument(
+        "--sample", default="5%",
+        help="Share of users to keep, e.g. 1%%, 5%%, 0.1 (default: 5%%)"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", default=None,
+        help="Store full DuckDB query plans in the run record (env: FUNNEL_PROFILE=1)"
+    )
+    parser.add_argument(
+        "--funnel-config",
+        help=f"JSON session/funnel config (env: {funnels.CONFIG_ENV}; see funnels.py)"
+    )
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run a sampled preview and print the estimates."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+    try:
+        summary = run_preview(args.sample, profile=args.profile, funnel_config=args.funnel_config)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except duckdb.Error as e:
+        print(f"❌ DuckDB Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    metrics, intervals = summary["metrics"], summary["intervals"]
+    print(f"\n✅ Preview of {summary['sample_rate']:.2%} of users ({summary['sampled_users']:,} users)")
+    for name in ("session_count", "steps_count", "views", "carts", "purchases"):
+        low, high = intervals[name]
+        print(f"  {name}: ~{metrics[name]:,} (95% CI {low:,.0f} - {high:,.0f})")
+    for name in ("view_to_cart_rate", "cart_to_purchase_rate"):
+        if name in metrics:
+            low, high = intervals[name]
+            print(f"  {name}: {metrics[name]:.2f}% (95% CI {low:.2f}% - {high:.2f}%)")
+    print(f"Preview artifacts: {PREVIEW_DIR}")
+
+
+if __name__ == "__main__":
+    main()
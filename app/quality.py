@@ -0,0 +1,134 @@
+"""
+Data-quality checks run after every ETL build.
+
+All checks share one fused aggregation pass over funnel_steps (every event
+appears there exactly once), nested so the table is scanned a single time:
+
+1. GROUP BY (user_id, sku, ts, event_type) collapses exact duplicate events
+2. GROUP BY (user_id, sku) flags purchases of a SKU the user never viewed
+3. One final row with the totals
+
+The rest are by-products of earlier stages: orphaned SKUs come from the
+rollup_sku_daily rollup, late (out-of-order) events are counted in file
+order when rows are loaded and merged (etl_manifest.late_events, the same
+count for full, chunked and incremental builds), and the events row count
+comes from table metadata.
+
+The report is written to artifacts/data_quality.json and served by
+/api/pipeline/quality.
+"""
+import json
+import datetime as dt
+from utils import ARTIFACTS, write_json_atomic
+
+QUALITY_REPORT = ARTIFACTS / "data_quality.json"
+
+# Check name -> (severity when the count is non-zero, description)
+CHECKS = {
+    "null_timestamps": ("warn", "Events whose timestamp could not be parsed"),
+    "duplicate_events": ("warn", "Extra copies of events with identical user, SKU, timestamp and type"),
+    "out_of_order_events": ("warn", "Events that come after a later event of the same user in file order"),
+    "purchases_without_views": ("warn", "Purchase events of a SKU the user never viewed"),
+    "orphaned_skus": ("warn", "SKUs with cart or purchase events but no views at all"),
+    "steps_events_mismatch": ("fail", "Difference between events and funnel_steps row counts"),
+    "rollup_drift": ("fail", "Difference between funnel_steps rows and the rollup_session_daily step total"),
+}
+
+# Severity ordering for the overall report status
+SEVERITY = ("pass", "warn", "fail")
+
+
+def quality_sql():
+    """Build the single SELECT computing every raw check count."""
+    return """
+    WITH distinct_events AS (
+      SELECT user_id, sku, ts, event_type, COUNT(*) AS copies
+      FROM funnel_steps
+      GROUP BY ALL
+    ),
+    user_skus AS (
+      SELECT user_id, sku,
+             SUM(copies) AS steps,
+             SUM(copies - 1) AS duplicates,
+             SUM(copies) FILTER (WHERE ts IS NULL) AS null_ts,
+             BOOL_OR(event_type = 'view') AS viewed,
+             SUM(copies) FILTER (WHERE event_type = 'transaction') AS purchases
+      FROM distinct_events
+      GROUP BY ALL
+    ),
+    skus AS (
+      SELECT sku, SUM(views) AS views, SUM(carts + purchases) AS conversions
+      FROM rollup_sku_daily
+      GROUP BY 1
+    )
+    SELECT COALESCE(SUM(steps), 0),
+           COALESCE(SUM(duplicates), 0),
+           COALESCE(SUM(null_ts), 0),
+           COALESCE(SUM(purchases) FILTER (WHERE NOT viewed), 0),
+           COUNT(*) FILTER (WHERE purchases > 0 AND NOT viewed),
+           (SELECT COUNT(*) FROM skus WHERE views = 0 AND conversions > 0),
+           (SELECT COALESCE(SUM(conversions), 0) FROM skus WHERE views = 0),
+           (SELECT COUNT(*) FROM events),
+           (SELECT COALESCE(SUM(steps), 0) FROM rollup_session_daily)
+    FROM user_skus
+    """
+
+
+def _check(name, count, **detail):
+    severity, description = CHECKS[name]
+    return {
+        "count": count,
+        "status": "pass" if not count else severity,
+        "description": description,
+        **detail,
+    }
+
+
+def run_checks(con, late_events=0):
+    """Run all data-quality checks and return the report.
+
+    Args:
+        con: Warehouse connection/cursor
+        late_events: Out-of-order events recorded when the rows were
+            loaded (see etl_manifest.late_events)
+
+    Returns:
+        Dict with generated_at, status (worst check status), counts and
+        checks ({name: {"count", "status", "description", ...}})
+    """
+    (steps, duplicates, null_ts, purchases_without_view, pairs_without_view,
+     orphaned_skus, orphaned_events, events, rollup_steps) = (
+        int(value) for value in con.execute(quality_sql()).fetchone()
+    )
+    checks = {
+        "null_timestamps": _check("null_timestamps", null_ts),
+        "duplicate_events": _check("duplicate_events", duplicates),
+        "out_of_order_events": _check("out_of_order_events", int(late_events or 0)),
+        "purchases_without_views": _check("purchases_without_views", purchases_without_view,
+                                          user_sku_pairs=pairs_without_view),
+        "orphaned_skus": _check("orphaned_skus", orphaned_skus, events=orphaned_events),
+        "steps_events_mismatch": _check("steps_events_mismatch", abs(events - steps)),
+        "rollup_drift": _check("rollup_drift", abs(steps - rollup_steps)),
+    }
+    return {
+        "generated_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "status": max((c["status"] for c in checks.values()), key=SEVERITY.index),
+        "counts": {"events": events, "steps": steps},
+        "checks": checks,
+    }
+
+
+def write_report(report, path=QUALITY_REPORT):
+    """Write the data-quality report as JSON."""
+    write_json_atomic(path, report)
+
+
+def read_report(path=QUALITY_REPORT):
+    """Return the last data-quality report, or None if there is none."""
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
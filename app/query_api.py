@@ -0,0 +1,258 @@
+"""
+Parameterized ad-hoc funnel queries for the API server.
+
+Analysts slice funnel_steps by date window, SKU list, event type and purchase
+cohort without writing a new .sql file. Filters are typed and validated, the
+SQL is built from a fixed whitelist with bound parameters, and results are
+kept in an LRU cache keyed on the normalized parameters plus the warehouse
+data version so repeated dashboard queries never reach DuckDB.
+
+Queries with a start/end window read only the month partitions that overlap
+it (see partitions.py), falling back to the warehouse table when no
+partitions have been written.
+"""
+import json
+import datetime as dt
+import threading
+from collections import OrderedDict
+import partitions
+from utils import WAREHOUSE, EVENT_TYPES, file_signature
+
+# group_by dimension -> SQL expression over funnel_steps (alias fs)
+GROUP_BY = {
+    "day": "CAST(DATE_TRUNC('day', fs.ts) AS DATE)",
+    "week": "CAST(DATE_TRUNC('week', fs.ts) AS DATE)",
+    "month": "CAST(DATE_TRUNC('month', fs.ts) AS DATE)",
+    "sku": "fs.sku",
+    "event_type": "fs.event_type",
+    "cohort_month": "c.cohort_month",
+}
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache."""
+
+    def __init__(self, maxsize=256):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value or None."""
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        """Insert a value, evicting the least recently used entry if full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _parse_date(value, name):
+    try:
+        return dt.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an ISO date (YYYY-MM-DD), got {value!r}")
+
+
+def _parse_list(values):
+    """Accept repeated query args and/or comma-separated values."""
+    items = []
+    for value in values:
+        items.extend(v.strip() for v in str(value).split(",") if v.strip())
+    return sorted(set(items))
+
+
+def normalize_params(args):
+    """Validate query-string arguments into a canonical params dict.
+
+    Args:
+        args: Mapping with getlist() (e.g. Flask request.args)
+
+    Returns:
+        Dict with start/end (ISO dates or None), skus, event_types,
+        cohort_months, group_by, limit and offset
+
+    Raises:
+        ValueError: If any filter is malformed
+    """
+    start = args.get("start")
+    end = args.get("end")
+    start = _parse_date(start, "start") if start else None
+    end = _parse_date(end, "end") if end else None
+    if start and end and start > end:
+        raise ValueError("start must be on or before end")
+
+    event_types = _parse_list(args.getlist("event_type"))
+    unknown = set(event_types) - set(EVENT_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown event_type(s): {', '.join(sorted(unknown))}")
+
+    try:
+        skus = sorted({int(sku) for sku in _parse_list(args.getlist("sku"))})
+    except ValueError:
+        raise ValueError("sku must be an integer item id")
+    
+    cohort_months = [
+        _parse_date(m if len(m) > 7 else f"{m}-01", "cohort").replace(day=1).isoformat()
+        for m in _parse_list(args.getlist("cohort"))
+    ]
+
+    group_by = args.get("group_by", "day")
+    if group_by not in GROUP_BY:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUP_BY)}")
+
+    try:
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+        offset = int(args.get("offset", 0))
+    except ValueError:
+        raise ValueError("limit and offset must be integers")
+    if not 1 <= limit <= MAX_LIMIT or offset < 0:
+        raise ValueError(f"limit must be 1-{MAX_LIMIT} and offset >= 0")
+
+    return {
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "skus": skus,
+        "event_types": event_types,
+        "cohort_months": sorted(set(cohort_months)),
+        "group_by": group_by,
+        "limit": limit,
+        "offset": offset,
+    }
+
+
+def build_query(params):
+    """Build the funnel slice SQL and its bind parameters.
+
+    Dates are inclusive: end=2015-06-30 covers the whole of that day. A
+    windowed query scans only the overlapping month partitions.
+    """
+    source, binds = steps_source(params["start"], params["end"])
+    where = []
+    if params["start"]:
+        where.append("fs.ts >= CAST(? AS DATE)")
+        binds.append(params["start"])
+    if params["end"]:
+        where.append("fs.ts < CAST(? AS DATE) + INTERVAL 1 DAY")
+        binds.append(params["end"])
+    if params["skus"]:
+        where.append(f"fs.sku IN ({', '.join('?' for _ in params['skus'])})")
+        binds.extend(params["skus"])
+    if params["event_types"]:
+        where.append(f"fs.event_type IN ({', '.join('?' for _ in params['event_types'])})")
+        binds.extend(params["event_types"])
+
+    needs_cohort = params["cohort_months"] or params["group_by"] == "cohort_month"
+    cohort_join = ""
+    if needs_cohort:
+        cohort_join = """
+        LEFT JOIN (
+          SELECT user_id, CAST(MIN(month_active) AS DATE) AS cohort_month
+          FROM rollup_purchaser_month GROUP BY 1
+        ) c USING (user_id)"""
+    if params["cohort_months"]:
+        where.append(f"c.cohort_month IN ({', '.join('CAST(? AS DATE)' for _ in params['cohort_months'])})")
+        binds.extend(params["cohort_months"])
+
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    sql = f"""
+    SELECT {GROUP_BY[params['group_by']]} AS group_key,
+           COUNT(*) AS events,
+           COUNT(DISTINCT fs.user_id) AS users,
+           COUNT(DISTINCT fs.session_id) AS sessions,
+           COUNT(*) FILTER (WHERE fs.event_type = 'view') AS views,
+           COUNT(*) FILTER (WHERE fs.event_type = 'addtocart') AS carts,
+           COUNT(*) FILTER (WHERE fs.event_type = 'transaction') AS purchases,
+           1.0 * COUNT(*) FILTER (WHERE fs.event_type = 'addtocart')
+               / NULLIF(COUNT(*) FILTER (WHERE fs.event_type = 'view'), 0) AS view_to_cart_rate,
+           1.0 * COUNT(*) FILTER (WHERE fs.event_type = 'transaction')
+               / NULLIF(COUNT(*) FILTER (WHERE fs.event_type = 'addtocart'), 0) AS cart_to_purchase_rate,
+           COUNT(*) OVER () AS total_groups
+    FROM {source} fs{cohort_join}
+    {where_sql}
+    GROUP BY 1
+    ORDER BY 1 NULLS LAST
+    LIMIT {params['limit']} OFFSET {params['offset']}
+    """
+    return sql, binds
+
+
+def steps_source(start, end):
+    """Return the FROM source (and its binds) for funnel_steps over [start, end].
+
+    Unbounded queries read the warehouse table; windowed ones read the
+    overlapping partition files listed in the partition manifest.
+    """
+    if not start and not end:
+        return "funnel_steps", []
+    files = partitions.prune("funnel_steps", start, end)
+    if files is None:
+        return "funnel_steps", []
+    if not files:
+        return "(SELECT * FROM funnel_steps LIMIT 0)", []
+    # Parquet stores the ENUM as text; restore it so grouping/ordering match
+    return """(
+        SELECT * REPLACE (CAST(event_type AS event_type_enum) AS event_type)
+        FROM read_parquet(?, hive_partitioning = false)
+    )""", [files]
+
+
+def data_version():
+    """Return a cheap version token for the warehouse contents.
+
+    Uses the size/mtime of the warehouse file, its WAL and the partition
+    manifest, so any committed write, archival or compaction changes the
+    token without querying DuckDB.
+    """
+    parts = []
+    for path in (WAREHOUSE, WAREHOUSE.with_name(WAREHOUSE.name + ".wal"), partitions.MANIFEST):
+        if path.exists():
+            sig = file_signature(path)
+            parts.append(f"{sig['size']}:{sig['mtime_ns']}")
+    return "|".join(parts)
+
+
+def run_query(con, params, cache):
+    """Run (or serve from cache) a normalized funnel query.
+
+    Returns:
+        (result dict, cached flag)
+    """
+    version = data_version()
+    key = (json.dumps(params, sort_keys=True), version)
+    result = cache.get(key)
+    if result is not None:
+        return result, True
+
+    sql, binds = build_query(params)
+    cursor = con.execute(sql, binds)
+    columns = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+    total_idx = columns.index("total_groups")
+    total = rows[0][total_idx] if rows else 0
+    result = {
+        "columns": [c for c in columns if c != "total_groups"],
+        "rows": [
+            [v.isoformat() if isinstance(v, (dt.date, dt.datetime)) else v
+             for i, v in enumerate(row) if i != total_idx]
+            for row in rows
+        ],
+        "total_groups": total,
+        "data_version": version,
+    }
+    cache.put(key, result)
+    return result, False
@@ -1,40 +1,111 @@
 """
 Execute analytics SQL queries and export results to artifacts.
+
+Every file in sql/ is a report exported to artifacts/<name>.csv. A report
+may declare other reports it must run after with a header comment:
+
+    -- depends: sku_dropoff, cohort_retention
+
+Reports run in dependency waves; reports within a wave run concurrently on
+cursors of one shared warehouse connection. A report is skipped when its SQL
+text, the warehouse data version and its dependencies' fingerprints are
+unchanged since the last run (see artifacts/analytics_manifest.json).
+
+Reports multiply their count columns by report_scale(), a macro defined
+on the report's connection before it runs: 1 for warehouse runs, 1/rate for
+preview runs on a user sample (see preview.py). Scaling inside the report
+keeps thresholds and rankings (e.g. QUALIFY carts >= 50) on the
+population-scale counts.
+
+With --approx-distinct, a report that has a variant in sql/approx/ runs that
+variant instead (same output file and columns, distinct counts estimated
+from the warehouse's HyperLogLog sketches; see rollups.py for the error).
+
+After the SQL reports, one ordered scan of funnel_steps exports the top
+session paths and time-to-convert quantiles (see paths.py); it is skipped
+like a report when the warehouse data and its parameters are unchanged.
 """
+import re
 import sys
+import json
+import time
+import hashlib
+import argparse
 import duckdb
 import pathlib as p
-from utils import ARTIFACTS, PROJECT_ROOT
+import instrument
+import paths
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import (ARTIFACTS, WAREHOUSE, PROJECT_ROOT, connect_warehouse, escape_sql_path,
+                   add_runtime_args, configure_runtime_from_args, report_progress,
+                   file_signature, write_json_atomic, write_artifact_meta)
+
+SQL_DIR = PROJECT_ROOT / "sql"
+
+# Approximate-distinct variants of reports, used with --approx-distinct
+APPROX_SQL_DIR = SQL_DIR / "approx"
 
+# Fingerprints of the last successful run of each report
+ANALYTICS_MANIFEST = ARTIFACTS / "analytics_manifest.json"
 
-def run_sql_query(sql_file, output_file):
-    """Execute a SQL file and export results to CSV.
+# Concurrent reports per dependency wave
+DEFAULT_WORKERS = 4
+
+DEPENDS_RE = re.compile(r"^--\s*depends:\s*(.+)$", re.IGNORECASE)
+
+# Macro reports multiply count columns by (population / sampled)
+SCALE_MACRO = "report_scale"
+
+# Manifest key of the session path / time-to-convert stage (see paths.py)
+PATHS_STAGE = "paths"
+
+
+def split_statements(sql):
+    """Split a SQL script into statements, dropping comment-only lines."""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [s.strip() for s in '\n'.join(lines).split(';') if s.strip()]
+
+
+def run_sql_query(sql_file, output_file, con=None, output_dir=ARTIFACTS, scale=1):
+    """Execute a SQL file against the warehouse and export results to CSV.
     
     Args:
         sql_file: Name of SQL file in sql/ directory
         output_file: Name of output CSV file for artifacts/ directory
+        con: Open warehouse connection/cursor to use; a read-only connection
+            is opened and closed if omitted
+        output_dir: Directory the CSV is written to (default: artifacts/)
+        scale: Value of the report_scale() macro the report multiplies
+            its counts by (1/rate for preview runs on a sample)
         
     Raises:
         FileNotFoundError: If SQL file or required data files are missing
         duckdb.Error: If SQL execution fails
+        
+    Returns:
+        Export metadata: {"file", "rows", "bytes", "seconds"}. The same
+        metadata is written to <output_file>.meta.json for the server.
     """
-    sql_path = PROJECT_ROOT / "sql" / sql_file
-    output_path = ARTIFACTS / output_file
+    sql_path = SQL_DIR / sql_file
+    output_path = p.Path(output_dir) / output_file
     
     if not sql_path.exists():
         raise FileNotFoundError(f"SQL file not found: {sql_path}")
     
     print(f"Executing {sql_file}...")
-    con = None
+    owns_con = con is None
     try:
-        con = duckdb.connect(database=":memory:")
+        if owns_con:
+            con = connect_warehouse(read_only=True)
         
         # Read SQL file
         with open(sql_path, 'r', encoding='utf-8') as f:
             sql = f.read()
         
+        con.execute(f"CREATE OR REPLACE TEMP MACRO {SCALE_MACRO}() AS {float(scale)!r}::DOUBLE;")
+        
         # Split into statements (separated by semicolons)
-        statements = [s.strip() for s in sql.split(';') if s.strip() and not s.strip().startswith('--')]
+        statements = split_statements(sql)
         
         if not statements:
             raise ValueError(f"SQL file {sql_file} is empty or contains no valid statements")
@@ -52,44 +123,280 @@ def run_sql_query(sql_file, output_file):
         if not select_query:
             raise ValueError(f"SQL file {sql_file} contains no SELECT query")
         
-        # Execute query and export (escape single quotes in path for SQL)
-        output_path_escaped = str(output_path).replace("'", "''")
-        con.execute(f"""
+        # Execute query and export once; COPY returns the number of rows written
+        started = time.perf_counter()
+        rows = con.execute(f"""
         COPY (
             {select_query}
-        ) TO '{output_path_escaped}' (HEADER, DELIMITER ',');
-        """)
+        ) TO '{escape_sql_path(output_path)}' (HEADER, DELIMITER ',');
+        """).fetchone()[0]
         
-        # Get row count
-        result = con.execute(f"SELECT COUNT(*) FROM ({select_query})").fetchone()
-        print(f"✅ Exported {result[0]} rows to {output_path}")
+        meta = {
+            "file": output_file,
+            "rows": rows,
+            "bytes": output_path.stat().st_size,
+            "seconds": round(time.perf_counter() - started, 4)
+        }
+        write_artifact_meta(output_path, sql_file=sql_file, **meta)
+        print(f"✅ Exported {rows} rows to {output_path} in {meta['seconds']:.2f}s")
+        return meta
         
     except duckdb.Error as e:
         print(f"❌ DuckDB Error executing {sql_file}: {e}", file=sys.stderr)
         raise
     finally:
-        if con is not None:
+        if owns_con and con is not None:
             con.close()
 
 
-def main():
-    """Run all analytics queries."""
+def discover_reports(sql_dir=SQL_DIR, approx=False):
+    """Find every report in sql/ and its declared dependencies.
+    
+    Args:
+        sql_dir: Directory of report .sql files
+        approx: Use the sql/approx/ variant of a report where one exists
+    
+    Returns:
+        Dict of report name -> {"sql_file", "output_file", "depends", "sql",
+        "approximate"}; sql_file is relative to sql_dir
+        
+    Raises:
+        ValueError: If a report depends on an unknown report
+    """
+    reports = {}
+    for path in sorted(p.Path(sql_dir).glob("*.sql")):
+        variant = p.Path(sql_dir) / APPROX_SQL_DIR.name / path.name
+        approximate = approx and variant.exists()
+        if approximate:
+            path = variant
+        sql = path.read_text(encoding='utf-8')
+        depends = []
+        for line in sql.splitlines():
+            match = DEPENDS_RE.match(line.strip())
+            if match:
+                depends.extend(d.strip().removesuffix(".sql") for d in match.group(1).split(",") if d.strip())
+        reports[path.stem] = {
+            "sql_file": path.relative_to(sql_dir).as_posix(),
+            "output_file": f"{path.stem}.csv",
+            "depends": sorted(set(depends)),
+            "sql": sql,
+            "approximate": approximate
+        }
+    
+    for name, report in reports.items():
+        unknown = [d for d in report["depends"] if d not in reports]
+        if unknown:
+            raise ValueError(f"Report {name} depends on unknown report(s): {', '.join(unknown)}")
+    return reports
+
+
+def execution_waves(reports):
+    """Group reports into waves where each wave only depends on earlier waves.
+    
+    Raises:
+        ValueError: If the dependencies contain a cycle
+    """
+    remaining = {name: set(r["depends"]) for name, r in reports.items()}
+    waves = []
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(f"Dependency cycle between reports: {', '.join(sorted(remaining))}")
+        waves.append(ready)
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return waves
+
+
+def data_version(con):
+    """Return a token that changes whenever the ETL rewrites the warehouse."""
     try:
-        print("Running analytics queries...\n")
+        return str(con.execute("SELECT MAX(updated_at) FROM etl_manifest").fetchone()[0])
+    except duckdb.Error:
+        return json.dumps(file_signature(WAREHOUSE))
+
+
+def report_fingerprint(report, version, dependency_fingerprints):
+    """Hash of the report SQL, the input data version and upstream fingerprints."""
+    digest = hashlib.sha256()
+    digest.update(report["sql"].encode("utf-8"))
+    digest.update(version.encode("utf-8"))
+    for fingerprint in dependency_fingerprints:
+        digest.update(fingerprint.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def paths_fingerprint(version):
+    """Hash of the paths stage parameters and the input data version."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(paths.PARAMS, sort_keys=True).encode("utf-8"))
+    digest.update(version.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _run_paths(con, recorder):
+    """Run the session path / time-to-convert scan on its own profiled cursor."""
+    cursor = recorder.wrap(con.cursor())
+    try:
+        with recorder.stage(f"report.{PATHS_STAGE}") as st:
+            exports = paths.run_paths(cursor)
+            st["rows_out"] = sum(meta["rows"] for meta in exports)
+            st["bytes_out"] = sum(meta["bytes"] for meta in exports)
+        return exports
+    finally:
+        cursor.close()
+
+
+def load_manifest():
+    """Load the analytics manifest (report -> fingerprint/rows), or {}."""
+    try:
+        with open(ANALYTICS_MANIFEST, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _run_on_cursor(con, report, recorder):
+    """Run one report on its own profiled cursor of the shared connection."""
+    cursor = recorder.wrap(con.cursor())
+    try:
+        with recorder.stage(f"report.{report['output_file'].rsplit('.', 1)[0]}",
+                            sql_file=report["sql_file"]) as st:
+            meta = run_sql_query(report["sql_file"], report["output_file"], con=cursor)
+            meta["approximate"] = report["approximate"]
+            st["rows_out"] = meta["rows"]
+            st["bytes_out"] = meta["bytes"]
+        return meta
+    finally:
+        cursor.close()
+
+
+def run_reports(con=None, force=False, workers=DEFAULT_WORKERS, profile=None, approx=False):
+    """Run all analytics reports and return their exports.
+    
+    The run is recorded by the instrument module with one stage per executed
+    report (time, rows, memory and DuckDB query profiles).
+    
+    Args:
+        con: Open warehouse connection/cursor shared by all reports; a
+            read-only connection is opened and closed if omitted
+        force: Re-run reports even if their fingerprint is unchanged
+        workers: Maximum reports executed concurrently within a wave
+        profile: Store full DuckDB operator trees in the run record
+            (default: FUNNEL_PROFILE env)
+        approx: Run the approximate-distinct variants in sql/approx/
+        
+    Returns:
+        List of export metadata dicts ({"file", "rows", "bytes", "seconds",
+        "approximate", "skipped"}), one per report, then one per
+        paths.OUTPUT_FILES artifact
         
-        # Ensure funnel_steps.csv exists
-        funnel_steps_path = ARTIFACTS / "funnel_steps.csv"
-        if not funnel_steps_path.exists():
-            raise FileNotFoundError(
-                f"funnel_steps.csv not found in {ARTIFACTS}. "
-                "Please run 'python src/etl_funnel.py' first."
-            )
+    Raises:
+        FileNotFoundError: If the warehouse or a SQL file is missing
+        ValueError: If report dependencies are invalid
+        duckdb.Error: If a report query fails
+    """
+    # Ensure the ETL has populated the warehouse
+    if not WAREHOUSE.exists():
+        raise FileNotFoundError(
+            f"Warehouse {WAREHOUSE} not found. "
+            "Please run 'python app/etl_funnel.py' first."
+        )
+    
+    params = {"force": force, "workers": workers, "approx": approx}
+    with instrument.run("analytics", params, full_profile=profile) as recorder:
+        reports = discover_reports(approx=approx)
+        waves = execution_waves(reports)
+        manifest = load_manifest()
+        owns_con = con is None
+        if owns_con:
+            con = connect_warehouse(read_only=True)
         
-        # Run SKU drop-off analysis
-        run_sql_query("sku_dropoff.sql", "sku_dropoff.csv")
+        fingerprints = {}
+        exports = {}
+        try:
+            version = data_version(con)
+            for wave in waves:
+                pending = []
+                for name in wave:
+                    report = reports[name]
+                    fingerprint = report_fingerprint(
+                        report, version, [fingerprints[d] for d in report["depends"]]
+                    )
+                    fingerprints[name] = fingerprint
+                    previous = manifest.get(name, {})
+                    if (not force and previous.get("fingerprint") == fingerprint
+                            and (ARTIFACTS / report["output_file"]).exists()):
+                        print(f"⏭️  Skipping {report['sql_file']} (unchanged)")
+                        exports[name] = {**previous.get("export", {}), "file": report["output_file"], "skipped": True}
+                    else:
+                        pending.append(name)
+                
+                with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending) or 1))) as pool:
+                    futures = {pool.submit(_run_on_cursor, con, reports[name], recorder): name for name in pending}
+                    for future in as_completed(futures):
+                        name = futures[future]
+                        meta = future.result()
+                        exports[name] = {**meta, "skipped": False}
+                        manifest[name] = {"fingerprint": fingerprints[name], "export": meta}
+                        report_progress("report", len(exports) / len(reports), file=reports[name]["sql_file"])
+            
+            fingerprint = paths_fingerprint(version)
+            previous = manifest.get(PATHS_STAGE, {})
+            if (not force and previous.get("fingerprint") == fingerprint
+                    and all((ARTIFACTS / f).exists() for f in paths.OUTPUT_FILES)):
+                print("⏭️  Skipping session paths (unchanged)")
+                path_exports = [{**meta, "skipped": True} for meta in previous.get("exports", [])]
+            else:
+                metas = _run_paths(con, recorder)
+                manifest[PATHS_STAGE] = {"fingerprint": fingerprint, "exports": metas}
+                path_exports = [{**meta, "skipped": False} for meta in metas]
+        finally:
+            write_json_atomic(ANALYTICS_MANIFEST, manifest)
+            if owns_con:
+                con.close()
         
-        # Run cohort retention analysis
-        run_sql_query("cohort_retention.sql", "cohort_retention.csv")
+        ordered = [exports[name] for wave in waves for name in wave] + path_exports
+        recorder.record["skipped"] = [name for name, meta in exports.items() if meta["skipped"]]
+        if path_exports and path_exports[0]["skipped"]:
+            recorder.record["skipped"].append(PATHS_STAGE)
+        report_progress("done", 1.0, exports=ordered, run_id=recorder.run_id)
+        return ordered
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Run the analytics SQL reports.")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Re-run every report even if its inputs and SQL are unchanged"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS,
+        help="Reports executed concurrently within a dependency wave"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", default=None,
+        help="Store full DuckDB query plans in the run record (env: FUNNEL_PROFILE=1)"
+    )
+    parser.add_argument(
+        "--approx-distinct", action="store_true",
+        help="Estimate distinct counts from HyperLogLog sketches (reports with a sql/approx/ variant)"
+    )
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run all analytics queries."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+    try:
+        print("Running analytics queries...\n")
+        run_reports(force=args.force, workers=args.workers, profile=args.profile,
+                    approx=args.approx_distinct)
         
         print("\n✅ All analytics queries complete!")
         
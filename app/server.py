@@ -2,22 +2,48 @@
 Backend API server for E-Commerce Revenue Funnel Analyzer UI.
 
 This server provides REST API endpoints for:
-- Pipeline execution (ETL)
-- Analytics query execution
+- Pipeline execution (ETL) as in-process background jobs
+- Analytics query execution as in-process background jobs
+- Job status, progress and cancellation
 - Artifact listing and metadata
+- Streaming artifact downloads (gzip CSV, Parquet, Arrow IPC) with
+  column projection, filters and row ranges
+- Per-stage run metrics (timings, rows, memory, DuckDB profiles)
+- The data-quality report of the last pipeline run
+- The month-partition manifest of funnel_steps/funnel_session
+- Sampled preview runs (population estimates with confidence intervals)
+- Micro-batch event ingestion with live funnel counters
+- ETags/conditional GET (304) and gzip/br compression of polled responses
 
 Run with: python app/server.py
 Access at: http://localhost:5000
 """
 
-import subprocess
+import os
 import json
+import itertools
 import pathlib
-import csv
-from flask import Flask, jsonify, request, send_from_directory
+import duckdb
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 from pathlib import Path
-import sys
+import etl_funnel
+import run_analytics as analytics
+import query_api
+import downloads
+import instrument
+import quality
+import partitions
+import preview
+import ingest
+import httpcache
+import funnels
+import paths
+from jobs import JobManager
+from warehouse import WarehousePool
+from rollups import funnel_totals
+from utils import (ARTIFACTS, WAREHOUSE, WarehouseLockedError, connect, funnel_metrics,
+                   read_artifact_meta, write_artifact_meta, read_summary_cache, write_summary_cache)
 
 # Get project root
 PROJECT_ROOT = Path(__file__).parent.parent.resolve()
@@ -27,142 +53,257 @@ APP_DIR = PROJECT_ROOT / "app"
 
 app = Flask(__name__, static_folder=str(APP_DIR), static_url_path='')
 CORS(app)  # Enable CORS for local development
+app.after_request(httpcache.compress)
 
 # Paths
-ARTIFACTS_DIR = PROJECT_ROOT / "artifacts"
-SCRIPTS_DIR = APP_DIR  # Scripts are now in app/ folder
+ARTIFACTS_DIR = ARTIFACTS
+WAREHOUSE_PATH = WAREHOUSE
 SQL_DIR = PROJECT_ROOT / "sql"
 
+# Background pipeline/analytics jobs
+JOBS = JobManager(max_workers=int(os.environ.get("FUNNEL_JOB_WORKERS", "2")))
+
+# Warm DuckDB cursors on the warehouse, shared by requests and in-process jobs
+WAREHOUSE_POOL = WarehousePool(size=int(os.environ.get("FUNNEL_POOL_SIZE", "4")))
+
+# Results of /api/query/funnel keyed on normalized params + data version
+QUERY_CACHE = query_api.LRUCache(maxsize=int(os.environ.get("FUNNEL_QUERY_CACHE_SIZE", "256")))
+
 
 def count_csv_rows(csv_path):
-    """Count rows in a CSV file (excluding header)."""
+    """Count rows in a CSV file (excluding header).
+    
+    Uses the sidecar metadata written by the pipeline when it is still valid,
+    otherwise counts with DuckDB and caches the result next to the artifact.
+    """
     try:
         if not csv_path.exists():
             return None
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            next(reader, None)  # Skip header
-            return sum(1 for row in reader)
+        meta = read_artifact_meta(csv_path)
+        if meta is not None and meta.get("rows") is not None:
+            return meta["rows"]
+        con = connect()
+        try:
+            rows = con.execute(
+                "SELECT COUNT(*) FROM read_csv(?, header=true, all_varchar=true)",
+                [str(csv_path)]
+            ).fetchone()[0]
+        finally:
+            con.close()
+        write_artifact_meta(csv_path, rows=rows)
+        return rows
     except Exception as e:
         print(f"Error counting rows in {csv_path}: {e}")
         return None
 
 
-def parse_pipeline_metrics(output):
-    """Parse metrics from pipeline stdout."""
-    metrics = {}
-    lines = output.split('\n')
+def query_warehouse_summary():
+    """Compute funnel summary metrics from the warehouse's daily rollups.
     
-    for line in lines:
-        if 'Events loaded:' in line:
-            try:
-                metrics['events_count'] = int(line.split('Events loaded:')[1].split(',')[0].strip())
-            except:
-                pass
-        elif 'Funnel steps:' in line:
-            try:
-                metrics['steps_count'] = int(line.split('Funnel steps:')[1].split(',')[0].strip())
-            except:
-                pass
-        elif 'Sessions created:' in line:
-            try:
-                metrics['session_count'] = int(line.split('Sessions created:')[1].split(',')[0].strip())
-            except:
-                pass
-        elif 'View-to-cart rate:' in line:
-            try:
-                metrics['view_to_cart_rate'] = float(line.split('View-to-cart rate:')[1].split('%')[0].strip())
-            except:
-                pass
-        elif 'Cart-to-purchase rate:' in line:
-            try:
-                metrics['cart_to_purchase_rate'] = float(line.split('Cart-to-purchase rate:')[1].split('%')[0].strip())
-            except:
-                pass
+    Returns None if the warehouse is missing or not yet populated.
+    """
+    if not WAREHOUSE_PATH.exists():
+        return None
+    try:
+        with WAREHOUSE_POOL.cursor() as con:
+            session_count, steps_count, total_views, total_carts, total_purchases = \
+                funnel_totals(con)
+    except duckdb.Error as e:
+        print(f"Error querying warehouse {WAREHOUSE_PATH}: {e}")
+        return None
+    
+    return funnel_metrics(session_count, steps_count, total_views, total_carts, total_purchases)
+
+
+def query_csv_summary():
+    """Compute funnel summary metrics from the CSV artifacts with DuckDB.
     
-    # Also try to read from artifacts if available
+    Returns None if funnel_session.csv is missing or unreadable.
+    """
     funnel_session_path = ARTIFACTS_DIR / "funnel_session.csv"
-    if funnel_session_path.exists():
+    if not funnel_session_path.exists():
+        return None
+    try:
+        con = connect()
         try:
-            with open(funnel_session_path, 'r') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-                if rows:
-                    total_views = sum(int(row.get('has_view', 0)) for row in rows)
-                    total_carts = sum(int(row.get('has_cart', 0)) for row in rows)
-                    total_purchases = sum(int(row.get('has_purchase', 0)) for row in rows)
-                    
-                    if not metrics.get('events_count'):
-                        metrics['events_count'] = len(rows)  # Approximate
-                    if not metrics.get('session_count'):
-                        metrics['session_count'] = len(rows)
-                    
-                    if total_views > 0:
-                        metrics['view_to_cart_rate'] = (total_carts / total_views) * 100
-                    if total_carts > 0:
-                        metrics['cart_to_purchase_rate'] = (total_purchases / total_carts) * 100
-        except Exception as e:
-            print(f"Error reading funnel_session.csv: {e}")
+            session_count, total_views, total_carts, total_purchases = con.execute("""
+                SELECT COUNT(*), COALESCE(SUM(has_view), 0),
+                       COALESCE(SUM(has_cart), 0), COALESCE(SUM(has_purchase), 0)
+                FROM read_csv(?, header=true)
+            """, [str(funnel_session_path)]).fetchone()
+        finally:
+            con.close()
+    except duckdb.Error as e:
+        print(f"Error reading funnel_session.csv: {e}")
+        return None
     
+    # Approximate events count from steps file
+    steps_count = count_csv_rows(ARTIFACTS_DIR / "funnel_steps.csv")
+    metrics = funnel_metrics(session_count, steps_count, total_views, total_carts, total_purchases)
+    if steps_count is None:
+        metrics.pop('steps_count')
+        metrics.pop('events_count')
     return metrics
 
 
+def get_summary_metrics():
+    """Return funnel summary metrics, cheapest source first.
+    
+    Order: the pipeline's summary cache (valid while the warehouse file is
+    unchanged), an aggregate over the warehouse (which refreshes the cache),
+    then an aggregate over the CSV artifacts. Returns None if nothing exists.
+    """
+    metrics = read_summary_cache()
+    if metrics is not None:
+        return metrics
+    
+    metrics = query_warehouse_summary()
+    if metrics is not None:
+        try:
+            write_summary_cache(metrics)
+        except OSError as e:
+            print(f"Error writing summary cache: {e}")
+        return metrics
+    
+    return query_csv_summary()
+
+
+def flush_stream(rows, blocking=True):
+    """Merge closed streamed sessions into the warehouse and refresh the summary cache.
+    
+    Holds the warehouse job lock, so flushes wait for pipeline runs.
+    
+    Raises:
+        ingest.FlushBusyError: If blocking is False and a job holds the lock
+    """
+    lock = JOBS.artifact_lock("warehouse")
+    if not lock.acquire(blocking=blocking):
+        raise ingest.FlushBusyError("A pipeline job is writing the warehouse; retry the flush once it finishes")
+    try:
+        with WAREHOUSE_POOL.writer() as con:
+            ingest.merge_events(con, rows, gap_minutes=LIVE_FUNNEL.gap_minutes)
+            metrics = funnel_metrics(*funnel_totals(con))
+    finally:
+        lock.release()
+    partitions.mark_stale()
+    write_summary_cache(metrics)
+
+
+# Open-session state of streamed events (POST /api/events); the session gap
+# comes from the funnel config (FUNNEL_CONFIG) loaded once at server start
+LIVE_FUNNEL = ingest.LiveFunnel(flush_stream, gap_minutes=funnels.load_config()["session_gap_minutes"])
+
+
+def with_live_counters(metrics):
+    """Add the streamed sessions not yet flushed to the warehouse to summary metrics."""
+    live = LIVE_FUNNEL.live_counters()
+    if not live["sessions"]:
+        return metrics
+    base = metrics or {}
+    return funnel_metrics(
+        base.get("session_count", 0) + live["sessions"],
+        base.get("steps_count", 0) + live["steps"],
+        base.get("views", 0) + live["views"],
+        base.get("carts", 0) + live["carts"],
+        base.get("purchases", 0) + live["purchases"]
+    )
+
+
+def summary_etag():
+    """ETag of /api/pipeline/summary from the versions of everything it reads."""
+    return httpcache.make_etag(
+        "summary",
+        query_api.data_version(),
+        [httpcache.file_version(ARTIFACTS_DIR / f) for f in ("funnel_session.csv", "funnel_steps.csv")],
+        LIVE_FUNNEL.live_counters()
+    )
+
+
 @app.route('/')
 def index():
     """Serve index.html."""
     return send_from_directory(str(APP_DIR), 'index.html')
 
 
+def report_outputs():
+    """Artifact names of every analytics report in sql/ and of the paths stage."""
+    return [r["output_file"] for r in analytics.discover_reports().values()] + list(paths.OUTPUT_FILES)
+
+
+def job_accepted(job, created):
+    """Build the 202 response for a submitted (or de-duplicated) job."""
+    return jsonify({
+        "status": "accepted",
+        "deduplicated": not created,
+        "job": job
+    }), 202
+
+
+def pipeline_job(ctx, params):
+    """Run the ETL in-process on a pooled warehouse cursor."""
+    with WAREHOUSE_POOL.writer() as con:
+        ctx.on_cancel(con.interrupt)
+        metrics = etl_funnel.run_pipeline(
+            incremental=params["incremental"],
+            shards=params["shards"],
+            chunk_size=params["chunk_size"],
+            export=params["csv"],
+            con=con
+        )
+    return {"metrics": metrics, "run_id": instrument.last_run_id()}
+
+
+def preview_job(ctx, params):
+    """Run the ETL and reports on a user sample in memory (no warehouse lock)."""
+    return preview.run_preview(params["sample"])
+
+
+def analytics_job(ctx, params):
+    """Run the analytics reports in-process on a pooled warehouse cursor."""
+    with WAREHOUSE_POOL.cursor() as con:
+        ctx.on_cancel(con.interrupt)
+        exports = analytics.run_reports(con=con, approx=params["approx_distinct"])
+    return {"exports": exports, "run_id": instrument.last_run_id()}
+
+
 @app.route('/api/pipeline/run', methods=['POST'])
 def run_pipeline():
-    """Execute ETL pipeline."""
+    """Queue an ETL pipeline run; returns a job id immediately.
+    
+    JSON body (optional): {"sample": "5%"} queues a preview on a
+    deterministic user sample instead (estimates in seconds, see preview.py);
+    omit it for the full run.
+    """
     try:
-        # Run pipeline script
-        script_path = SCRIPTS_DIR / "etl_funnel.py"
-        if not script_path.exists():
-            return jsonify({
-                "status": "error",
-                "error_code": "FileNotFoundError",
-                "message": f"Pipeline script not found: {script_path}"
-            }), 404
-        
-        result = subprocess.run(
-            [sys.executable, str(script_path)],
-            cwd=str(PROJECT_ROOT),
-            capture_output=True,
-            text=True,
-            timeout=300  # 5 minute timeout
-        )
-        
-        if result.returncode != 0:
-            error_msg = result.stderr or result.stdout or "Unknown error"
-            return jsonify({
-                "status": "error",
-                "error_code": "ExecutionError",
-                "message": error_msg[:500]  # Limit error message length
-            }), 500
+        options = request.get_json(silent=True) or {}
+        if options.get("sample") is not None:
+            params = {"sample": preview.parse_rate(options["sample"])}
+            job, created = JOBS.submit(
+                "preview", lambda ctx: preview_job(ctx, params),
+                artifacts=["preview"], params=params
+            )
+            return job_accepted(job, created)
         
-        # Parse metrics from output
-        metrics = parse_pipeline_metrics(result.stdout)
+        params = {
+            "incremental": bool(options.get("incremental", False)),
+            "shards": int(options.get("shards", 1)),
+            "chunk_size": etl_funnel.parse_size(options.get("chunk_size", etl_funnel.DEFAULT_CHUNK_SIZE)),
+            "csv": None if options.get("csv") is None else bool(options["csv"])
+        }
         
-        return jsonify({
-            "status": "success",
-            "metrics": metrics
-        })
+        job, created = JOBS.submit(
+            "pipeline", lambda ctx: pipeline_job(ctx, params),
+            artifacts=["warehouse", "funnel_session.csv", "funnel_steps.csv"],
+            params=params
+        )
+        return job_accepted(job, created)
     
-    except subprocess.TimeoutExpired:
+    except (TypeError, ValueError) as e:
         return jsonify({
             "status": "error",
-            "error_code": "TimeoutError",
-            "message": "Pipeline execution timed out after 5 minutes"
-        }), 500
-    
-    except FileNotFoundError as e:
-        return jsonify({
-            "status": "error",
-            "error_code": "FileNotFoundError",
-            "message": f"Required file not found: {str(e)}"
-        }), 404
+            "error_code": "ValueError",
+            "message": f"Invalid pipeline options: {e}"
+        }), 400
     
     except Exception as e:
         return jsonify({
@@ -174,95 +315,111 @@ def run_pipeline():
 
 @app.route('/api/analytics/run', methods=['POST'])
 def run_analytics():
-    """Execute analytics queries."""
+    """Queue the analytics queries; returns a job id immediately.
+    
+    JSON body (optional): {"approx_distinct": true} runs the approximate
+    (HyperLogLog) variants of reports that have one.
+    """
     try:
-        # Check prerequisite
-        funnel_steps_path = ARTIFACTS_DIR / "funnel_steps.csv"
-        if not funnel_steps_path.exists():
-            return jsonify({
-                "status": "error",
-                "error_code": "FileNotFoundError",
-                "message": "funnel_steps.csv not found. Please run the pipeline first."
-            }), 404
+        options = request.get_json(silent=True) or {}
+        params = {"approx_distinct": bool(options.get("approx_distinct", False))}
         
-        # Run analytics script
-        script_path = SCRIPTS_DIR / "run_analytics.py"
-        if not script_path.exists():
+        # Check prerequisite
+        if not WAREHOUSE_PATH.exists():
             return jsonify({
                 "status": "error",
                 "error_code": "FileNotFoundError",
-                "message": f"Analytics script not found: {script_path}"
+                "message": "Warehouse not found. Please run the pipeline first."
             }), 404
         
-        result = subprocess.run(
-            [sys.executable, str(script_path)],
-            cwd=str(PROJECT_ROOT),
-            capture_output=True,
-            text=True,
-            timeout=300  # 5 minute timeout
+        job, created = JOBS.submit(
+            "analytics", lambda ctx: analytics_job(ctx, params),
+            artifacts=["warehouse"] + report_outputs(),
+            params=params
         )
-        
-        if result.returncode != 0:
-            error_msg = result.stderr or result.stdout or "Unknown error"
-            return jsonify({
-                "status": "error",
-                "error_code": "ExecutionError",
-                "message": error_msg[:500]
-            }), 500
-        
-        # Get row counts from exported files
-        exports = []
-        sku_path = ARTIFACTS_DIR / "sku_dropoff.csv"
-        cohort_path = ARTIFACTS_DIR / "cohort_retention.csv"
-        
-        if sku_path.exists():
-            rows = count_csv_rows(sku_path)
-            exports.append({"file": "sku_dropoff.csv", "rows": rows})
-        else:
-            exports.append({"file": "sku_dropoff.csv", "rows": None})
-        
-        if cohort_path.exists():
-            rows = count_csv_rows(cohort_path)
-            exports.append({"file": "cohort_retention.csv", "rows": rows})
-        else:
-            exports.append({"file": "cohort_retention.csv", "rows": None})
-        
-        return jsonify({
-            "status": "success",
-            "exports": exports
-        })
+        return job_accepted(job, created)
     
-    except subprocess.TimeoutExpired:
+    except Exception as e:
         return jsonify({
             "status": "error",
-            "error_code": "TimeoutError",
-            "message": "Analytics execution timed out after 5 minutes"
+            "error_code": "Exception",
+            "message": str(e)
         }), 500
-    
-    except FileNotFoundError as e:
+
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """List known pipeline/analytics jobs, newest first."""
+    return jsonify({"jobs": JOBS.list()})
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get status, stage and progress of a job."""
+    job = JOBS.get(job_id)
+    if job is None:
         return jsonify({
-            "status": "error",
-            "error_code": "FileNotFoundError",
-            "message": str(e)
+            "status": "not_found",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+    return jsonify({"status": "success", "job": job})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running job."""
+    job = JOBS.cancel(job_id)
+    if job is None:
+        return jsonify({
+            "status": "not_found",
+            "message": f"Unknown job: {job_id}"
         }), 404
+    return jsonify({"status": "success", "job": job})
+
+
+@app.route('/api/runs', methods=['GET'])
+def list_runs():
+    """List recorded pipeline/analytics runs, newest first.
     
-    except Exception as e:
+    Query args: kind (pipeline|analytics), limit (default 20).
+    """
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
         return jsonify({
             "status": "error",
-            "error_code": "Exception",
-            "message": str(e)
-        }), 500
+            "error_code": "ValueError",
+            "message": "limit must be an integer"
+        }), 400
+    return jsonify({"runs": instrument.list_runs(kind=request.args.get("kind"), limit=limit)})
+
+
+@app.route('/api/runs/<run_id>', methods=['GET'])
+def get_run(run_id):
+    """Get the full per-stage metrics record of a run."""
+    record = instrument.load_run(run_id)
+    if record is None:
+        return jsonify({
+            "status": "not_found",
+            "message": f"Unknown run: {run_id}"
+        }), 404
+    return jsonify({"status": "success", "run": record})
 
 
 @app.route('/api/artifacts', methods=['GET'])
 def get_artifacts():
-    """Get list of artifacts with metadata."""
-    expected_files = [
-        "funnel_session.csv",
-        "funnel_steps.csv",
-        "sku_dropoff.csv",
-        "cohort_retention.csv"
-    ]
+    """Get list of artifacts with metadata.
+    
+    Tagged with an ETag over the artifacts' size/mtime, so polls with a
+    matching If-None-Match get 304 without any CSV being read.
+    """
+    expected_files = ["funnel_session.csv", "funnel_steps.csv"] + report_outputs()
+    etag = httpcache.make_etag(
+        "artifacts", [(f, httpcache.file_version(ARTIFACTS_DIR / f)) for f in expected_files]
+    )
+    cached = httpcache.not_modified(etag)
+    if cached is not None:
+        return cached
     
     files = []
     for filename in expected_files:
@@ -279,53 +436,233 @@ def get_artifacts():
             "rows": rows
         })
     
-    return jsonify({"files": files})
+    return httpcache.tag(jsonify({"files": files}), etag)
+
+
+@app.route('/api/artifacts/<name>/download', methods=['GET'])
+def download_artifact(name):
+    """Stream a slice of an artifact as gzip CSV, Parquet or Arrow IPC.
+    
+    Query args: format (csv|parquet|arrow, default csv), columns (repeatable
+    or comma-separated), filter (column:op:value with op eq|ne|lt|le|gt|ge|in,
+    'in' values separated by '|'; repeatable, ANDed), offset, limit.
+    """
+    filename = name if name.endswith(".csv") else f"{name}.csv"
+    if filename not in ["funnel_session.csv", "funnel_steps.csv"] + report_outputs() \
+            or not (ARTIFACTS_DIR / filename).exists():
+        return jsonify({
+            "status": "not_found",
+            "message": f"Unknown artifact: {name}"
+        }), 404
+    
+    path = ARTIFACTS_DIR / filename
+    con = downloads.open_connection()
+    try:
+        columns = downloads.artifact_columns(con, path)
+        params = downloads.normalize_params(request.args, columns)
+        if params["format"] == "arrow" and downloads.pa is None:
+            con.close()
+            return jsonify({
+                "status": "error",
+                "error_code": "NotImplemented",
+                "message": "Arrow downloads require pyarrow on the server"
+            }), 501
+        # Run the query up to the first chunk so errors still get a JSON response
+        stream = downloads.stream_artifact(con, path, params, columns)
+        first = next(stream, b"")
+    except ValueError as e:
+        con.close()
+        return jsonify({
+            "status": "error",
+            "error_code": "ValueError",
+            "message": str(e)
+        }), 400
+    except duckdb.Error as e:
+        con.close()
+        return jsonify({
+            "status": "error",
+            "error_code": type(e).__name__,
+            "message": str(e)
+        }), 400
+    
+    mimetype, extension = downloads.FORMATS[params["format"]]
+    download_name = filename[:-len(".csv")] + extension
+    return Response(
+        itertools.chain([first], stream),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{download_name}"'}
+    )
 
 
 @app.route('/api/pipeline/summary', methods=['GET'])
 def get_pipeline_summary():
-    """Get pipeline summary metrics from artifacts."""
-    funnel_session_path = ARTIFACTS_DIR / "funnel_session.csv"
+    """Get pipeline summary metrics from the summary cache, warehouse or CSV artifacts.
     
-    if not funnel_session_path.exists():
+    Sessions of streamed events that are still open (or awaiting their
+    flush) are added from the live counters. Responses carry an ETag over
+    the warehouse/artifact versions and live counters; a matching
+    If-None-Match gets 304 without computing anything.
+    """
+    try:
+        etag = summary_etag()
+        cached = httpcache.not_modified(etag)
+        if cached is not None:
+            return cached
+        metrics = with_live_counters(get_summary_metrics())
+        if metrics is None:
+            return jsonify({
+                "status": "not_found",
+                "message": "No pipeline summary available. Run the pipeline first."
+            }), 404
+        
+        return httpcache.tag(jsonify({
+            "status": "success",
+            "metrics": metrics
+        }), etag)
+    
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+@app.route('/api/events', methods=['POST'])
+def ingest_events():
+    """Buffer a batch of raw events for micro-batch sessionization.
+    
+    JSON body: {"events": [{"user_id", "timestamp", "event", "itemid"}, ...]}
+    (the events.csv fields; timestamp as epoch seconds/milliseconds or ISO
+    8601). Returns 202 once buffered; funnel counters update within about
+    ingest.MICRO_BATCH_SECONDS.
+    """
+    if not WAREHOUSE_PATH.exists():
+        return jsonify({
+            "status": "not_found",
+            "message": "Warehouse not found. Run the pipeline before streaming events."
+        }), 404
+    try:
+        events = ingest.parse_events(request.get_json(silent=True))
+        buffered = LIVE_FUNNEL.submit(events)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "error_code": "ValueError",
+            "message": f"Invalid events: {e}"
+        }), 400
+    except OverflowError as e:
+        return jsonify({
+            "status": "error",
+            "error_code": "OverflowError",
+            "message": str(e)
+        }), 503
+    return jsonify({"status": "accepted", "accepted": len(events), "buffered": buffered}), 202
+
+
+@app.route('/api/events/status', methods=['GET'])
+def get_events_status():
+    """Get the ingestion buffer, open sessions, live counters and last flush."""
+    return jsonify({"status": "success", "stream": LIVE_FUNNEL.status()})
+
+
+@app.route('/api/events/flush', methods=['POST'])
+def flush_events():
+    """Close every open streamed session and merge it into the warehouse now.
+    
+    Does not wait for a pipeline job or another flush: returns 409 if either
+    holds the warehouse (the closed sessions stay queued and the background
+    flusher merges them once it is free).
+    """
+    try:
+        flushed = LIVE_FUNNEL.process(close_all=True, blocking=False)
+    except (ingest.FlushBusyError, WarehouseLockedError) as e:
+        return jsonify({
+            "status": "error",
+            "error_code": type(e).__name__,
+            "message": str(e)
+        }), 409
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "error_code": type(e).__name__,
+            "message": str(e)
+        }), 500
+    return jsonify({"status": "success", "flushed_events": flushed, "stream": LIVE_FUNNEL.status()})
+
+
+@app.route('/api/pipeline/quality', methods=['GET'])
+def get_pipeline_quality():
+    """Get the data-quality report of the last pipeline run."""
+    report = quality.read_report()
+    if report is None:
         return jsonify({
             "status": "not_found",
-            "message": "No pipeline summary available. Run the pipeline first."
+            "message": "No data-quality report available. Run the pipeline first."
         }), 404
+    return jsonify({"status": "success", "report": report})
+
+
+@app.route('/api/pipeline/preview', methods=['GET'])
+def get_pipeline_preview():
+    """Get the summary of the last sampled preview run."""
+    summary = preview.read_summary()
+    if summary is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No preview available. Queue one with POST /api/pipeline/run {\"sample\": \"5%\"}."
+        }), 404
+    return jsonify({"status": "success", "preview": summary})
+
+
+@app.route('/api/partitions', methods=['GET'])
+def get_partitions():
+    """Get the month-partition manifest (rows, ts range, bytes, archived flag)."""
+    manifest = partitions.read_manifest()
+    if manifest is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No partitions written yet. Run the pipeline first."
+        }), 404
+    return jsonify({"status": "success", "manifest": manifest})
+
+
+@app.route('/api/query/funnel', methods=['GET'])
+def query_funnel():
+    """Ad-hoc funnel slice over the warehouse.
     
+    Query args: start, end (ISO dates, inclusive), sku, event_type, cohort
+    (YYYY-MM, first-purchase month; all repeatable or comma-separated),
+    group_by (day|week|month|sku|event_type|cohort_month), limit, offset.
+    """
     try:
-        metrics = {}
-        with open(funnel_session_path, 'r') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            
-            total_views = sum(int(row.get('has_view', 0)) for row in rows)
-            total_carts = sum(int(row.get('has_cart', 0)) for row in rows)
-            total_purchases = sum(int(row.get('has_purchase', 0)) for row in rows)
-            
-            metrics['session_count'] = len(rows)
-            
-            # Approximate events count from steps file
-            funnel_steps_path = ARTIFACTS_DIR / "funnel_steps.csv"
-            if funnel_steps_path.exists():
-                steps_rows = count_csv_rows(funnel_steps_path)
-                if steps_rows:
-                    metrics['steps_count'] = steps_rows
-                    metrics['events_count'] = steps_rows  # Approximate
-            
-            if total_views > 0:
-                metrics['view_to_cart_rate'] = (total_carts / total_views) * 100
-            if total_carts > 0:
-                metrics['cart_to_purchase_rate'] = (total_purchases / total_carts) * 100
-        
+        params = query_api.normalize_params(request.args)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "error_code": "ValueError",
+            "message": str(e)
+        }), 400
+    
+    try:
+        with WAREHOUSE_POOL.cursor() as con:
+            result, cached = query_api.run_query(con, params, QUERY_CACHE)
         return jsonify({
             "status": "success",
-            "metrics": metrics
+            "params": params,
+            "cached": cached,
+            **result
         })
     
-    except Exception as e:
+    except FileNotFoundError as e:
+        return jsonify({
+            "status": "not_found",
+            "message": str(e)
+        }), 404
+    
+    except duckdb.Error as e:
         return jsonify({
             "status": "error",
+            "error_code": "DuckDBError",
             "message": str(e)
         }), 500
 
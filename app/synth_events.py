@@ -0,0 +1,214 @@
+"""
+Deterministic synthetic events.csv generator (RetailRocket-shaped).
+
+Writes `user_id,timestamp,event,itemid` rows with epoch-millisecond
+timestamps, like the RetailRocket export, so the ETL, analytics and
+benchmarks can run without the real dataset. The shape is configurable:
+
+- users, each with a geometric number of sessions (mean --sessions-per-user)
+- sessions of a geometric number of views (mean --views-per-session), spaced
+  10s-10min apart, starting anywhere in the --days window
+- per-view add-to-cart probability and per-cart purchase probability
+- SKU popularity following a power law (Zipf exponent --sku-alpha)
+
+All randomness comes from DuckDB's hash() of (seed, tag, keys), so the same
+arguments produce the same file (for a given DuckDB version). Generation runs
+as a single DuckDB COPY, so 100M-event files stream to disk without Python
+loops.
+"""
+import sys
+import math
+import argparse
+import datetime as dt
+import pathlib as p
+import duckdb
+from utils import RAW, escape_sql_path, connect, add_runtime_args, configure_runtime_from_args
+
+DEFAULTS = {
+    "sessions_per_user": 1.5,
+    "views_per_session": 2.0,
+    "cart_rate": 0.026,
+    "purchase_rate": 0.32,
+    "skus": 235_000,
+    "sku_alpha": 1.1,
+    "start": "2015-05-03",
+    "days": 138,
+    "seed": 42,
+}
+
+# Multiplier/modulus of the Lehmer permutation that scatters SKU popularity
+# ranks over item ids (bijective on 1..2^31-2)
+SKU_PERMUTATION = (48271, 2147483647)
+
+
+def parse_count(value):
+    """Parse an event count such as 1000000, '1M', '10M' or '2.5K'."""
+    text = str(value).strip().upper()
+    units = {"K": 10**3, "M": 10**6, "B": 10**9}
+    factor = units.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in units else text
+    try:
+        count = int(float(number) * factor)
+    except ValueError:
+        raise ValueError(f"Invalid count {value!r}; use an integer or a K/M/B suffix")
+    if count <= 0:
+        raise ValueError(f"Count must be positive, got {value!r}")
+    return count
+
+
+def events_per_user(sessions_per_user, views_per_session, cart_rate, purchase_rate):
+    """Expected number of events generated per user."""
+    return sessions_per_user * views_per_session * (1 + cart_rate + cart_rate * purchase_rate)
+
+
+def _uniform(seed, tag, *keys):
+    """SQL for a deterministic uniform draw in [0, 1) keyed on (seed, tag, keys)."""
+    args = ", ".join(str(k) for k in keys)
+    return f"(hash({seed}, '{tag}', {args})::DOUBLE / 18446744073709551616.0)"
+
+
+def _geometric(u, mean):
+    """SQL for a geometric draw >= 1 with the given mean from uniform `u`."""
+    if mean <= 1:
+        return "1"
+    return f"(1 + floor(ln(1 - {u}) / ln({1 - 1 / mean}))::BIGINT)"
+
+
+def _power_law(u, n, alpha):
+    """SQL for a popularity rank in 1..n with P(rank k) ~ k^-alpha."""
+    if abs(alpha - 1) < 1e-9:
+        rank = f"pow({n}, {u})"
+    else:
+        a = 1 - alpha
+        rank = f"pow(({n ** a - 1!r}) * {u} + 1, {1 / a!r})"
+    return f"LEAST({n}, GREATEST(1, floor({rank})::BIGINT))"
+
+
+def generator_sql(users, sessions_per_user, views_per_session, cart_rate, purchase_rate,
+                  skus, sku_alpha, start, days, seed):
+    """Build the SELECT producing the synthetic events, ordered by timestamp."""
+    start_s = int(dt.datetime.fromisoformat(start).replace(tzinfo=dt.timezone.utc).timestamp())
+    span_s = int(days * 86400)
+    mult, mod = SKU_PERMUTATION
+    u = lambda tag, *keys: _uniform(seed, tag, *keys)
+    return f"""
+    WITH sessions AS (
+      SELECT user_id, unnest(range({_geometric(u('sessions', 'user_id'), sessions_per_user)})) AS session_no
+      FROM (SELECT range AS user_id FROM range({users}))
+    ),
+    session_shape AS (
+      SELECT user_id, session_no,
+             {start_s} + floor({u('start', 'user_id', 'session_no')} * {span_s})::BIGINT AS start_s,
+             10 + floor({u('gap', 'user_id', 'session_no')} * 590)::BIGINT AS gap_s,
+             {_geometric(u('views', 'user_id', 'session_no'), views_per_session)} AS views
+      FROM sessions
+    ),
+    views AS (
+      SELECT user_id, session_no, view_no,
+             start_s + view_no * gap_s AS ts_s,
+             ({_power_law(u('sku', 'user_id', 'session_no', 'view_no'), skus, sku_alpha)} * {mult}) % {mod} AS itemid,
+             {u('cart', 'user_id', 'session_no', 'view_no')} < {cart_rate} AS carted,
+             {u('purchase', 'user_id', 'session_no', 'view_no')} < {purchase_rate} AS purchased
+      FROM (SELECT *, unnest(range(views)) AS view_no FROM session_shape)
+    ),
+    events AS (
+      SELECT user_id, ts_s * 1000 AS ts_ms, 'view' AS event, itemid FROM views
+      UNION ALL
+      SELECT user_id, (ts_s + 20) * 1000, 'addtocart', itemid FROM views WHERE carted
+      UNION ALL
+      SELECT user_id, (ts_s + 80) * 1000, 'transaction', itemid FROM views WHERE carted AND purchased
+    )
+    SELECT user_id, ts_ms AS timestamp, event, itemid
+    FROM events
+    ORDER BY timestamp, user_id, event, itemid
+    """
+
+
+def generate_events(output, events=None, users=None, con=None, **options):
+    """Write a synthetic events CSV.
+
+    Args:
+        output: Destination CSV path
+        events: Approximate number of events (sets users from the expected
+            events per user); ignored when `users` is given
+        users: Number of users to simulate
+        con: DuckDB connection to use (an in-memory one is opened if omitted)
+        **options: Overrides for DEFAULTS (sessions_per_user, views_per_session,
+            cart_rate, purchase_rate, skus, sku_alpha, start, days, seed)
+
+    Returns:
+        Number of events written
+
+    Raises:
+        ValueError: If neither events nor users is given, or a rate is not in [0, 1]
+    """
+    params = {**DEFAULTS, **{k: v for k, v in options.items() if v is not None}}
+    for rate in ("cart_rate", "purchase_rate"):
+        if not 0 <= params[rate] <= 1:
+            raise ValueError(f"{rate} must be between 0 and 1")
+    if users is None:
+        if events is None:
+            raise ValueError("Either events or users is required")
+        per_user = events_per_user(params["sessions_per_user"], params["views_per_session"],
+                                   params["cart_rate"], params["purchase_rate"])
+        users = max(1, math.ceil(events / per_user))
+
+    owns_con = con is None
+    con = con or connect()
+    try:
+        return con.execute(f"""
+        COPY ({generator_sql(users, **params)})
+        TO '{escape_sql_path(output)}' (HEADER, DELIMITER ',');
+        """).fetchone()[0]
+    finally:
+        if owns_con:
+            con.close()
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate a synthetic RetailRocket-shaped events.csv.")
+    parser.add_argument("--events", default="1M", help="Approximate event count, e.g. 1M, 10M (default: 1M)")
+    parser.add_argument("--users", type=int, help="Simulate exactly this many users (overrides --events)")
+    parser.add_argument("--output", default=str(RAW / "events.csv"), help="Output CSV (default: data/raw/events.csv)")
+    parser.add_argument("--force", action="store_true", help="Overwrite the output file if it exists")
+    parser.add_argument("--seed", type=int, help=f"Random seed (default: {DEFAULTS['seed']})")
+    parser.add_argument("--sessions-per-user", type=float, help=f"Mean sessions per user (default: {DEFAULTS['sessions_per_user']})")
+    parser.add_argument("--views-per-session", type=float, help=f"Mean views per session (default: {DEFAULTS['views_per_session']})")
+    parser.add_argument("--cart-rate", type=float, help=f"Add-to-cart probability per view (default: {DEFAULTS['cart_rate']})")
+    parser.add_argument("--purchase-rate", type=float, help=f"Purchase probability per cart (default: {DEFAULTS['purchase_rate']})")
+    parser.add_argument("--skus", type=int, help=f"Number of SKUs (default: {DEFAULTS['skus']:,})")
+    parser.add_argument("--sku-alpha", type=float, help=f"Power-law exponent of SKU popularity (default: {DEFAULTS['sku_alpha']})")
+    parser.add_argument("--start", help=f"First day of the event window (default: {DEFAULTS['start']})")
+    parser.add_argument("--days", type=int, help=f"Length of the event window in days (default: {DEFAULTS['days']})")
+    add_runtime_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Generate the synthetic events file."""
+    args = parse_args(argv)
+    configure_runtime_from_args(args)
+    try:
+        output = p.Path(args.output)
+        if output.exists() and not args.force:
+            raise FileExistsError(f"{output} already exists; pass --force to overwrite it")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Generating synthetic events to {output}...")
+        rows = generate_events(
+            output, events=parse_count(args.events), users=args.users,
+            sessions_per_user=args.sessions_per_user, views_per_session=args.views_per_session,
+            cart_rate=args.cart_rate, purchase_rate=args.purchase_rate, skus=args.skus,
+            sku_alpha=args.sku_alpha, start=args.start, days=args.days, seed=args.seed
+        )
+        print(f"✅ Wrote {rows:,} events to {output}")
+    except (FileExistsError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except duckdb.Error as e:
+        print(f"❌ DuckDB Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 """
 Utility functions and constants for the e-commerce funnel analyzer.
 """
+import os
+import re
+import json
+import threading
+import contextlib
 import pathlib as p
+import duckdb
 
 # Get project root directory (parent of src/)
 PROJECT_ROOT = p.Path(__file__).parent.parent.resolve()
@@ -9,7 +15,58 @@ PROJECT_ROOT = p.Path(__file__).parent.parent.resolve()
 # Path constants (relative to project root)
 RAW = PROJECT_ROOT / "data" / "raw"
 INTERIM = PROJECT_ROOT / "data" / "interim"
-ARTIFACTS = PROJECT_ROOT / "artifacts"
+
+# Output directory, raw events file and warehouse can be redirected with
+# FUNNEL_ARTIFACTS, FUNNEL_EVENTS_FILE and FUNNEL_WAREHOUSE (used by the
+# benchmark harness to run against synthetic data without touching these)
+ARTIFACTS = p.Path(os.environ.get("FUNNEL_ARTIFACTS", PROJECT_ROOT / "artifacts"))
+EVENTS_FILE = p.Path(os.environ.get("FUNNEL_EVENTS_FILE", RAW / "events.csv"))
+
+# Persistent DuckDB warehouse written by the ETL and queried by analytics/server
+WAREHOUSE = p.Path(os.environ.get("FUNNEL_WAREHOUSE", INTERIM / "funnel.duckdb"))
+
+# Per-run stage/timing/profile records (see instrument.py); FUNNEL_RUNS_DIR
+# keeps benchmark runs out of the real run history
+RUNS_DIR = p.Path(os.environ.get("FUNNEL_RUNS_DIR", INTERIM / "runs"))
+
+# Month-partitioned Parquet mirror of funnel_steps/funnel_session (see
+# partitions.py); kept next to the warehouse unless FUNNEL_PARTITIONS is set
+PARTITIONS_DIR = p.Path(os.environ.get("FUNNEL_PARTITIONS", WAREHOUSE.parent / "partitions"))
+
+# Append-only log of streamed events flushed to the warehouse (see ingest.py);
+# full builds replay it, so streamed events survive a rebuild from events.csv
+STREAM_LOG = WAREHOUSE.parent / "stream_events.csv"
+
+# Synthetic datasets, warehouses and results written by the benchmark harness
+BENCH_DIR = INTERIM / "bench"
+
+# Funnel event types, in funnel order (also the ENUM codes 0..2 in the warehouse)
+EVENT_TYPES = ("view", "addtocart", "transaction")
+
+# Cached funnel totals/rates written by the ETL and read by the API server
+SUMMARY_CACHE = ARTIFACTS / "pipeline_summary.json"
+
+# When FUNNEL_PROGRESS=1, stages emit "PROGRESS {json}" lines on stdout for the job runner
+PROGRESS_ENV = "FUNNEL_PROGRESS"
+PROGRESS_PREFIX = "PROGRESS "
+
+# Per-thread progress handler installed by in-process job runs (see progress_handler)
+_progress_local = threading.local()
+
+# Spill directory for sorts/window partitions that exceed the memory limit
+SPILL_DIR = INTERIM / "duckdb_tmp"
+
+# Low-memory mode: cap DuckDB at this fraction of physical RAM and few threads
+LOW_MEMORY_FRACTION = 0.25
+LOW_MEMORY_THREADS = 2
+
+# DuckDB runtime settings applied to every connection (see configure_runtime)
+RUNTIME = {
+    "memory_limit": os.environ.get("FUNNEL_MEMORY_LIMIT"),
+    "threads": os.environ.get("FUNNEL_THREADS"),
+    "temp_directory": os.environ.get("FUNNEL_TEMP_DIR"),
+    "low_memory": os.environ.get("FUNNEL_LOW_MEMORY", "").lower() in ("1", "true", "yes"),
+}
 
 # Ensure directories exist
 RAW.mkdir(parents=True, exist_ok=True)
@@ -19,13 +76,13 @@ ARTIFACTS.mkdir(parents=True, exist_ok=True)
 
 def get_events_file():
     """Get the path to events.csv file."""
-    events_path = RAW / "events.csv"
-    if not events_path.exists():
+    if not EVENTS_FILE.exists():
         raise FileNotFoundError(
-            f"events.csv not found in {RAW}. "
-            "Please download the RetailRocket dataset and place events.csv in data/raw/"
+            f"{EVENTS_FILE.name} not found in {EVENTS_FILE.parent}. "
+            "Please download the RetailRocket dataset and place events.csv in data/raw/ "
+            "(or generate one with 'python app/synth_events.py')"
         )
-    return str(events_path)
+    return str(EVENTS_FILE)
 
 
 def validate_data_directory():
@@ -36,10 +93,245 @@ def validate_data_directory():
             "Please create it and add your data files."
         )
     
-    events_file = RAW / "events.csv"
-    if not events_file.exists():
+    if not EVENTS_FILE.exists():
         raise FileNotFoundError(
-            f"Required file events.csv not found in {RAW}. "
+            f"Required file {EVENTS_FILE.name} not found in {EVENTS_FILE.parent}. "
             "Please download the dataset and place it in data/raw/"
         )
 
+
+
+def escape_sql_path(path):
+    """Return a filesystem path escaped for use inside a SQL string literal."""
+    return str(path).replace("'", "''")
+
+
+def physical_memory_bytes():
+    """Return total physical memory in bytes, or None if it cannot be determined."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def configure_runtime(memory_limit=None, threads=None, temp_directory=None, low_memory=None):
+    """Override the DuckDB runtime settings used by connect().
+    
+    Arguments left as None keep their current value (environment defaults:
+    FUNNEL_MEMORY_LIMIT, FUNNEL_THREADS, FUNNEL_TEMP_DIR, FUNNEL_LOW_MEMORY).
+    """
+    for key, value in (("memory_limit", memory_limit), ("threads", threads),
+                       ("temp_directory", temp_directory), ("low_memory", low_memory)):
+        if value is not None:
+            RUNTIME[key] = value
+
+
+def runtime_config():
+    """Build the DuckDB config dict from RUNTIME.
+    
+    Insertion order is not preserved by default, which lets DuckDB stream
+    and spill more freely; event loads turn it on for the duration of the
+    load (etl_funnel.file_order), so events.rowid follows file order. Low-memory mode caps memory and
+    threads so sorts and window partitions spill to data/interim/duckdb_tmp.
+    """
+    config = {"preserve_insertion_order": False}
+    memory_limit = RUNTIME["memory_limit"]
+    threads = RUNTIME["threads"]
+    temp_directory = RUNTIME["temp_directory"]
+    
+    if RUNTIME["low_memory"]:
+        if memory_limit is None:
+            total = physical_memory_bytes()
+            if total:
+                memory_limit = f"{max(1, int(total * LOW_MEMORY_FRACTION / 1024**2))}MB"
+        if threads is None:
+            threads = LOW_MEMORY_THREADS
+        if temp_directory is None:
+            temp_directory = SPILL_DIR
+    
+    if memory_limit:
+        config["memory_limit"] = str(memory_limit)
+    if threads:
+        config["threads"] = int(threads)
+    if temp_directory:
+        p.Path(temp_directory).mkdir(parents=True, exist_ok=True)
+        config["temp_directory"] = str(temp_directory)
+    return config
+
+
+def add_runtime_args(parser):
+    """Add DuckDB runtime options (memory limit, threads, spill dir) to a CLI parser."""
+    group = parser.add_argument_group("runtime")
+    group.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 8GB")
+    group.add_argument("--threads", type=int, help="DuckDB worker threads")
+    group.add_argument("--temp-dir", help="Directory for spilled sorts/windows")
+    group.add_argument(
+        "--low-memory", action="store_true", default=None,
+        help=f"Cap memory and threads and spill to {SPILL_DIR}"
+    )
+    return parser
+
+
+def configure_runtime_from_args(args):
+    """Apply runtime options parsed by add_runtime_args."""
+    configure_runtime(
+        memory_limit=args.memory_limit,
+        threads=args.threads,
+        temp_directory=args.temp_dir,
+        low_memory=args.low_memory
+    )
+
+
+def connect(database=":memory:", read_only=False):
+    """Open a DuckDB connection with the project runtime configuration."""
+    return duckdb.connect(database=str(database), read_only=read_only, config=runtime_config())
+
+
+class WarehouseLockedError(duckdb.IOException):
+    """The warehouse file is locked by another process (usually the API server)."""
+
+
+def connect_warehouse(read_only=False):
+    """Open a connection to the persistent DuckDB warehouse.
+    
+    DuckDB lets one process write a database file at a time, and the API
+    server keeps the warehouse open while it runs (see warehouse.py), so
+    CLI runs against a warehouse the server holds fail with
+    WarehouseLockedError; run them through the server's job API instead.
+    
+    Args:
+        read_only: Open the database read-only (requires an existing warehouse)
+        
+    Raises:
+        FileNotFoundError: If read_only is set and the ETL has not run yet
+        WarehouseLockedError: If another process holds the warehouse lock
+    """
+    if read_only and not WAREHOUSE.exists():
+        raise FileNotFoundError(
+            f"Warehouse {WAREHOUSE} not found. "
+            "Please run 'python app/etl_funnel.py' first."
+        )
+    try:
+        return connect(WAREHOUSE, read_only=read_only)
+    except duckdb.IOException as e:
+        if "Could not set lock" not in str(e):
+            raise
+        holder = re.search(r"PID \d+", str(e))
+        raise WarehouseLockedError(
+            f"Warehouse {WAREHOUSE} is in use by another process"
+            f"{f' ({holder.group(0)})' if holder else ''}, usually the API server. "
+            "Stop it first, or run the pipeline/reports through its API "
+            "(POST /api/pipeline/run, POST /api/analytics/run)."
+        ) from e
+
+
+def report_progress(stage, fraction=None, **info):
+    """Emit a structured progress event for the current pipeline stage.
+    
+    Args:
+        stage: Stage name (e.g. "load", "sessionize", "export")
+        fraction: Overall completion between 0 and 1, if known
+        **info: Extra JSON-serializable fields (row counts, final metrics)
+    """
+    handler = getattr(_progress_local, "handler", None)
+    if handler is not None:
+        handler(stage, fraction, **info)
+        return
+    if os.environ.get(PROGRESS_ENV) != "1":
+        return
+    event = {"stage": stage, "fraction": fraction, **info}
+    print(PROGRESS_PREFIX + json.dumps(event, default=str), flush=True)
+
+
+@contextlib.contextmanager
+def progress_handler(handler):
+    """Route report_progress calls made on this thread to `handler(stage, fraction, **info)`."""
+    previous = getattr(_progress_local, "handler", None)
+    _progress_local.handler = handler
+    try:
+        yield
+    finally:
+        _progress_local.handler = previous
+
+
+def file_signature(path):
+    """Return the (size, mtime) signature used to invalidate cached metadata."""
+    stat = p.Path(path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_json_atomic(path, data):
+    """Write JSON to `path` via a temp file so readers never see a partial file."""
+    path = p.Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def artifact_meta_path(path):
+    """Return the sidecar metadata path for an artifact (e.g. x.csv.meta.json)."""
+    path = p.Path(path)
+    return path.with_name(path.name + ".meta.json")
+
+
+def write_artifact_meta(path, **fields):
+    """Write sidecar metadata (row count etc.) tied to the artifact's current signature."""
+    write_json_atomic(artifact_meta_path(path), {**fields, "signature": file_signature(path)})
+
+
+def read_artifact_meta(path):
+    """Read sidecar metadata for an artifact, or None if missing or stale."""
+    path = p.Path(path)
+    meta_path = artifact_meta_path(path)
+    if not path.exists() or not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("signature") != file_signature(path):
+        return None
+    return meta
+
+
+def funnel_metrics(session_count, steps_count, views, carts, purchases, events_count=None):
+    """Build the summary metrics dict shared by the ETL, cache and API server."""
+    metrics = {
+        "session_count": session_count,
+        "steps_count": steps_count,
+        "events_count": events_count if events_count is not None else steps_count,
+        "views": views,
+        "carts": carts,
+        "purchases": purchases
+    }
+    if views > 0:
+        metrics["view_to_cart_rate"] = (carts / views) * 100
+    if carts > 0:
+        metrics["cart_to_purchase_rate"] = (purchases / carts) * 100
+    return metrics
+
+
+def write_summary_cache(metrics, source=WAREHOUSE):
+    """Cache summary metrics, invalidated when `source` changes."""
+    write_json_atomic(SUMMARY_CACHE, {
+        "metrics": metrics,
+        "source": str(source),
+        "signature": file_signature(source)
+    })
+
+
+def read_summary_cache():
+    """Return cached summary metrics, or None if missing or stale."""
+    if not SUMMARY_CACHE.exists():
+        return None
+    try:
+        with open(SUMMARY_CACHE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        source = p.Path(cache["source"])
+        if not source.exists() or cache.get("signature") != file_signature(source):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return cache["metrics"]
@@ -0,0 +1,89 @@
+"""
+Long-lived DuckDB connection pool for the API server.
+
+The server keeps one DuckDB database instance open on the warehouse file for
+its whole lifetime and hands out cursors from a bounded pool. Cursors share
+the instance's buffer cache, so tables loaded by one request (or by an
+in-process pipeline run) stay warm for the next, and no request pays for
+re-importing duckdb or re-reading artifacts.
+
+The instance is opened read-write (pipeline jobs and streamed merges write
+through it), and DuckDB allows a single writing process per file: while the
+server runs, CLI runs of etl_funnel.py, run_analytics.py or partitions.py
+cannot open the warehouse and exit with a WarehouseLockedError message
+(see utils.connect_warehouse). Run them through the job API instead.
+"""
+import queue
+import threading
+import contextlib
+from utils import WAREHOUSE, connect_warehouse
+
+
+class WarehousePool:
+    """Bounded pool of cursors on a single warehouse connection."""
+
+    def __init__(self, size=4):
+        self._size = size
+        self._lock = threading.Lock()
+        self._con = None
+        self._idle = queue.LifoQueue()
+        self._created = 0
+
+    def _connection(self):
+        with self._lock:
+            if self._con is None:
+                self._con = connect_warehouse()
+            return self._con
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        con = self._connection()
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                return con.cursor()
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Check out a cursor for the duration of a with-block.
+
+        Raises:
+            FileNotFoundError: If the warehouse has not been created yet
+                (pipeline runs use `writer`, which creates it)
+        """
+        if not WAREHOUSE.exists():
+            raise FileNotFoundError(
+                f"Warehouse {WAREHOUSE} not found. Please run the pipeline first."
+            )
+        with self.writer() as cur:
+            yield cur
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Check out a cursor, creating the warehouse file if it does not exist."""
+        cur = self._checkout()
+        try:
+            yield cur
+        except BaseException:
+            # Roll back anything the caller left open so the cursor is reusable
+            try:
+                cur.execute("ROLLBACK;")
+            except Exception:
+                pass
+            raise
+        finally:
+            self._idle.put(cur)
+
+    def close(self):
+        """Close all cursors and the underlying connection."""
+        with self._lock:
+            while not self._idle.empty():
+                self._idle.get_nowait().close()
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+            self._created = 0
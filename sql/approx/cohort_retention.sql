@@ -0,0 +1,22 @@
+-- Cohort Retention Analysis (approximate distinct counts)
+-- Same output as sql/cohort_retention.sql, with user counts estimated from
+-- the HyperLogLog sketches in sketch_cohort_month (about 0.8% relative
+-- standard error; see app/rollups.py) instead of COUNT DISTINCT
+
+-- Runs instead of the exact report with run_analytics.py --approx-distinct
+
+-- User counts are multiplied by report_scale() (1/rate in sampled preview
+-- runs); retention is a ratio and needs no scaling
+
+WITH pairs AS (
+  SELECT cohort_month, month_active,
+         hll_estimate(COUNT(*), SUM(pow(0.5, rho))) AS active_users
+  FROM sketch_cohort_month
+  GROUP BY 1,2
+)
+SELECT cohort_month, month_active,
+       CAST(round(CASE WHEN month_active=cohort_month THEN active_users ELSE 0 END * report_scale()) AS BIGINT) AS cohort_size,
+       CAST(round(active_users * report_scale()) AS BIGINT) AS active_users,
+       CASE WHEN month_active=cohort_month THEN 1.0*active_users/NULLIF(active_users,0) END AS retention
+FROM pairs
+ORDER BY 1,2;
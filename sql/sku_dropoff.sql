@@ -2,27 +2,23 @@
 -- Identifies SKUs with low cart-to-purchase conversion rates
 -- Uses RANK() window function and QUALIFY clause
 
--- Load funnel_steps if not already loaded (path resolved relative to project root)
-CREATE TABLE IF NOT EXISTS funnel_steps AS
-SELECT * FROM read_csv_auto('artifacts/funnel_steps.csv', header=true);
+-- Reads the rollup_sku_daily rollup (day × SKU stage counts) from the DuckDB
+-- warehouse (data/interim/funnel.duckdb) instead of scanning funnel_steps
 
-WITH carted AS (
-  SELECT sku, COUNT(*) AS carts
-  FROM funnel_steps
-  WHERE event_type='addtocart'
-  GROUP BY 1
-),
-purchased AS (
-  SELECT sku, COUNT(*) AS purchases
-  FROM funnel_steps
-  WHERE event_type='transaction'
+-- Counts are multiplied by report_scale() (1/rate in sampled preview runs),
+-- so the carts threshold and ranks apply to population-scale counts
+
+WITH sku_totals AS (
+  SELECT sku,
+         CAST(round(SUM(carts) * report_scale()) AS BIGINT) AS carts,
+         CAST(round(SUM(purchases) * report_scale()) AS BIGINT) AS purchases
+  FROM rollup_sku_daily
   GROUP BY 1
+  HAVING SUM(carts) > 0
 )
-SELECT c.sku, c.carts, COALESCE(p.purchases,0) AS purchases,
-       1.0*COALESCE(p.purchases,0)/NULLIF(c.carts,0) AS cart_to_purchase_rate,
-       RANK() OVER (ORDER BY 1.0*COALESCE(p.purchases,0)/NULLIF(c.carts,0)) AS low_conv_rank
-FROM carted c
-LEFT JOIN purchased p USING(sku)
-QUALIFY c.carts >= 50
+SELECT sku, carts, purchases,
+       1.0*purchases/NULLIF(carts,0) AS cart_to_purchase_rate,
+       RANK() OVER (ORDER BY 1.0*purchases/NULLIF(carts,0)) AS low_conv_rank
+FROM sku_totals
+QUALIFY carts >= 50
 ORDER BY cart_to_purchase_rate;
-